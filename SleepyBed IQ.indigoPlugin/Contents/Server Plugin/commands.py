@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# SleepyBed IQ Plugin command dispatcher
+#
+# Runs SleepIQ commands (SleepNumber, FlexFit presets, base positions...) on a
+# pool of worker threads so Indigo action callbacks can return right away.
+# Commands for the same bed run one at a time in the order they were queued;
+# commands for different beds run at the same time. Commands that set the same
+# thing (e.g. the left side head position) are held for a short coalescing
+# window, and a newer one replaces any that hasn't been sent yet.
+#
+################################################################################
+
+import logging
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("Plugin.commands")
+
+################################################################################
+class Command(object):
+    ########################################
+    def __init__(self, bedId, deviceId, description, function, args, target=None, expectedStates=None, verify=None,
+                 tracksMotion=False):
+        self.bedId = bedId  # SleepIQ bed ID. Commands with the same bed ID run in order.
+        self.target = target  # Hashable ID of what the command sets, or None if it must never be coalesced.
+        self.deviceId = deviceId  # Indigo device ID the command was issued for.
+        self.description = description  # Text describing the command for the log and device states.
+        self.function = function  # Callable that sends the command to the SleepIQ service.
+        self.args = args  # Tuple of arguments for function.
+        self.queuedTime = time.monotonic()
+        self.notBefore = self.queuedTime  # Time the command may be sent, later if it waits for newer values.
+        self.startTime = None
+        self.finishTime = None
+        self.error = None  # Exception raised by function, if any.
+        self.expectedStates = expectedStates or dict()  # Device state key: value expected once the command has taken effect (None if unknown).
+        self.previousStates = dict()  # Device state key: value to go back to if the command fails.
+        self.verify = verify  # Callable taking the bed ID and returning the actual device state values, or None.
+        self.tracksMotion = tracksMotion  # True if the command moves the base, so verify is read until it stops.
+
+    ########################################
+    def latency(self):
+        # Seconds from being queued until finished.
+        return (self.finishTime or time.monotonic()) - self.queuedTime
+
+
+################################################################################
+class CommandDispatcher(object):
+    ########################################
+    def __init__(self, workers=4, onFinished=None, coalesceWindow=0.5):
+        self.onFinished = onFinished  # Called with each Command after it ran, on the worker thread.
+        self.coalesceWindow = coalesceWindow  # Seconds a command with a target waits for a newer value.
+        self.coalesced = 0  # Number of commands dropped because a newer one for the same target replaced them.
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.queues = dict()  # bedId: deque of Commands waiting to run. A bed is present while a worker drains it.
+        self.lock = threading.Lock()
+
+    ########################################
+    def submit(self, command):
+        # Queue a command. Returns a tuple of the number of commands now pending for the command's bed and the
+        # command it replaced (or None).
+        replaced = None
+        with self.lock:
+            queue = self.queues.get(command.bedId, None)
+            startWorker = queue is None
+            if startWorker:
+                queue = self.queues[command.bedId] = deque()
+            if command.target is not None:
+                command.notBefore = command.queuedTime + self.coalesceWindow
+                for queuedCommand in queue:
+                    if queuedCommand.target == command.target:
+                        # Only the newest value is sent, no later than the replaced command would have been. It
+                        # goes to the end of the queue so it still runs after anything queued before it.
+                        replaced = queuedCommand
+                        queue.remove(queuedCommand)
+                        command.notBefore = min(command.notBefore, queuedCommand.notBefore)
+                        self.coalesced += 1
+                        break
+            queue.append(command)
+            pending = len(queue)
+        if startWorker:
+            self.executor.submit(self.drain, command.bedId)
+        return pending, replaced
+
+    ########################################
+    def pending(self, bedId):
+        # Number of commands waiting to run for a bed.
+        with self.lock:
+            return len(self.queues.get(bedId, ()))
+
+    ########################################
+    def drain(self, bedId):
+        # Run the bed's queued commands one at a time until none are left.
+        while True:
+            with self.lock:
+                queue = self.queues[bedId]
+                if len(queue) == 0:
+                    del self.queues[bedId]
+                    return
+                wait = queue[0].notBefore - time.monotonic()
+                if wait <= 0:
+                    command = queue.popleft()
+            if wait > 0:
+                # Give newer values for the same target a chance to replace the command before it's sent.
+                time.sleep(wait)
+                continue
+
+            command.startTime = time.monotonic()
+            try:
+                command.function(*command.args)
+            except Exception as e:
+                command.error = e
+            command.finishTime = time.monotonic()
+
+            if self.onFinished:
+                try:
+                    self.onFinished(command)
+                except Exception:
+                    logger.exception(f"Error reporting the result of \"{command.description}\"")
+
+    ########################################
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# SleepyBed IQ Plugin base motion tracker
+#
+# Follows a bed base while its actuators move after a position or FlexFit
+# preset command by reading the base status of just that bed every second or
+# so. Tracking ends when every position with a known target has reached it,
+# when the positions stop changing, or when the request budget runs out, so a
+# base that never gets where it was sent can't cause endless requests.
+#
+################################################################################
+
+import threading
+
+REACHED = "reached"  # Every position with a known target got there.
+STOPPED = "stopped"  # The base stopped moving short of a target, or (with no known targets) settled.
+TIMED_OUT = "timedOut"  # The request budget ran out while the base was still moving.
+CANCELLED = "cancelled"  # A newer tracker for the same bed took over.
+
+
+################################################################################
+class MotionTracker(object):
+    ########################################
+    def __init__(self, read, targets, interval=1.0, tolerance=2, stallReads=3, maxRequests=30, onProgress=None):
+        self.read = read  # Callable returning a dict of state key: current position.
+        self.targets = dict(targets)  # State key: target position, or None if not known ahead of time.
+        self.interval = interval  # Seconds between reads.
+        self.tolerance = tolerance  # Largest difference from a target that counts as reached.
+        self.stallReads = stallReads  # Number of reads in a row without any change that means the base stopped.
+        self.maxRequests = maxRequests  # Most reads for one tracking run.
+        self.onProgress = onProgress  # Called with the positions after every read that changed them.
+        self.requests = 0  # Number of reads made so far.
+        self.positions = dict()  # Positions from the last successful read.
+        self.cancelled = threading.Event()
+
+    ########################################
+    def cancel(self):
+        self.cancelled.set()
+
+    ########################################
+    def reached(self, positions):
+        knownTargets = [(key, target) for key, target in self.targets.items() if target is not None]
+        if len(knownTargets) == 0:
+            return False
+        return all(key in positions and abs(positions[key] - target) <= self.tolerance for key, target in knownTargets)
+
+    ########################################
+    def run(self):
+        # Read the positions until the base is done moving. Returns the result (REACHED, STOPPED, TIMED_OUT or
+        # CANCELLED). The last positions read are in self.positions.
+        unchanged = 0
+        while self.requests < self.maxRequests:
+            if self.cancelled.wait(self.interval):
+                return CANCELLED
+            self.requests += 1
+            try:
+                positions = self.read()
+            except Exception:
+                # A failed read counts against the budget but not toward deciding the base stopped.
+                continue
+
+            if self.reached(positions):
+                self.positions = positions
+                return REACHED
+            if positions == self.positions:
+                unchanged += 1
+                if unchanged >= self.stallReads:
+                    return STOPPED
+            else:
+                unchanged = 0
+                self.positions = positions
+                if self.onProgress:
+                    self.onProgress(positions)
+        return TIMED_OUT
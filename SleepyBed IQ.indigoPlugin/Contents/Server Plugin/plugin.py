@@ -14,10 +14,24 @@
 #
 ################################################################################
 
+import cProfile
+import hashlib
+import io
+import json
 import logging
+import os
+import pstats
 import requests
+import threading
+import time
 
-from sleepyq import Sleepyq
+from commands import Command, CommandDispatcher
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime
+from functools import partial
+from motion import MotionTracker, CANCELLED, STOPPED, TIMED_OUT
+from zoneinfo import ZoneInfo
+from sleepyq import API_URL, Sleepyq, Bed, SideStatus, Sleeper
 
 ################################################################################
 class Plugin(indigo.PluginBase):
@@ -41,6 +55,114 @@ class Plugin(indigo.PluginBase):
         self.lastError = ""  # String of last error message shown in log.
         self.bedsList = []  # List of beds associated with the SleepIQ account.
         self.sleepersList = []  # List of sleepers registered in the SleepIQ account.
+        self.bedCatalog = []  # Last known list of beds, saved between restarts, used until the first status update.
+        self.startTime = time.monotonic()  # Used to measure the time from startup to the first device update.
+        self.firstUpdateLogged = False
+
+        # Bed bases are queried by a pool of worker threads so several beds can be fetched at the same time.
+        self.baseFetchWorkers = int(pluginPrefs.get('baseFetchWorkers', 4))  # Maximum base requests in flight.
+        self.baseFetchDeadline = float(pluginPrefs.get('baseFetchDeadline', 10))  # Seconds to wait for all bases per cycle.
+        self.baseFetchExecutor = ThreadPoolExecutor(max_workers=self.baseFetchWorkers)
+        self.baseFetches = dict()  # bedId: Future of the last base fetch for the bed, possibly still running.
+        self.baseFetchesLock = threading.Lock()
+        self.connectionPoolSize = int(pluginPrefs.get('connectionPoolSize', 10))  # Kept-alive connections to the SleepIQ service.
+        self.apiUrl = pluginPrefs.get('apiUrl', "").strip() or API_URL  # Base URL of the SleepIQ service (or a local stand-in).
+        self.connectionWarmLead = 2  # Seconds before each poll to reopen connections the service closed while idle.
+        # Requests to the SleepIQ service are rate limited. The burst is raised to fit a whole status update of
+        # every bed, so base requests don't wait for the rate limiter past baseFetchDeadline.
+        self.requestRate = float(pluginPrefs.get('requestRate', 5))  # Requests per second on average.
+        self.requestBurst = int(pluginPrefs.get('requestBurst', 10))  # Smallest number of requests allowed at once.
+        # SleepIQ requests and responses can be recorded (credentials scrubbed) to replay them later for testing.
+        self.recordTraffic = bool(pluginPrefs.get('recordTraffic', False))
+        self.recordingMaxBytes = 5000000  # Size at which the recording file is rotated.
+        self.recordingBackups = 3  # Rotated recording files kept.
+
+        # Base capabilities (board features, bed type, underbed light settings) rarely change, so they are
+        # cached per bed on disk and only re-downloaded every few hours or from the plugin menu.
+        self.dataFolder = f"{indigo.server.getInstallFolderPath()}/Preferences/Plugins/{pluginId}"
+        self.capabilitiesFile = os.path.join(self.dataFolder, "capabilities.json")
+        self.capabilityRefreshHours = float(pluginPrefs.get('capabilityRefreshHours', 24))
+        # The service sometimes answers 404 for a while, so a bed recorded as having no base API is checked again
+        # after this many hours.
+        self.noBaseRecheckHours = 1
+        self.capabilities = dict()  # bedId: {'base': base, 'updated': epoch seconds, 'features': dict ({} if the base lists none), or None if the bed has no base API}
+        self.capabilitiesLock = threading.Lock()
+        self.capabilitiesDirty = False  # True when capabilities changed since they were last saved.
+        self.capabilitiesSaveLock = threading.Lock()  # Held while the capabilities file is written.
+
+        # The SleepIQ session key and bed catalog are saved so a restart doesn't have to wait on a login.
+        self.sessionFile = os.path.join(self.dataFolder, "session.json")
+        self.savedSession = dict()  # Contents of the session file as last read or written.
+
+        self.bedDevices = dict()  # bedId: set of IDs of the started SleepNumber Bed devices monitoring that bed.
+        self.bedDevicesLock = threading.Lock()
+
+        # Unchanged beds, sides and bases are the same snapshot objects from one poll to the next, so the states
+        # and properties each bed calls for are only worked out again when one of them changed.
+        self.bedStates = dict()  # bedId: (Bed, FoundationStatus, features, state list, properties) from the last update.
+        self.emptySide = SideStatus({})  # Stands in for a side of a bed nobody is assigned to.
+        self.emptySleeper = Sleeper({})
+
+        self.publishedStates = dict()  # Indigo device ID: {state key: value last sent to the server}
+        self.publishedStatesLock = threading.Lock()
+
+        self.propsUpdateInterval = 3600  # Minimum seconds between device property writes.
+        # Properties that decide which base actions work. Changes to these are written right away.
+        self.capabilityProps = {'base', 'baseConfigured', 'baseType', 'hasFootControl', 'hasFootWarming', 'hasMassageAndLight', 'hasUnderbedLight'}
+        self.propsWrittenAt = dict()  # Indigo device ID: time.time() the device's properties were last written.
+
+        # Polling schedule. Status is checked every pollInterval seconds, every fastPollInterval seconds while
+        # someone is getting in or out of bed, a base is moving or it's night time where a bed is, and less
+        # often (doubling each time) while the SleepIQ service is failing.
+        self.pollInterval = float(pluginPrefs.get('pollInterval', 30))
+        self.fastPollInterval = float(pluginPrefs.get('fastPollInterval', 10))
+        self.fastPollHold = 120  # Seconds to keep polling fast after bed activity was last seen.
+        self.maxPollBackoff = 600  # Longest wait between polls while the service is failing.
+        self.nightStartHour = 21  # Local hour (in the bed's time zone) when fast night polling starts.
+        self.nightEndHour = 9  # Local hour when fast night polling ends.
+        self.pollFailures = 0  # Number of polls in a row that have failed.
+        self.fastPollUntil = 0  # time.monotonic() until which polling stays fast.
+        self.bedActivity = dict()  # bedId: tuple of in-bed flags and base positions seen on the last poll.
+
+        # Status requests for a single bed share one fetch, and are answered from the last update if it's recent.
+        self.statusFreshness = 5  # Seconds a bed's last status update is good enough for a status request.
+        self.bedUpdated = dict()  # bedId: time.monotonic() the bed's status was last updated.
+        self.bedRefreshes = dict()  # bedId: Future for the bed's refresh in progress.
+        self.bedRefreshLock = threading.Lock()
+
+        # Bed commands from actions run on worker threads so the action callbacks return right away.
+        # Rapid-fire commands for the same setting within half a second are coalesced so only the last is sent.
+        self.commandDispatcher = CommandDispatcher(workers=4, onFinished=self.commandFinished, coalesceWindow=0.5)
+        self.coalescedCommands = dict()  # Indigo device ID: number of its commands replaced by newer ones.
+
+        # The states a command sets are published as soon as it's queued and marked pending, then read back from
+        # just that bed after verifyDelays seconds until they match (confirmed) or the last read (rolled back).
+        # Polls don't overwrite a pending state.
+        self.verifyDelays = (2, 5, 15)  # Seconds after a command succeeds to read back the bed's state.
+        self.verifyTolerance = 2  # Largest difference between an expected and actual value that still matches.
+        self.expectedStates = dict()  # Indigo device ID: {state key: Command whose expected value is pending}
+        self.expectedStatesLock = threading.Lock()
+
+        # After a base position or FlexFit preset command, the base of just that bed is read every
+        # motionPollInterval seconds until it gets there or stops moving, at most motionMaxRequests times.
+        self.motionPollInterval = 1.0
+        self.motionStallReads = 3  # Reads in a row without a change that mean the base stopped.
+        self.motionMaxRequests = 40
+        self.motionTrackers = dict()  # bedId: (MotionTracker, list of the Commands it's following)
+        self.motionLock = threading.Lock()
+        self.motionExecutor = ThreadPoolExecutor(max_workers=4)
+        self.motionTriggers = dict()  # Indigo trigger ID: "Base Finished Moving" trigger
+
+        # SleepIQ Service Diagnostics devices show the request metrics of each diagnosticsInterval.
+        self.diagnosticsDevices = set()  # IDs of the started SleepIQ Service Diagnostics devices.
+        self.diagnosticsInterval = 300  # Seconds between diagnostics device updates.
+        self.diagnosticsUpdated = time.monotonic()  # Time the diagnostics devices were last updated.
+
+        # Status updates can be profiled on request from the plugin menu. Nothing is profiled otherwise.
+        self.profileCycles = 0  # Number of status updates still to profile.
+        self.profiler = None  # cProfile.Profile collecting the profiled status updates.
+        self.profiledCycles = 0  # Number of status updates profiled so far.
+        self.profiledSeconds = 0  # Wall clock time of the status updates profiled so far.
 
         self.connection = None
 
@@ -51,10 +173,22 @@ class Plugin(indigo.PluginBase):
     def startup(self):
         self.logger.debug("startup called")
 
+        self.loadCapabilities()
+
         # Attempt to connect to the SleepIQ service.
         try:
-            self.connection = Sleepyq(self.username, self.password)
-            connected = self.connection.login()
+            self.connection = Sleepyq(self.username, self.password, pool_size=self.connectionPoolSize, api_url=self.apiUrl,
+                                      rate_limit=self.requestRate, rate_burst=self.requestBurst)
+            self.connection.breaker.listener = self.serviceStateChanged
+            # Renew the session key in the background every hour so polls and actions don't wait on a login.
+            self.connection.key_lifetime = 3600
+            if self.recordTraffic:
+                self.startRecording()
+            # Reuse the session key from the last run if there is one. It's replaced automatically if it was rejected.
+            if self.loadSession():
+                connected = True
+            else:
+                connected = self.connection.login()
             if not connected:
                 self.logger.error("Unable to connect to the SleepIQ service with the provided username and password.  \
                 Please verify the username and password settings in the SleepyBed IQ configuration.")
@@ -70,6 +204,26 @@ class Plugin(indigo.PluginBase):
     ########################################
     def shutdown(self):
         self.logger.debug("shutdown called")
+        self.baseFetchExecutor.shutdown(wait=False)
+        self.commandDispatcher.shutdown()
+        with self.motionLock:
+            for tracker, commands in self.motionTrackers.values():
+                tracker.cancel()
+        self.motionExecutor.shutdown(wait=False)
+        if self.connection:
+            self.connection.close()
+
+    # Start Triggers
+    ########################################
+    def triggerStartProcessing(self, trigger):
+        self.logger.debug(f"Starting trigger: {trigger.name}")
+        self.motionTriggers[trigger.id] = trigger
+
+    # Stop Triggers
+    ########################################
+    def triggerStopProcessing(self, trigger):
+        self.logger.debug(f"Stopping trigger: {trigger.name}")
+        self.motionTriggers.pop(trigger.id, None)
 
     # Start Devices
     ########################################
@@ -79,11 +233,36 @@ class Plugin(indigo.PluginBase):
         device.setErrorStateOnServer("")
         # Reload the device states list.
         device.stateListOrDisplayStateIdChanged()
+        # Forget previously published states so they are all sent again.
+        with self.publishedStatesLock:
+            self.publishedStates.pop(device.id, None)
+        # Add the device to the bed device index so status updates can find it.
+        if device.deviceTypeId == "sleepNumberBed":
+            with self.bedDevicesLock:
+                self.bedDevices.setdefault(device.pluginProps.get('bedId', ""), set()).add(device.id)
+        elif device.deviceTypeId == "apiDiagnostics":
+            self.diagnosticsDevices.add(device.id)
 
     # Stop Devices
     ########################################
     def deviceStopComm(self, device):
         self.logger.debug(f"Stopping device: {device.name}")
+        # Remove the device from the bed device index.
+        with self.bedDevicesLock:
+            for bedId in list(self.bedDevices):
+                self.bedDevices[bedId].discard(device.id)
+                if len(self.bedDevices[bedId]) == 0:
+                    del self.bedDevices[bedId]
+        self.diagnosticsDevices.discard(device.id)
+        with self.publishedStatesLock:
+            self.publishedStates.pop(device.id, None)
+
+    # Device Communication Property Changed
+    ########################################
+    def didDeviceCommPropertyChange(self, origDev, newDev):
+        # Only restart communication (and so re-index the device) when the monitored bed changes. The other
+        # properties are written by parseBedData and must not restart the device.
+        return origDev.pluginProps.get('bedId', "") != newDev.pluginProps.get('bedId', "")
 
     ########################################
     # Standard Plugin Methods
@@ -94,84 +273,193 @@ class Plugin(indigo.PluginBase):
     def runConcurrentThread(self):
         self.logger.debug("Starting runConcurrentThread.")
 
-        # Set a counter variable to control how often repeated error messages appear.
-        loopCount = 0
+        # Polls are scheduled at a fixed rate from this time so the API latency doesn't make the period drift.
+        nextPoll = time.monotonic()
+        # Remember when the saved errors were last cleared to control how often repeated error messages appear.
+        lastErrorReset = time.monotonic()
 
         try:
             while True:
+                if self.profileCycles:
+                    pollSucceeded = self.profilePollBeds()
+                else:
+                    pollSucceeded = self.pollBeds()
+                self.updateDiagnostics()
+
+                # Clear the saved errors every 10 minutes.
+                if time.monotonic() - lastErrorReset >= 600:
+                    self.logger.debug("runConcurrentThread: 10 minutes have passed. Resetting error conditions (if any).")
+                    lastErrorReset = time.monotonic()
+                    self.lastError = ""
+
+                connectionStats = self.connection.connection_stats()
+                self.logger.debug(f"runConcurrentThread: {connectionStats['requests']} requests sent, {connectionStats['reused']} on reused connections, \
+                {connectionStats['new']} on new connections, {connectionStats['warmed']} connections opened ahead of time.")
+
+                # Sleep until the next scheduled poll. If this poll overran the schedule, poll again right away
+                # rather than trying to catch up on the missed ones.
+                nextPoll += self.nextPollInterval(pollSucceeded)
+                now = time.monotonic()
+                if nextPoll < now:
+                    nextPoll = now
+                # Shortly before polling, reopen any connections the service closed while they were idle so the
+                # poll doesn't wait on new connections. Enough are opened for the account and base requests.
+                if nextPoll - now > self.connectionWarmLead:
+                    self.sleep(nextPoll - now - self.connectionWarmLead)
+                    self.connection.warm_connections(max(3, self.baseFetchWorkers))
+                    now = time.monotonic()
+                self.sleep(max(0, nextPoll - now))
+
+        # End while True continuous loop.
+        except self.StopThread:
+            pass  # Optionally catch the StopThread exception and do any needed cleanup.
+
+    # Poll Beds
+    ########################################
+    def pollBeds(self):
+        # Run one status update: get the beds and sleepers from the SleepIQ service and update the devices.
+        # Returns False if the beds couldn't be fetched.
+        pollSucceeded = True
 
-                # Populate the beds list, including sleeper status.
+        # Populate the beds list, including sleeper status.
+        try:
+            self.logger.debug("pollBeds: Updating beds and sleepers list.")
+            self.bedsList = self.connection.beds_with_sleeper_status()
+            for bed in self.bedsList:
+                self.bedUpdated[bed.bed_id] = time.monotonic()
+            self.sleepersList = [side.sleeper for bed in self.bedsList for side in (bed.left, bed.right) if side and side.sleeper]
+            self.sizeRequestBurst()
+            self.saveSession()
+            self.logger.debug("pollBeds: Account fetch timings (seconds): " + \
+                              ", ".join(f"{name}={seconds:.3f}" for name, seconds in self.connection.last_timings.items()))
+            if len(self.bedsList) == 0:
+                errorText = "There are no beds associated with this SleepIQ account. This plugin only works with beds that are registered with the SleepIQ service."
+                # Only display the error if it wasn't recently shown.
+                if self.lastError != errorText:
+                    self.lastError = errorText
+                    self.logger.error(errorText)
+        except Exception as e:
+            pollSucceeded = False
+            # Detect authentication/session login errors.
+            if str(e).startswith("401 Client Error"):
+                # Attempt to re-connect to the SleepIQ service.
                 try:
-                    self.logger.debug("runConcurrentThread: Updating beds and sleepers list.")
-                    self.bedsList = self.connection.beds_with_sleeper_status()
-                    if len(self.bedsList) == 0:
-                        errorText = "There are no beds associated with this SleepIQ account. This plugin only works with beds that are registered with the SleepIQ service."
+                    connected = self.connection.login()
+                    if not connected:
+                        errorText = u"Unable to connect to the SleepIQ service with the provided username and password.  \
+                        Please verify the username and password settings in the SleepyBed IQ configuration."
                         # Only display the error if it wasn't recently shown.
                         if self.lastError != errorText:
                             self.lastError = errorText
-                            self.logger.error(errorerrorText)
+                            self.logger.error(errorText)
+                    # End if last error is not the same as this error.
+                # End if not connected.
                 except Exception as e:
-                    # Detect authentication/session login errors.
+                    # If we still get an authentication error, let the user know.
                     if str(e).startswith("401 Client Error"):
-                        # Attempt to re-connect to the SleepIQ service.
-                        try:
-                            connected = self.connection.login()
-                            if not connected:
-                                errorText = u"Unable to connect to the SleepIQ service with the provided username and password.  \
-                                Please verify the username and password settings in the SleepyBed IQ configuration."
-                                # Only display the error if it wasn't recently shown.
-                                if self.lastError != errorText:
-                                    self.lastError = errorText
-                                    self.logger.error(errorText)
-                            # End if last error is not the same as this error.
-                        # End if not connected.
-                        except Exception as e:
-                            # If we still get an authentication error, let the user know.
-                            if str(e).startswith("401 Client Error"):
-                                errorText = "Unable to connect to the SleepIQ service with the provided username and password.  \
-                                Please verify the username and password settings in the SleepyBed IQ configuration."
-                                # Only display the error if it wasn't recently shown.
-                                if self.lastError != errorText:
-                                    self.lastError = errorText
-                                    self.logger.error(errorText)
-                            # End if last error is not the same as this error.
-                            else:
-                                errorText = f"Unable to connect to the SleepIQ service. Error: {e}"
-                                # Only display the error if it wasn't recently shown.
-                                if self.lastError != errorText:
-                                    self.lastError = errorText
-                                    self.logger.error(errorText)
-                            # End if last error is not the same as this error.
-                        # End if this was a client authentication error.
-                    # End try to connect.
+                        errorText = "Unable to connect to the SleepIQ service with the provided username and password.  \
+                        Please verify the username and password settings in the SleepyBed IQ configuration."
+                        # Only display the error if it wasn't recently shown.
+                        if self.lastError != errorText:
+                            self.lastError = errorText
+                            self.logger.error(errorText)
+                    # End if last error is not the same as this error.
                     else:
-                        errorText = f"Unable to load the list of beds associated with this SleepIQ account. Error: {e}"
+                        errorText = f"Unable to connect to the SleepIQ service. Error: {e}"
                         # Only display the error if it wasn't recently shown.
                         if self.lastError != errorText:
                             self.lastError = errorText
                             self.logger.error(errorText)
-                    # End if the last error is no the same as this error.
-                # End if the original bed refresh resulted in a client auth error.
-                # End try to refresh bed and sleeper status.
-
-                # Parse the Bed data.
-                self.parseBedData()
+                    # End if last error is not the same as this error.
+                # End if this was a client authentication error.
+            # End try to connect.
+            else:
+                errorText = f"Unable to load the list of beds associated with this SleepIQ account. Error: {e}"
+                # Only display the error if it wasn't recently shown.
+                if self.lastError != errorText:
+                    self.lastError = errorText
+                    self.logger.error(errorText)
+            # End if the last error is no the same as this error.
+        # End if the original bed refresh resulted in a client auth error.
+        # End try to refresh bed and sleeper status.
 
-                # Increment the loop counter.
-                loopCount += 1
+        # Parse the Bed data.
+        self.parseBedData()
 
-                # Reset the loop counter every 19 loops (10 minutes) and clear the saved errors.
-                if loopCount > 19:
-                    self.logger.debug("runConcurrentThread: 10 minutes have passed. Resetting error conditions (if any).")
-                    loopCount = 0
-                    self.lastError = ""
+        return pollSucceeded
 
-                # Sleep for 30 seconds before looping again.
-                self.sleep(30)
+    # Size the Request Burst
+    ########################################
+    def sizeRequestBurst(self):
+        # A status update makes 3 account requests plus, for each bed with a base, a status request and (when
+        # its capabilities are refreshed) a features request. Allow all of them at once.
+        rateLimiter = self.connection.rate_limiter
+        if rateLimiter is None:
+            return
+        burst = max(self.requestBurst, 3 + 2 * sum(1 for bed in self.bedsList if bed.base))
+        if burst != rateLimiter.burst:
+            self.logger.debug(f"sizeRequestBurst: Allowing {burst} SleepIQ requests at once.")
+            rateLimiter.configure(burst=burst)
+
+    # Start Recording SleepIQ Traffic
+    ########################################
+    def startRecording(self):
+        fileName = os.path.join(indigo.server.getLogsFolderPath(pluginId=self.pluginId), "sleepiq-traffic.jsonl")
+        try:
+            self.connection.start_recording(fileName, max_bytes=self.recordingMaxBytes, backup_count=self.recordingBackups)
+            indigo.server.log(f"Recording SleepIQ service traffic to {fileName}")
+        except Exception as e:
+            self.logger.error(f"Unable to record SleepIQ service traffic to {fileName}. Error: {e}")
 
-        # End while True continuous loop.
-        except self.StopThread:
-            pass  # Optionally catch the StopThread exception and do any needed cleanup.
+    # Profile a Status Update
+    ########################################
+    def profilePollBeds(self):
+        # Run pollBeds under the profiler, and save the statistics after the last requested status update. Only
+        # this thread is profiled; time spent waiting for the fetch worker threads shows up in wait() calls.
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiledCycles = 0
+            self.profiledSeconds = 0
+        start = time.monotonic()
+        self.profiler.enable()
+        try:
+            return self.pollBeds()
+        finally:
+            self.profiler.disable()
+            self.profiledSeconds += time.monotonic() - start
+            self.profiledCycles += 1
+            self.profileCycles -= 1
+            if self.profileCycles <= 0:
+                self.profileCycles = 0
+                self.saveProfile()
+
+    # Save Profile Statistics
+    ########################################
+    def saveProfile(self):
+        profiler, self.profiler = self.profiler, None
+        fileName = os.path.join(indigo.server.getLogsFolderPath(pluginId=self.pluginId),
+                                f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+        try:
+            profiler.dump_stats(fileName + ".pstats")
+            with open(fileName + ".txt", "w") as reportFile:
+                stats = pstats.Stats(profiler, stream=reportFile)
+                stats.sort_stats('cumulative').print_stats(50)
+                stats.sort_stats('tottime').print_stats(50)
+            savedText = f" Statistics saved to {fileName}.pstats and {fileName}.txt."
+        except Exception as e:
+            self.logger.error(f"Unable to save the profile statistics. Error: {e}")
+            savedText = ""
+
+        # Log the functions that took the most time themselves.
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('tottime').print_stats(10)
+        lines = [line for line in report.getvalue().splitlines() if line.strip()]
+        start = next((index for index, line in enumerate(lines) if line.strip().startswith("ncalls")), len(lines))
+        self.logger.info(f"Profiled {self.profiledCycles} status update(s) taking {self.profiledSeconds:.2f} seconds "
+                         f"({self.profiledSeconds / max(1, self.profiledCycles):.2f} seconds each).{savedText} "
+                         f"Functions taking the most time:")
+        for line in lines[start:]:
+            self.logger.info(f"  {line}")
 
     ########################################
     # Standard Plugin Callback Methods
@@ -209,7 +497,7 @@ class Plugin(indigo.PluginBase):
         # Set up a local Sleepyq object with the passed username and password for account validation.
         username = valuesDict.get('username', "")
         password = valuesDict.get('password', "")
-        connection = Sleepyq(username, password)
+        connection = Sleepyq(username, password, api_url=valuesDict.get('apiUrl', "").strip() or API_URL)
 
         # Validate the username field.
         if valuesDict.get('username', "") == "":
@@ -254,6 +542,27 @@ class Plugin(indigo.PluginBase):
                 errorsDict['password'] = "The password is not valid. Please enter a valid password."
                 errorsDict['showAlertText'] += errorsDict['password'] + "\n\n"
 
+        # Validate the update settings.
+        for key, name, minimum in (('pollInterval', "Update Interval", 5), ('fastPollInterval', "Active Update Interval", 5),
+                                   ('baseFetchWorkers', "Simultaneous Base Requests", 1), ('baseFetchDeadline', "Base Request Time Limit", 1),
+                                   ('capabilityRefreshHours', "Base Features Refresh", 1), ('connectionPoolSize', "Connection Pool Size", 1),
+                                   ('requestRate', "Request Rate", 1), ('requestBurst', "Request Burst", 1)):
+            try:
+                if float(valuesDict.get(key, minimum)) < minimum:
+                    raise ValueError
+            except ValueError:
+                isError = True
+                errorsDict[key] = f"The '{name}' must be a number of at least {minimum}."
+                errorsDict['showAlertText'] += errorsDict[key] + "\n\n"
+        for key, name in (('baseFetchWorkers', "Simultaneous Base Requests"), ('connectionPoolSize', "Connection Pool Size"),
+                          ('requestBurst', "Request Burst")):
+            try:
+                int(valuesDict.get(key, 1))
+            except ValueError:
+                isError = True
+                errorsDict[key] = f"The '{name}' must be a whole number."
+                errorsDict['showAlertText'] += errorsDict[key] + "\n\n"
+
         # Attempt to connect to the SleepIQ service and verify the username and password are correct.
         try:
             connected = connection.login()
@@ -285,6 +594,39 @@ class Plugin(indigo.PluginBase):
         else:
             return True, valuesDict
 
+    # Preferences Dialog Closed
+    ########################################
+    def closedPrefsConfigUi(self, valuesDict, userCancelled):
+        self.logger.debug(f"closedPrefsConfigUi called: userCancelled: {userCancelled}")
+        if userCancelled:
+            return
+
+        # Apply the base fetching settings without requiring a plugin restart.
+        baseFetchWorkers = int(valuesDict.get('baseFetchWorkers', 4))
+        self.baseFetchDeadline = float(valuesDict.get('baseFetchDeadline', 10))
+        self.capabilityRefreshHours = float(valuesDict.get('capabilityRefreshHours', 24))
+        self.pollInterval = float(valuesDict.get('pollInterval', 30))
+        self.fastPollInterval = float(valuesDict.get('fastPollInterval', 10))
+        self.requestRate = float(valuesDict.get('requestRate', 5))
+        self.requestBurst = int(valuesDict.get('requestBurst', 10))
+        if self.connection and self.connection.rate_limiter is not None:
+            self.connection.rate_limiter.configure(rate=self.requestRate)
+            self.sizeRequestBurst()
+        recordTraffic = bool(valuesDict.get('recordTraffic', False))
+        if recordTraffic != self.recordTraffic:
+            self.recordTraffic = recordTraffic
+            if self.connection:
+                if recordTraffic:
+                    self.startRecording()
+                else:
+                    self.connection.stop_recording()
+                    indigo.server.log("Stopped recording SleepIQ service traffic")
+        if baseFetchWorkers != self.baseFetchWorkers:
+            self.baseFetchWorkers = baseFetchWorkers
+            oldExecutor = self.baseFetchExecutor
+            self.baseFetchExecutor = ThreadPoolExecutor(max_workers=self.baseFetchWorkers)
+            oldExecutor.shutdown(wait=False)
+
     # Sensor Action callback
     ########################################
     def actionControlSensor(self, action, device):
@@ -305,27 +647,16 @@ class Plugin(indigo.PluginBase):
             if action.sensorAction == indigo.kSensorAction.RequestStatus:
                 # Query hardware module (device) for its current status here:
                 indigo.server.log(u"sent \"%s\" %s" % (device.name, "status request"))
-                # There's no method for updating just one bed status with the SleepyQ library, so
-                # we'll just populate the beds list, including sleeper status then parse everything.
+                # Update just this bed.
                 try:
-                    self.bedsList = self.connection.beds_with_sleeper_status()
-                    if len(self.bedsList) == 0:
-                        errorText = "There are no beds associated with this SleepIQ account. This plugin only works with beds that are registered with the SleepIQ service."
-                        # Only display the error if it wasn't recently shown.
-                        if self.lastError != errorText:
-                            elf.lastError = errorText
-                            self.logger.error(errorText)
-                        return False
+                    self.refreshBed(bedId)
                 except Exception as e:
-                    errorText = f"Unable to load the list of beds associated with this SleepIQ account. Error: {e}"
+                    errorText = f"Unable to update the status of the '{device.name}' bed. Error: {e}"
                     # Only display the error if it wasn't recently shown.
                     if self.lastError != errorText:
-                        elf.lastError = errorText
+                        self.lastError = errorText
                         self.logger.error(errorText)
                     return False
-
-                # Parse the Bed data.
-                self.parseBedData()
         # End if/else sensor action checking.
 
     # End if this is a sensor device.
@@ -345,6 +676,52 @@ class Plugin(indigo.PluginBase):
             self.pluginPrefs['showDebugInfo'] = True
         self.debug = not self.debug
 
+    # Refresh Bed Capabilities Menu Action
+    ########################################
+    def refreshCapabilities(self):
+        # Forget the cached base capabilities so they are downloaded again during the next status update.
+        indigo.server.log("Bed base capabilities will be refreshed during the next status update")
+        with self.capabilitiesLock:
+            self.capabilities = dict()
+        self.saveCapabilities()
+
+    # Profile Status Updates Menu Action
+    ########################################
+    def profilePollCycles(self, valuesDict, typeId):
+        # Profile the next few status updates, then save the statistics to the plugin's log folder.
+        errorsDict = indigo.Dict()
+        try:
+            cycles = int(valuesDict.get('cycles', 5))
+            if cycles < 1 or cycles > 100:
+                raise ValueError
+        except ValueError:
+            errorsDict['cycles'] = "Enter a whole number of status updates from 1 to 100."
+            errorsDict['showAlertText'] = errorsDict['cycles']
+            return False, valuesDict, errorsDict
+
+        self.profileCycles = cycles
+        indigo.server.log(f"Profiling the next {cycles} status update(s)")
+        return True
+
+    # Show SleepIQ Service Statistics Menu Action
+    ########################################
+    def showApiMetrics(self):
+        # Log the request metrics of each SleepIQ endpoint since the plugin started.
+        if not self.connection:
+            self.logger.info("Not connected to the SleepIQ service yet.")
+            return
+        endpoints = self.connection.metrics.snapshot()
+        summary = self.connection.metrics.summary()
+        self.logger.info(f"SleepIQ service statistics since the plugin started (service {self.serviceStateName()}):")
+        for endpoint, metrics in sorted(endpoints.items()) + [("All endpoints", summary)]:
+            statuses = ", ".join(f"{status}: {count}" for status, count in sorted(metrics['statuses'].items()))
+            latency = "no responses" if metrics['latency_p50'] is None else \
+                f"p50 {metrics['latency_p50'] * 1000:.0f} ms, p90 {metrics['latency_p90'] * 1000:.0f} ms, " \
+                f"p99 {metrics['latency_p99'] * 1000:.0f} ms, max {metrics['latency_max'] * 1000:.0f} ms"
+            self.logger.info(f"  {endpoint}: {metrics['calls']} calls, {metrics['requests']} requests, {metrics['retries']} retries, "
+                             f"{metrics['timeouts']} timeouts, {metrics['connection_errors']} connection errors, "
+                             f"{metrics['rejected']} not sent. Status codes: {statuses or 'none'}. Latency: {latency}.")
+
     # Test Login (plugin prefs config UI)
     ########################################
     def testLogin(self, valuesDict):
@@ -375,7 +752,7 @@ class Plugin(indigo.PluginBase):
 
         # Attempt to connect to the SleepIQ service.
         try:
-            connection = Sleepyq(username, password)
+            connection = Sleepyq(username, password, api_url=valuesDict.get('apiUrl', "").strip() or API_URL)
             connected = connection.login()
         except Exception as e:
             isError = True
@@ -413,157 +790,836 @@ class Plugin(indigo.PluginBase):
 
         returnBedList = list()
 
-        # Iterate through beds, and return the available list in Indigo's format
-        for bed in self.bedsList:
-            bedId = bed.data.get('bedId', "")
-            bedName = bed.data.get('name', "")
-            returnBedList.append([bedId, bedName])
+        # Iterate through beds, and return the available list in Indigo's format. Until the first status
+        # update finishes, use the bed catalog saved from the last time the plugin ran.
+        for bed in self.bedsList or self.bedCatalog:
+            returnBedList.append([bed.bed_id, bed.name])
 
         self.logger.debug(f"bedListGenerator: Return bed list is {returnBedList}")
         return returnBedList
 
+    # Generate Device List for Triggers
+    ########################################
+    def deviceListGenerator(self, filter="", valuesDict=None, typeId="", targetId=0):
+        # Generate an Indigo UI list of this plugin's SleepNumber Bed devices, with an "any" choice first.
+        returnDeviceList = [["0", "- any bed -"]]
+        for device in indigo.devices.iter("self.sleepNumberBed"):
+            returnDeviceList.append([str(device.id), device.name])
+        return returnDeviceList
+
     ########################################
     # Plugin Specific Operational Methods
     ########################################
 
-    # Parse Bed Object Data and Update Device Status
+    # Load Cached Bed Capabilities
     ########################################
-    def parseBedData(self):
-        # Go through the bedsList list, find associated Indigo devices and update them.
-        self.logger.debug(u"parseBedData called.")
+    def loadCapabilities(self):
+        try:
+            with open(self.capabilitiesFile, "r") as capabilitiesFile:
+                capabilities = json.load(capabilitiesFile)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            self.logger.warning(f"Unable to read the cached bed base capabilities. They will be downloaded again. Error: {e}")
+            return
+        with self.capabilitiesLock:
+            self.capabilities = capabilities
+        self.logger.debug(f"loadCapabilities: Loaded cached capabilities for {len(capabilities)} bed(s).")
 
-        if len(self.bedsList) > 0:
-            for bed in self.bedsList:
+    # Save Cached Bed Capabilities
+    ########################################
+    def saveCapabilities(self):
+        # Only one thread writes the file at a time, so the newest capabilities are always the ones left on disk.
+        with self.capabilitiesSaveLock:
+            with self.capabilitiesLock:
+                capabilities = dict(self.capabilities)
+                self.capabilitiesDirty = False
+            # Write to a temporary file first so a crash can't leave a partial cache behind.
+            tempFile = f"{self.capabilitiesFile}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                os.makedirs(self.dataFolder, exist_ok=True)
+                with open(tempFile, "w") as capabilitiesFile:
+                    json.dump(capabilities, capabilitiesFile)
+                os.replace(tempFile, self.capabilitiesFile)
+            except Exception as e:
+                self.logger.warning(f"Unable to save the cached bed base capabilities. Error: {e}")
+                # Try again after the next status update.
+                with self.capabilitiesLock:
+                    self.capabilitiesDirty = True
+                try:
+                    os.remove(tempFile)
+                except OSError:
+                    pass
 
-                # We'll be using the following local variables...
-                bedData = bed.data  # Dict containing data for the Bed object.
-                bedBaseData = dict()  # Dict containing data for the base of the bed.
-                bedBaseFeatureData = dict()  # Dict containing more data for the base of the bed.
-                rightSideData = dict()  # Dict containing data for the right side SideStatus object.
-                rightSleeperData = dict()  # Dict containing data for the right side Sleeper object.
-                leftSideData = dict()  # Dict containing data for the left side SideStatus object.
-                leftSleeperData = dict()  # Dict containing data for the left side Sleeper object.
-                device = None  # Single Indigo device object from this plugin.
-                keyValueList = []  # List of key:value tuples to be used to update device states.
-                pluginProps = None  # Local writable copy of an Indigo device's properties.
-                anyoneInBed = False  # Boolean of whether anyone is in bed or not.
-                everyoneInBed = False  # Boolean of whether everyone is in bed.
-
-                if bedData.get('base', None):
-                    try:
-                        bedBaseData = self.connection.foundation_status(bedId=bedData.get('bedId')).data
-                    except Exception as e:
-                        errorText = f"Unable to obtain status information for the base of the '{bedData.get('name', '(unnamed)')}' bed. \
-                        This may be temporary. Check the bed's network connection and this server connection if the error continues. The error was: {e}"
-                        # Only display the error if it wasn't recently shown.
-                        if self.lastError != errorText:
-                            self.lastError = errorText
-                            self.logger.error(errorText)
-                    try:
-                        bedBaseFeatureData = self.connection.foundation_features(bedId=bedData.get('bedId')).data
-                    except Exception as e:
-                        errorText = f"Unable to obtain features list information for the base of the '{bedData.get('name', '(unnamed)')}' bed. \
-                        This may be temporary. Check the bed's network connection and this server connection if the error continues. The error was: {e}"
+    # Update Cached Capabilities for One Bed
+    ########################################
+    def setCapabilities(self, bed, features):
+        # features is the foundation features dict, or None if the bed's base endpoints don't exist (HTTP 404).
+        # Runs on the base fetch worker threads, so the file is saved once all the beds were fetched.
+        with self.capabilitiesLock:
+            self.capabilities[bed.bed_id] = {'base': bed.base, 'updated': time.time(), 'features': features}
+            self.capabilitiesDirty = True
+
+    # Load Saved SleepIQ Session
+    ########################################
+    def loadSession(self):
+        # Give the connection the session key and the bed and sleeper catalog saved by the last run. Returns
+        # True if a session key for the current account was found.
+        try:
+            with open(self.sessionFile, "r") as sessionFile:
+                session = json.load(sessionFile)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            self.logger.warning(f"Unable to read the saved SleepIQ session. Error: {e}")
+            return False
+        # Only reuse a session saved for the account currently configured.
+        if session.get('account') != self.accountHash():
+            return False
 
-                        # Only display the error if it wasn't recently shown.
-                        if self.lastError != errorText:
-                            self.lastError = errorText
-                            self.logger.error(errorText)
+        self.savedSession = session
+        self.bedCatalog = [Bed(bedData) for bedData in session.get('beds', [])]
+        self.sleepersList = [Sleeper(sleeperData) for sleeperData in session.get('sleepers', [])]
+        self.connection.seed_bed_cache(self.bedCatalog)
+        if not session.get('key'):
+            return False
+        self.connection.use_session_key(session['key'], max(0, time.time() - session.get('loginTime', 0)))
+        self.logger.debug(f"loadSession: Reusing the saved SleepIQ session and {len(self.bedCatalog)} bed(s).")
+        return True
+
+    # Save SleepIQ Session
+    ########################################
+    def saveSession(self):
+        # Save the session key and bed and sleeper catalog if they changed. The file is only readable by the
+        # user Indigo runs as, and is tied to the configured account so a different account can't use it.
+        key = self.connection.session_key()
+        keyAge = self.connection.key_age()
+        session = {
+            'account': self.accountHash(),
+            'key': key,
+            'loginTime': self.savedSession.get('loginTime', 0) if key == self.savedSession.get('key') else time.time() - (keyAge or 0),
+            'beds': [bed.data for bed in self.bedsList],
+            'sleepers': [sleeper.data for sleeper in self.sleepersList]
+        }
+        if session == self.savedSession:
+            return
+        try:
+            os.makedirs(self.dataFolder, exist_ok=True)
+            fileDescriptor = os.open(self.sessionFile + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fileDescriptor, "w") as sessionFile:
+                json.dump(session, sessionFile)
+            os.replace(self.sessionFile + ".tmp", self.sessionFile)
+            self.savedSession = session
+        except Exception as e:
+            self.logger.warning(f"Unable to save the SleepIQ session. Error: {e}")
+
+    # Account Hash
+    ########################################
+    def accountHash(self):
+        # Identifies the configured SleepIQ account in the session file without storing the username.
+        return hashlib.sha256(self.username.strip().lower().encode("utf-8")).hexdigest()
+
+    # Record a Bed Without Base Endpoints
+    ########################################
+    def setNoBaseCapabilities(self, bed):
+        with self.capabilitiesLock:
+            capabilities = self.capabilities.get(bed.bed_id, None)
+            alreadyKnown = capabilities is not None and capabilities.get('base') == bed.base and capabilities.get('features') is None
+        # Only log it the first time, not every time the base is checked again.
+        if not alreadyKnown:
+            self.logger.info(f"The base of the '{bed.name or '(unnamed)'}' bed doesn't provide status information. \
+            It will be checked again in {self.noBaseRecheckHours:g} hour(s), or when the bed capabilities are refreshed from the plugin menu.")
+        self.setCapabilities(bed, None)
+
+    # Check for an HTTP 404 Error
+    ########################################
+    def isNotFoundError(self, e):
+        return isinstance(e, requests.exceptions.HTTPError) and e.response is not None and e.response.status_code == 404
+
+    # Choose the Time Until the Next Poll
+    ########################################
+    def nextPollInterval(self, pollSucceeded):
+        if pollSucceeded:
+            self.pollFailures = 0
+        else:
+            # Back off exponentially while the SleepIQ service is failing.
+            self.pollFailures += 1
+            interval = min(self.pollInterval * 2 ** self.pollFailures, self.maxPollBackoff)
+            # Don't poll again before the SleepIQ connection is willing to try the service again.
+            interval = max(interval, self.connection.breaker.retry_after())
+            self.logger.debug(f"nextPollInterval: {self.pollFailures} failed poll(s) in a row. Next poll in {interval} seconds.")
+            return interval
+
+        if time.monotonic() < self.fastPollUntil or self.isNightTime():
+            return min(self.fastPollInterval, self.pollInterval)
+        return self.pollInterval
+
+    # SleepIQ Service State Changed
+    ########################################
+    def serviceStateChanged(self, oldState, newState):
+        # Called by the Sleepyq circuit breaker when the SleepIQ service stops or starts responding.
+        if newState == "open":
+            self.logger.warning(f"The SleepIQ service is not responding. Requests to it are paused for \
+            {self.connection.breaker.reset_timeout} seconds at a time until it responds again.")
+        elif newState == "closed":
+            self.logger.info("The SleepIQ service is responding again.")
+        else:
+            self.logger.debug(f"serviceStateChanged: SleepIQ service state changed from {oldState} to {newState}.")
 
-                rightSideData = bed.right.data
-                rightSleeperData = bed.right.sleeper.data
-                leftSideData = bed.left.data
-                leftSleeperData = bed.left.sleeper.data
+    # SleepIQ Service State Name
+    ########################################
+    def serviceStateName(self):
+        return {"closed": "up", "open": "down", "half-open": "recovering"}.get(self.connection.breaker.state, "unknown")
+
+    # Update Diagnostics Devices
+    ########################################
+    def updateDiagnostics(self):
+        # Every diagnosticsInterval seconds, publish the SleepIQ request metrics since the last update to the
+        # SleepIQ Service Diagnostics devices so API health can be charted over time.
+        elapsed = time.monotonic() - self.diagnosticsUpdated
+        if elapsed < self.diagnosticsInterval:
+            return
+        self.diagnosticsUpdated = time.monotonic()
+        endpoints, summary = self.connection.metrics.take_window()
+        if len(self.diagnosticsDevices) == 0:
+            return
+
+        slowestEndpoint, slowestLatency = "", 0
+        for endpoint, metrics in endpoints.items():
+            if (metrics['latency_p90'] or 0) > slowestLatency:
+                slowestEndpoint, slowestLatency = endpoint, metrics['latency_p90']
+        errorRate = round(100 * summary['errors'] / summary['requests'], 1) if summary['requests'] else 0
+        keyValueList = [
+            {'key': 'serviceState', 'value': self.serviceStateName()},
+            {'key': 'requests', 'value': summary['requests']},
+            {'key': 'errors', 'value': summary['errors']},
+            {'key': 'errorRate', 'value': errorRate, 'uiValue': f"{errorRate}%"},
+            {'key': 'retries', 'value': summary['retries']},
+            {'key': 'timeouts', 'value': summary['timeouts']},
+            {'key': 'notSent', 'value': summary['rejected']},
+            {'key': 'latencyP50', 'value': round((summary['latency_p50'] or 0) * 1000)},
+            {'key': 'latencyP90', 'value': round((summary['latency_p90'] or 0) * 1000)},
+            {'key': 'latencyP99', 'value': round((summary['latency_p99'] or 0) * 1000)},
+            {'key': 'slowestEndpoint', 'value': slowestEndpoint},
+            {'key': 'slowestEndpointP90', 'value': round(slowestLatency * 1000)},
+            {'key': 'intervalSeconds', 'value': round(elapsed)}
+        ]
+        for deviceId in list(self.diagnosticsDevices):
+            try:
+                device = indigo.devices[deviceId]
+            except KeyError:
+                continue
+            self.publishStates(device, keyValueList)
 
-                for device in indigo.devices.iter("self"):
+    # Check if it's Night Time for Any Bed
+    ########################################
+    def isNightTime(self):
+        # True if the local time in any bed's time zone is between nightStartHour and nightEndHour.
+        for bed in self.bedsList:
+            try:
+                hour = datetime.now(ZoneInfo(bed.timezone)).hour
+            except Exception:
+                continue
+            if hour >= self.nightStartHour or hour < self.nightEndHour:
+                return True
+        return False
+
+    # Note Bed Activity
+    ########################################
+    def noteBedActivity(self, bedId, leftSide, rightSide, base):
+        # Poll faster for a while when someone gets in or out of bed or a base position changes.
+        previousActivity = self.bedActivity.get(bedId, None)
+        activity = (leftSide.is_in_bed, rightSide.is_in_bed)
+        if base is not None:
+            activity += (base.left_head_position, base.left_foot_position, base.right_head_position, base.right_foot_position)
+        elif previousActivity is not None:
+            # Keep the last known positions if the base couldn't be reached this cycle.
+            activity += previousActivity[2:]
+
+        if previousActivity is not None and previousActivity != activity:
+            self.logger.debug(f"noteBedActivity: Activity detected on bed {bedId}. Polling every {self.fastPollInterval} seconds.")
+            self.fastPollUntil = time.monotonic() + self.fastPollHold
+        self.bedActivity[bedId] = activity
+
+    # Fetch Base Data for One Bed
+    ########################################
+    def fetchBedBaseData(self, bed):
+        # Get the foundation status (a FoundationStatus, None if unavailable) and features dict (None if
+        # unavailable) for the base of a single bed. Runs on a base fetch worker thread.
+        bedBase = None  # FoundationStatus of the base of the bed.
+        bedBaseFeatureData = None  # Dict containing more data for the base of the bed.
+
+        with self.capabilitiesLock:
+            capabilities = self.capabilities.get(bed.bed_id)
+        # Forget the cached capabilities if the base was replaced.
+        if capabilities and capabilities.get('base') != bed.base:
+            capabilities = None
+        # Beds whose base endpoints returned 404 aren't asked again for noBaseRecheckHours, or until the
+        # capabilities are refreshed.
+        if capabilities and capabilities.get('features') is None:
+            if time.time() - capabilities.get('updated', 0) < self.noBaseRecheckHours * 3600:
+                return bedBase, bedBaseFeatureData
+            capabilities = None
+
+        try:
+            bedBase = self.connection.foundation_status(bedId=bed.bed_id)
+        except Exception as e:
+            if self.isNotFoundError(e):
+                self.setNoBaseCapabilities(bed)
+                return bedBase, bedBaseFeatureData
+            errorText = f"Unable to obtain status information for the base of the '{bed.name or '(unnamed)'}' bed. \
+            This may be temporary. Check the bed's network connection and this server connection if the error continues. The error was: {e}"
+            # Only display the error if it wasn't recently shown.
+            if self.lastError != errorText:
+                self.lastError = errorText
+                self.logger.error(errorText)
+
+        # Use the cached features unless they're older than the refresh interval. A base that didn't list its
+        # features is asked again as soon as one without a base API would be.
+        if capabilities:
+            refreshHours = self.capabilityRefreshHours if capabilities['features'] else self.noBaseRecheckHours
+            if time.time() - capabilities.get('updated', 0) < refreshHours * 3600:
+                return bedBase, capabilities['features']
+
+        try:
+            bedBaseFeatureData = self.connection.foundation_features(bedId=bed.bed_id).data
+            self.setCapabilities(bed, bedBaseFeatureData)
+        except Exception as e:
+            if self.isNotFoundError(e):
+                # The base status still counts, there are just no features to show.
+                self.setCapabilities(bed, dict())
+                return bedBase, dict()
+            errorText = f"Unable to obtain features list information for the base of the '{bed.name or '(unnamed)'}' bed. \
+            This may be temporary. Check the bed's network connection and this server connection if the error continues. The error was: {e}"
+
+            # Only display the error if it wasn't recently shown.
+            if self.lastError != errorText:
+                self.lastError = errorText
+                self.logger.error(errorText)
+            # Fall back to the expired features until they can be downloaded again.
+            if capabilities:
+                bedBaseFeatureData = capabilities['features']
+
+        return bedBase, bedBaseFeatureData
+
+    # Refresh One Bed
+    ########################################
+    def refreshBed(self, bedId):
+        # Update the status of a single bed and its devices. Requests that arrive while a refresh of the same
+        # bed is running wait for it and share its result, and requests within statusFreshness seconds of the
+        # last update are answered by that update.
+        with self.bedRefreshLock:
+            if time.monotonic() - self.bedUpdated.get(bedId, 0) < self.statusFreshness:
+                self.logger.debug(f"refreshBed: Bed {bedId} was updated less than {self.statusFreshness} seconds ago.")
+                return
+            future = self.bedRefreshes.get(bedId, None)
+            isLeader = future is None
+            if isLeader:
+                future = self.bedRefreshes[bedId] = Future()
+
+        if not isLeader:
+            self.logger.debug(f"refreshBed: Waiting for the refresh of bed {bedId} already in progress.")
+            future.result()
+            return
+
+        try:
+            bed = self.connection.bed_with_sleeper_status(bedId)
+            # Replace the bed in the beds list so everything else sees the new status too.
+            self.bedsList = [bed if listBed.bed_id == bedId else listBed for listBed in self.bedsList]
+            self.parseBedData([bed])
+            self.bedUpdated[bedId] = time.monotonic()
+            future.set_result(bed)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.bedRefreshLock:
+                del self.bedRefreshes[bedId]
+
+    # Fetch Base Data for All Beds
+    ########################################
+    def fetchBaseData(self, beds):
+        # Fetch the base data of every bed that has a base at the same time. At most baseFetchWorkers requests
+        # are in flight, and beds that haven't answered within baseFetchDeadline seconds are skipped this cycle
+        # so one slow bed can't hold up the updates for the others. A bed whose fetch is still running from an
+        # earlier cycle isn't fetched again; this cycle waits for that fetch instead, so slow beds can't fill
+        # the workers with fetches for the same bed.
+        baseDataByBedId = dict()  # bedId: (FoundationStatus, features dict)
+        futures = dict()  # Future: Bed object
+
+        with self.baseFetchesLock:
+            for bed in beds:
+                if bed.base:
+                    future = self.baseFetches.get(bed.bed_id, None)
+                    if future is None or future.done():
+                        future = self.baseFetches[bed.bed_id] = self.baseFetchExecutor.submit(self.fetchBedBaseData, bed)
+                    else:
+                        self.logger.debug(f"fetchBaseData: Base fetch for bed {bed.bed_id} still running from an earlier cycle.")
+                    futures[future] = bed
+
+        if len(futures) == 0:
+            return baseDataByBedId
+
+        done, notDone = wait(futures, timeout=self.baseFetchDeadline)
+        for future in done:
+            baseDataByBedId[futures[future].bed_id] = future.result()
+        for future in notDone:
+            # Drop the fetch if it hasn't started yet. One already running is left to finish.
+            future.cancel()
+            errorText = f"Timed out after {self.baseFetchDeadline} seconds waiting for base information for the \
+            '{futures[future].name or '(unnamed)'}' bed. The base states for this bed will be updated next time."
+            # Only display the error if it wasn't recently shown.
+            if self.lastError != errorText:
+                self.lastError = errorText
+                self.logger.error(errorText)
+
+        return baseDataByBedId
+
+    # Parse Bed Object Data and Update Device Status
+    ########################################
+    def parseBedData(self, beds=None):
+        # Go through the bedsList list (or just the beds passed), find associated Indigo devices and update them.
+        self.logger.debug(u"parseBedData called.")
+        if beds is None:
+            beds = self.bedsList
+
+        if len(beds) > 0:
+            # Get the base data for all beds at once rather than one bed at a time.
+            baseDataByBedId = self.fetchBaseData(beds)
+            # Save the base capabilities downloaded this cycle all at once.
+            if self.capabilitiesDirty:
+                self.saveCapabilities()
+            statesWritten = 0  # Number of device states actually sent to the server this cycle.
+            deviceCount = 0  # Number of devices updated this cycle.
+
+            for bed in beds:
+                bedBase, bedBaseFeatureData = baseDataByBedId.get(bed.bed_id, (None, None))
+                leftSide = bed.left or self.emptySide
+                rightSide = bed.right or self.emptySide
+                anyoneInBed = leftSide.is_in_bed or rightSide.is_in_bed
+
+                self.noteBedActivity(bed.bed_id, leftSide, rightSide, bedBase)
+
+                # Only the devices monitoring this bed need to be updated.
+                with self.bedDevicesLock:
+                    deviceIds = list(self.bedDevices.get(bed.bed_id, ()))
+                if len(deviceIds) == 0:
+                    continue
+                bedKeyValueList, pluginProps = self.bedStatesAndProps(bed, bedBase, bedBaseFeatureData)
+
+                for deviceId in deviceIds:
+                    try:
+                        device = indigo.devices[deviceId]
+                    except KeyError:
+                        continue
                     if not (device.enabled and device.configured):
                         continue
 
-                    if device.deviceTypeId == "sleepNumberBed":
-                        # Create a key/value list to store all the device states before updating the device.
-                        # Use keyValueList.append({'key':'<keyName>', 'value':<value>, 'uiValue':<UI value>})
-                        # to add state/value list items.
-                        keyValueList = []
-                        # Create a temporary local copy of the device's properties.
-                        pluginProps = device.pluginProps
-
-                        # See if this Indigo device is associated with this Bed object.
-                        if device.pluginProps.get('bedId', "") == bedData.get('bedId', "x"):
-                            # Update the local copy of the device properties.
-                            pluginProps['accountId'] = bedData.get('accountId', "")
-                            pluginProps['address'] = bedData.get('bedId', "")
-                            pluginProps['base'] = bedData.get('base', "")
-                            pluginProps['baseConfigured'] = bedBaseData.get('fsConfigured', False)
-                            pluginProps['baseNeedsHoming'] = bedBaseData.get('fsNeedsHoming', False)
-                            pluginProps['baseType'] = bedBaseData.get('fsType', "")
-                            pluginProps['hasFootControl'] = bedBaseFeatureData.get('hasFootControl', False)
-                            pluginProps['hasFootWarming'] = bedBaseFeatureData.get('hasFootWarming', False)
-                            pluginProps['hasMassageAndLight'] = bedBaseFeatureData.get('hasMassageAndLight', False)
-                            pluginProps['hasUnderbedLight'] = bedBaseFeatureData.get('hasUnderbedLight', False)
-                            pluginProps['bedName'] = bedData.get('name', "")
-                            pluginProps['dualSleep'] = bedData.get('dualSleep', False)
-                            pluginProps['generation'] = bedData.get('generation', "")
-                            pluginProps['isKidsBed'] = bedData.get('isKidsBed', False)
-                            pluginProps['macAddress'] = bedData.get('macAddress', "")
-                            pluginProps['model'] = bedData.get('model', "")
-                            pluginProps['purchaseDate'] = bedData.get('purchaseDate', "")
-                            pluginProps['reference'] = bedData.get('reference', "")
-                            pluginProps['registrationDate'] = bedData.get('registrationDate', "")
-                            pluginProps['returnRequestStatus'] = bedData.get('returnRequestStatus', 0)
-                            pluginProps['serial'] = bedData.get('serial', "")
-                            pluginProps['size'] = bedData.get('size', "")
-                            pluginProps['sku'] = bedData.get('sku', "")
-                            pluginProps['status'] = bedData.get('status', 0)
-                            pluginProps['timeZone'] = bedData.get('timezone', "")
-                            pluginProps['version'] = bedData.get('version', "")
-                            pluginProps['zipCode'] = bedData.get('zipcode', "")
-
-                            # Update the key/value list for device states.
-                            keyValueList.append({'key': 'leftIsInBed', 'value': leftSideData.get('isInBed', False)})
-                            keyValueList.append({'key': 'leftPressure', 'value': leftSideData.get('pressure', 0)})
-                            keyValueList.append({'key': 'leftFootPosition', 'value': int(bedBaseData.get('fsLeftFootPosition', u'00'), 16)})
-                            keyValueList.append({'key': 'leftHeadPosition', 'value': int(bedBaseData.get('fsLeftHeadPosition', u'00'), 16)})
-                            keyValueList.append({'key': 'leftSleepNumber', 'value': leftSideData.get('sleepNumber', 0)})
-                            keyValueList.append({'key': 'leftSleeperId', 'value': leftSleeperData.get('sleeperId', 0)})
-                            keyValueList.append({'key': 'leftSleeperName', 'value': leftSleeperData.get('firstName', "")})
-                            keyValueList.append({'key': 'leftSleepGoal', 'value': leftSleeperData.get('sleepGoal', "")})
-                            keyValueList.append({'key': 'leftAlertId', 'value': leftSideData.get('alertId', "")})
-                            keyValueList.append({'key': 'leftAlertText', 'value': leftSideData.get('alertDetailedMessage', "")})
-
-                            keyValueList.append({'key': 'rightIsInBed', 'value': rightSideData.get('isInBed', False)})
-                            keyValueList.append({'key': 'rightPressure', 'value': rightSideData.get('pressure', 0)})
-                            keyValueList.append({'key': 'rightFootPosition', 'value': int(bedBaseData.get('fsRightFootPosition', u'00'), 16)})
-                            keyValueList.append({'key': 'rightHeadPosition', 'value': int(bedBaseData.get('fsRightHeadPosition', u'00'), 16)})
-                            keyValueList.append({'key': 'rightSleepNumber', 'value': rightSideData.get('sleepNumber', 0)})
-                            keyValueList.append({'key': 'rightSleeperId', 'value': rightSleeperData.get('sleeperId', 0)})
-                            keyValueList.append({'key': 'rightSleeperName', 'value': rightSleeperData.get('firstName', "")})
-                            keyValueList.append({'key': 'rightSleepGoal', 'value': rightSleeperData.get('sleepGoal', "")})
-                            keyValueList.append({'key': 'rightAlertId', 'value': rightSideData.get('alertId', "")})
-                            keyValueList.append({'key': 'rightAlertText', 'value': rightSideData.get('alertDetailedMessage', "")})
-
-                            # Update the calculated anyone and everyone in bed states.
-                            if leftSideData.get('isInBed', False) or rightSideData.get('isInBed', False):
-                                keyValueList.append({'key': 'anyoneInBed', 'value': True})
-                                keyValueList.append({'key': 'onOffState', 'value': True})
-                                # Send an Indigo log message if the onOffState will change.
-                                if not device.onState:
-                                    indigo.server.log(u"received \"" + device.name + u"\" status update is on", 'SleepyBed IQ')
-                            else:
-                                keyValueList.append({'key': 'anyoneInBed', 'value': False})
-                                keyValueList.append({'key': 'onOffState', 'value': False})
-                                # Send an Indigo log message if the onOffState will change.
-                                if device.onState:
-                                    indigo.server.log(u"received \"" + device.name + u"\" status update is off", 'SleepyBed IQ')
-                            if leftSideData.get('isInBed', False) and rightSideData.get('isInBed', False):
-                                keyValueList.append({'key': 'everyoneInBed', 'value': True})
-                            else:
-                                keyValueList.append({'key': 'everyoneInBed', 'value': False})
-
-                            # Now update the device properties and states on the server.
-                            self.logger.debug(u"parseBedData: Setting device \"" + device.name + "\" properties to:\n" + str(pluginProps))
-                            device.replacePluginPropsOnServer(pluginProps)  # Properties
-                            self.logger.debug(u"parseBedData: Setting device \"" + device.name + "\" states to:\n" + str(keyValueList))
-                            device.updateStatesOnServer(keyValueList)  # States
+                    # Send an Indigo log message if the onOffState will change.
+                    if anyoneInBed and not device.onState:
+                        indigo.server.log(u"received \"" + device.name + u"\" status update is on", 'SleepyBed IQ')
+                    elif not anyoneInBed and device.onState:
+                        indigo.server.log(u"received \"" + device.name + u"\" status update is off", 'SleepyBed IQ')
+
+                    # Leave states a queued command has set alone until the command has been verified.
+                    keyValueList = bedKeyValueList
+                    with self.expectedStatesLock:
+                        pendingKeys = set(self.expectedStates.get(deviceId, ()))
+                    if len(pendingKeys) > 0:
+                        keyValueList = [state for state in keyValueList if state['key'] not in pendingKeys]
+
+                    # Now update the device properties and states on the server.
+                    deviceCount += 1
+                    self.reconcileProps(device, pluginProps)  # Properties
+                    statesWritten += self.publishStates(device, keyValueList)  # States
+
+            self.logger.debug(f"parseBedData: {statesWritten} device state(s) written this cycle.")
+
+            # Report how long it took after startup for devices to be updated the first time.
+            if not self.firstUpdateLogged and deviceCount > 0:
+                self.firstUpdateLogged = True
+                self.logger.info(f"Devices updated {time.monotonic() - self.startTime:.1f} seconds after startup.")
+
+    # Bed States and Properties
+    ########################################
+    def bedStatesAndProps(self, bed, bedBase, bedBaseFeatureData):
+        # Work out the device states and properties a bed's status calls for, shared by every device monitoring
+        # the bed. They're reused while the bed, base and features are the same objects as last time.
+        cached = self.bedStates.get(bed.bed_id, None)
+        if cached is not None and cached[0] is bed and cached[1] is bedBase and cached[2] is bedBaseFeatureData:
+            return cached[3], cached[4]
+
+        bedData = bed.data  # Dict containing data for the Bed object.
+        leftSide = bed.left or self.emptySide
+        rightSide = bed.right or self.emptySide
+        leftSleeper = leftSide.sleeper or self.emptySleeper
+        rightSleeper = rightSide.sleeper or self.emptySleeper
+
+        # Work out what the device properties should be.
+        pluginProps = dict()
+        pluginProps['accountId'] = bedData.get('accountId', "")
+        pluginProps['address'] = bed.bed_id
+        pluginProps['base'] = bed.base
+        # Keep the last known base values if the base couldn't be reached this cycle.
+        if bedBase is not None:
+            pluginProps['baseConfigured'] = bedBase.configured
+            pluginProps['baseNeedsHoming'] = bedBase.needs_homing
+            pluginProps['baseType'] = bedBase.base_type
+        if bedBaseFeatureData:
+            pluginProps['hasFootControl'] = bedBaseFeatureData.get('hasFootControl', False)
+            pluginProps['hasFootWarming'] = bedBaseFeatureData.get('hasFootWarming', False)
+            pluginProps['hasMassageAndLight'] = bedBaseFeatureData.get('hasMassageAndLight', False)
+            pluginProps['hasUnderbedLight'] = bedBaseFeatureData.get('hasUnderbedLight', False)
+        pluginProps['bedName'] = bed.name
+        pluginProps['dualSleep'] = bedData.get('dualSleep', False)
+        pluginProps['generation'] = bedData.get('generation', "")
+        pluginProps['isKidsBed'] = bedData.get('isKidsBed', False)
+        pluginProps['macAddress'] = bedData.get('macAddress', "")
+        pluginProps['model'] = bedData.get('model', "")
+        pluginProps['purchaseDate'] = bedData.get('purchaseDate', "")
+        pluginProps['reference'] = bedData.get('reference', "")
+        pluginProps['registrationDate'] = bedData.get('registrationDate', "")
+        pluginProps['returnRequestStatus'] = bedData.get('returnRequestStatus', 0)
+        pluginProps['serial'] = bedData.get('serial', "")
+        pluginProps['size'] = bedData.get('size', "")
+        pluginProps['sku'] = bedData.get('sku', "")
+        pluginProps['status'] = bedData.get('status', 0)
+        pluginProps['timeZone'] = bed.timezone
+        pluginProps['version'] = bedData.get('version', "")
+        pluginProps['zipCode'] = bedData.get('zipcode', "")
+
+        # Create a key/value list to store all the device states.
+        # Use keyValueList.append({'key':'<keyName>', 'value':<value>, 'uiValue':<UI value>})
+        # to add state/value list items.
+        keyValueList = []
+        keyValueList.append({'key': 'leftIsInBed', 'value': leftSide.is_in_bed})
+        keyValueList.append({'key': 'leftPressure', 'value': leftSide.pressure})
+        keyValueList.append({'key': 'leftSleepNumber', 'value': leftSide.sleep_number})
+        keyValueList.append({'key': 'leftSleeperId', 'value': leftSleeper.sleeper_id})
+        keyValueList.append({'key': 'leftSleeperName', 'value': leftSleeper.first_name})
+        keyValueList.append({'key': 'leftSleepGoal', 'value': leftSleeper.sleep_goal})
+        keyValueList.append({'key': 'leftAlertId', 'value': leftSide.alert_id})
+        keyValueList.append({'key': 'leftAlertText', 'value': leftSide.alert_detailed_message})
+
+        keyValueList.append({'key': 'rightIsInBed', 'value': rightSide.is_in_bed})
+        keyValueList.append({'key': 'rightPressure', 'value': rightSide.pressure})
+        keyValueList.append({'key': 'rightSleepNumber', 'value': rightSide.sleep_number})
+        keyValueList.append({'key': 'rightSleeperId', 'value': rightSleeper.sleeper_id})
+        keyValueList.append({'key': 'rightSleeperName', 'value': rightSleeper.first_name})
+        keyValueList.append({'key': 'rightSleepGoal', 'value': rightSleeper.sleep_goal})
+        keyValueList.append({'key': 'rightAlertId', 'value': rightSide.alert_id})
+        keyValueList.append({'key': 'rightAlertText', 'value': rightSide.alert_detailed_message})
+
+        # Leave the base positions at their last values if the base couldn't be reached this cycle. A bed
+        # without a base is always at 0.
+        if bedBase is not None or not bed.base:
+            keyValueList.append({'key': 'leftFootPosition', 'value': bedBase.left_foot_position if bedBase else 0})
+            keyValueList.append({'key': 'leftHeadPosition', 'value': bedBase.left_head_position if bedBase else 0})
+            keyValueList.append({'key': 'rightFootPosition', 'value': bedBase.right_foot_position if bedBase else 0})
+            keyValueList.append({'key': 'rightHeadPosition', 'value': bedBase.right_head_position if bedBase else 0})
+
+        # Update the calculated anyone and everyone in bed states.
+        anyoneInBed = bool(leftSide.is_in_bed or rightSide.is_in_bed)
+        keyValueList.append({'key': 'anyoneInBed', 'value': anyoneInBed})
+        keyValueList.append({'key': 'onOffState', 'value': anyoneInBed})
+        keyValueList.append({'key': 'everyoneInBed', 'value': bool(leftSide.is_in_bed and rightSide.is_in_bed)})
+
+        self.bedStates[bed.bed_id] = (bed, bedBase, bedBaseFeatureData, keyValueList, pluginProps)
+        return keyValueList, pluginProps
+
+    # Reconcile Device Properties
+    ########################################
+    def reconcileProps(self, device, newProps):
+        # Replacing the properties is a heavy server round trip, and these values almost never change, so only
+        # write them when they differ from the device's current properties and no more often than
+        # propsUpdateInterval seconds, unless a capability property changed. Returns True if the properties were
+        # written.
+        pluginProps = device.pluginProps
+        changedProps = {key: value for key, value in newProps.items() if pluginProps.get(key, None) != value}
+        if len(changedProps) == 0:
+            return False
+        if time.time() - self.propsWrittenAt.get(device.id, 0) < self.propsUpdateInterval and \
+                not self.capabilityProps.intersection(changedProps):
+            self.logger.debug(u"reconcileProps: Deferring property changes for device \"" + device.name + "\": " + str(changedProps))
+            return False
+
+        pluginProps.update(changedProps)
+        self.logger.debug(u"reconcileProps: Setting device \"" + device.name + "\" properties:\n" + str(changedProps))
+        device.replacePluginPropsOnServer(pluginProps)
+        self.propsWrittenAt[device.id] = time.time()
+        return True
+
+    # Publish Changed Device States
+    ########################################
+    def publishStates(self, device, keyValueList):
+        # Send only the states whose values differ from what was last sent for this device, and skip the
+        # server call entirely if nothing changed. Returns the number of states written.
+        with self.publishedStatesLock:
+            publishedStates = self.publishedStates.setdefault(device.id, dict())
+            changedStates = [state for state in keyValueList
+                             if state['key'] not in publishedStates or publishedStates[state['key']] != state['value']]
+            if len(changedStates) == 0:
+                return 0
+            self.logger.debug(u"publishStates: Setting device \"" + device.name + "\" states to:\n" + str(changedStates))
+            device.updateStatesOnServer(changedStates)
+            for state in changedStates:
+                publishedStates[state['key']] = state['value']
+        return len(changedStates)
+
+    # Queue a Bed Command
+    ########################################
+    def queueCommand(self, device, description, target, function, *args, expectedStates=None, verify=None, tracksMotion=False):
+        # Queue a SleepIQ command for the device's bed and return without waiting for it to run. A command with
+        # a target replaces a queued command for the same target that hasn't been sent yet. expectedStates are
+        # published right away and marked pending until verify(bedId) reads them back after the command ran
+        # (following the base until it stops if tracksMotion is True).
+        command = Command(device.pluginProps.get('bedId', ""), device.id, description, function, args, target,
+                          expectedStates, verify, tracksMotion)
+        if len(command.expectedStates) > 0:
+            with self.expectedStatesLock:
+                owners = self.expectedStates.setdefault(device.id, dict())
+                for key in command.expectedStates:
+                    # Rolling back goes to the last value seen from the bed, not another command's expected value.
+                    if key in owners:
+                        command.previousStates[key] = owners[key].previousStates.get(key, None)
+                    else:
+                        command.previousStates[key] = device.states.get(key, None)
+                    owners[key] = command
+        pending, replaced = self.commandDispatcher.submit(command)
+        self.logger.debug(f"queueCommand: Queued \"{description}\" for \"{device.name}\". {pending} command(s) pending.")
+        keyValueList = [
+            {'key': 'lastCommand', 'value': description},
+            {'key': 'lastCommandStatus', 'value': "queued"},
+            {'key': 'pendingCommands', 'value': pending}
+        ]
+        if replaced:
+            self.coalescedCommands[device.id] = self.coalescedCommands.get(device.id, 0) + 1
+            self.logger.debug(f"queueCommand: Dropped \"{replaced.description}\" in favor of the newer command. \
+            {self.commandDispatcher.coalesced} request(s) saved so far.")
+            keyValueList.append({'key': 'coalescedCommands', 'value': self.coalescedCommands[device.id]})
+        if len(command.expectedStates) > 0:
+            keyValueList.extend({'key': key, 'value': value} for key, value in command.expectedStates.items() if value is not None)
+            keyValueList.append({'key': 'pendingVerification', 'value': True})
+        self.publishStates(device, keyValueList)
+
+    # Bed Command Finished (command dispatcher callback)
+    ########################################
+    def commandFinished(self, command):
+        if command.error:
+            self.logger.error(f"Unable to {command.description}. Error: {command.error}")
+            # The bed never got the command, so put back what it was before.
+            self.settleExpectedStates(command, command.previousStates)
+        else:
+            self.logger.debug(f"commandFinished: \"{command.description}\" finished in {command.latency():.2f} seconds.")
+            if command.tracksMotion:
+                self.trackMotion(command)
+            elif command.verify:
+                self.scheduleVerification(command, 0, dict())
+
+        try:
+            device = indigo.devices[command.deviceId]
+        except KeyError:
+            return
+        self.publishStates(device, [
+            {'key': 'lastCommand', 'value': command.description},
+            {'key': 'lastCommandStatus', 'value': "failed" if command.error else "succeeded"},
+            {'key': 'lastCommandError', 'value': str(command.error) if command.error else ""},
+            {'key': 'lastCommandLatency', 'value': round(command.latency(), 2)},
+            {'key': 'pendingCommands', 'value': self.commandDispatcher.pending(command.bedId)}
+        ])
+
+    # Schedule a Command Verification
+    ########################################
+    def scheduleVerification(self, command, attempt, lastStates):
+        delay = self.verifyDelays[attempt] - (self.verifyDelays[attempt - 1] if attempt > 0 else 0)
+        timer = threading.Timer(delay, self.verifyCommand, (command, attempt, lastStates))
+        timer.daemon = True
+        timer.start()
+
+    # Verify a Command (verification timer callback)
+    ########################################
+    def verifyCommand(self, command, attempt, lastStates):
+        # Read back the states a command set from its bed alone. Expected values that match are confirmed, and
+        # unknown (None) expected values are confirmed once they stop changing. Anything still different after
+        # the last attempt is rolled back to what the bed reports.
+        with self.expectedStatesLock:
+            owners = self.expectedStates.get(command.deviceId, dict())
+            ownedKeys = [key for key, owner in owners.items() if owner is command]
+        if len(ownedKeys) == 0:
+            # A newer command for the same states took over; it does its own verification.
+            return
+
+        try:
+            actualStates = command.verify(command.bedId)
+        except Exception as e:
+            self.logger.debug(f"verifyCommand: Unable to read back \"{command.description}\". Error: {e}")
+            actualStates = None
+
+        lastAttempt = attempt + 1 >= len(self.verifyDelays)
+        if actualStates is None:
+            if lastAttempt:
+                # Leave the states for the next poll to correct.
+                self.settleExpectedStates(command, dict())
+            else:
+                self.scheduleVerification(command, attempt + 1, lastStates)
+            return
+
+        matched = True
+        for key in ownedKeys:
+            expected = command.expectedStates[key]
+            actual = actualStates.get(key, None)
+            if expected is None:
+                matched = matched and key in lastStates and lastStates[key] == actual
+            else:
+                matched = matched and actual is not None and abs(actual - expected) <= self.verifyTolerance
+
+        if matched or lastAttempt:
+            if matched:
+                self.logger.debug(f"verifyCommand: \"{command.description}\" confirmed after {attempt + 1} read(s).")
+            else:
+                self.logger.warning(f"The bed didn't reach the expected state after the command to {command.description}. "
+                                    f"Showing the bed's actual state.")
+            self.settleExpectedStates(command, actualStates)
+            return
+
+        # Show the progress of states with no known target (e.g. a preset) while waiting for them to settle.
+        progress = [{'key': key, 'value': actualStates[key]} for key in ownedKeys
+                    if command.expectedStates[key] is None and actualStates.get(key, None) is not None]
+        if len(progress) > 0:
+            try:
+                self.publishStates(indigo.devices[command.deviceId], progress)
+            except KeyError:
+                return
+        self.scheduleVerification(command, attempt + 1, actualStates)
+
+    # Track Base Motion
+    ########################################
+    def trackMotion(self, command):
+        # Follow the bed's base until it's done moving after the command. A tracker already following the bed
+        # is replaced by one that follows its commands as well as this one.
+        with self.motionLock:
+            previous = self.motionTrackers.get(command.bedId, None)
+            commands = [command]
+            if previous:
+                previous[0].cancel()
+                commands = previous[1] + commands
+            targets = dict()
+            for trackedCommand in commands:
+                targets.update(trackedCommand.expectedStates)
+            tracker = MotionTracker(partial(command.verify, command.bedId), targets, interval=self.motionPollInterval,
+                                    tolerance=self.verifyTolerance, stallReads=self.motionStallReads,
+                                    maxRequests=self.motionMaxRequests, onProgress=partial(self.motionProgress, commands))
+            self.motionTrackers[command.bedId] = (tracker, commands)
+        self.motionExecutor.submit(self.runMotionTracker, command.bedId, tracker, commands)
+
+    # Run a Motion Tracker (motion tracker worker thread)
+    ########################################
+    def runMotionTracker(self, bedId, tracker, commands):
+        deviceIds = set(trackedCommand.deviceId for trackedCommand in commands)
+        for deviceId in deviceIds:
+            try:
+                self.publishStates(indigo.devices[deviceId], [{'key': 'baseMoving', 'value': True}])
+            except KeyError:
+                pass
+
+        result = tracker.run()
+        with self.motionLock:
+            if self.motionTrackers.get(bedId, (None,))[0] is not tracker:
+                # A newer tracker took over these commands.
+                return
+            del self.motionTrackers[bedId]
+        if result == CANCELLED:
+            return
+
+        self.logger.debug(f"runMotionTracker: Base of bed {bedId} {result} after {tracker.requests} status request(s).")
+        if result == TIMED_OUT or (result == STOPPED and any(target is not None for target in tracker.targets.values())):
+            self.logger.warning(f"The base didn't reach the expected position after the command to {commands[-1].description} "
+                                f"({'still moving' if result == TIMED_OUT else 'stopped'} after {tracker.requests} status checks). "
+                                f"Showing the base's actual position.")
+        for trackedCommand in commands:
+            self.settleExpectedStates(trackedCommand, tracker.positions)
+
+        for deviceId in deviceIds:
+            try:
+                self.publishStates(indigo.devices[deviceId], [{'key': 'baseMoving', 'value': False},
+                                                              {'key': 'lastMotionResult', 'value': result}])
+            except KeyError:
+                pass
+        sides = set(trackedCommand.target[1] for trackedCommand in commands if trackedCommand.target)
+        self.fireMotionTriggers(deviceIds, sides, result)
+
+    # Base Motion Progress (motion tracker callback)
+    ########################################
+    def motionProgress(self, commands, positions):
+        # Show the positions with no known target (e.g. after a preset) while the base moves.
+        with self.expectedStatesLock:
+            progress = dict()  # Indigo device ID: key/value list
+            for trackedCommand in commands:
+                owners = self.expectedStates.get(trackedCommand.deviceId, dict())
+                for key, expected in trackedCommand.expectedStates.items():
+                    if expected is None and owners.get(key, None) is trackedCommand and key in positions:
+                        progress.setdefault(trackedCommand.deviceId, []).append({'key': key, 'value': positions[key]})
+        for deviceId, keyValueList in progress.items():
+            try:
+                self.publishStates(indigo.devices[deviceId], keyValueList)
+            except KeyError:
+                pass
+
+    # Fire Base Finished Moving Triggers
+    ########################################
+    def fireMotionTriggers(self, deviceIds, sides, result):
+        for trigger in list(self.motionTriggers.values()):
+            if trigger.pluginTypeId != 'baseMotionFinished':
+                continue
+            triggerDeviceId = int(trigger.pluginProps.get('deviceId', 0) or 0)
+            if triggerDeviceId != 0 and triggerDeviceId not in deviceIds:
+                continue
+            if trigger.pluginProps.get('side', "any") not in ("any", *sides):
+                continue
+            if trigger.pluginProps.get('result', "any") not in ("any", result):
+                continue
+            self.logger.debug(f"fireMotionTriggers: Executing trigger \"{trigger.name}\".")
+            indigo.trigger.execute(trigger)
+
+    # Settle Expected States
+    ########################################
+    def settleExpectedStates(self, command, states):
+        # Stop treating the states the command set as pending and publish the given values for them (missing
+        # keys are left for the next poll). States a newer command has set since are left to that command.
+        with self.expectedStatesLock:
+            owners = self.expectedStates.get(command.deviceId, dict())
+            ownedKeys = [key for key, owner in owners.items() if owner is command]
+            for key in ownedKeys:
+                del owners[key]
+            stillPending = len(owners) > 0
+            if not stillPending:
+                self.expectedStates.pop(command.deviceId, None)
+        if len(ownedKeys) == 0:
+            return
+
+        try:
+            device = indigo.devices[command.deviceId]
+        except KeyError:
+            return
+        keyValueList = [{'key': key, 'value': states[key]} for key in ownedKeys if states.get(key, None) is not None]
+        keyValueList.append({'key': 'pendingVerification', 'value': stillPending})
+        self.publishStates(device, keyValueList)
+
+    # Read SleepNumbers for One Bed
+    ########################################
+    def readSleepNumbers(self, bedId):
+        for familyStatus in self.connection.bed_family_status():
+            if familyStatus.bed_id == bedId:
+                return {'leftSleepNumber': familyStatus.left.sleep_number,
+                        'rightSleepNumber': familyStatus.right.sleep_number}
+        return None
+
+    # Read Base Positions for One Bed
+    ########################################
+    def readBasePositions(self, bedId):
+        bedBase = self.connection.foundation_status(bedId=bedId)
+        return {'leftHeadPosition': bedBase.left_head_position, 'leftFootPosition': bedBase.left_foot_position,
+                'rightHeadPosition': bedBase.right_head_position, 'rightFootPosition': bedBase.right_foot_position}
 
     # Set SleepNumber value
     ########################################
@@ -584,10 +1640,13 @@ class Plugin(indigo.PluginBase):
         if SleepNumber < 0 or SleepNumber > 100:
             errorText = f"The SleepNumber \"{SleepNumber}\" is invalid. No action taken."
             self.logger.error(errorText)
+            return
 
         bedId = device.pluginProps.get('bedId', "")
 
-        self.connection.set_sleepnumber(side, SleepNumber, bedId)
+        self.queueCommand(device, f"set the {'Right' if side == 'R' else 'Left'} side SleepNumber of \"{device.name}\" to {SleepNumber}",
+                          ('sleepNumber', side), self.connection.set_sleepnumber, side, SleepNumber, bedId,
+                          expectedStates={f"{'right' if side == 'R' else 'left'}SleepNumber": SleepNumber}, verify=self.readSleepNumbers)
 
     # Select FlexFit Preset
     ########################################
@@ -615,9 +1674,14 @@ class Plugin(indigo.PluginBase):
         # "speed" should be either 0 (for fast) or 1 (for slow).
 
         bedId = device.pluginProps.get('bedId', "")
+        sideName = 'right' if side == 'R' else 'left'
 
         if device.pluginProps.get('base', "") != "":
-            self.connection.preset(FlexFitPreset, side, bedId, speed)
+            # The preset's positions aren't known ahead of time, so they're pending until the base stops moving.
+            self.queueCommand(device, f"set the {'Right' if side == 'R' else 'Left'} side FlexFit position of \"{device.name}\" to preset {FlexFitPreset}",
+                              ('preset', side), self.connection.preset, FlexFitPreset, side, bedId, speed,
+                              expectedStates={f"{sideName}HeadPosition": None, f"{sideName}FootPosition": None},
+                              verify=self.readBasePositions, tracksMotion=True)
         else:
             errorText = u"The \"" + device.name + u"\" doesn't support that feature.  No action taken."
             self.logger.error(errorText)
@@ -648,7 +1712,10 @@ class Plugin(indigo.PluginBase):
         # Make sure the bed supports controlling what's been requested.
         if device.pluginProps.get('base', "") != "":
             if headOrFoot == "H" or (headOrFoot == "F" and device.pluginProps.get('hasFootControl', False)):
-                self.connection.set_foundation_position(side, headOrFoot, basePosition, bedId, speed)
+                self.queueCommand(device, f"set the {'Right' if side == 'R' else 'Left'} side {'Foot' if headOrFoot == 'F' else 'Head'} position of \"{device.name}\" to {basePosition}",
+                                  ('position', side, headOrFoot), self.connection.set_foundation_position, side, headOrFoot, basePosition, bedId, speed,
+                                  expectedStates={f"{'right' if side == 'R' else 'left'}{'Foot' if headOrFoot == 'F' else 'Head'}Position": basePosition},
+                                  verify=self.readBasePositions, tracksMotion=True)
             else:
                 errorText = u"The \"" + device.name + u"\" doesn't support that feature.  No action taken."
                 self.logger.error(errorText)
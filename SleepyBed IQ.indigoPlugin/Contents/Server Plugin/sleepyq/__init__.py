@@ -1,7 +1,16 @@
+import logging
+import re
 import requests
-import inflection
+import threading
+import time
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from .retry import RetryPolicy, CircuitBreaker, CircuitOpenError, OK, RELOGIN, RETRY, FAIL
+from .transport import CountingHTTPAdapter
+from .ratelimit import PriorityRateLimiter, RateLimitError, SAFETY, USER, BACKGROUND
+from .metrics import ApiMetrics
+from .recording import TrafficRecorder
 
 RIGHT_NIGHT_STAND = 1
 LEFT_NIGHT_STAND = 2
@@ -54,140 +63,604 @@ MASSAGE_MODE = [
         WAVE
     ]
 
+API_URL = "https://prod-api.sleepiq.sleepnumber.com/rest"
+
+logger = logging.getLogger("Plugin.sleepyq")
+
+# Attribute name: API key, e.g. 'sleeper_left_id': 'sleeperLeftId'. Seeded with
+# the names this module uses and extended the first time any other name is read.
+API_KEYS = {
+        'bed_id': 'bedId',
+        'sleeper_id': 'sleeperId',
+        'sleeper_left_id': 'sleeperLeftId',
+        'sleeper_right_id': 'sleeperRightId',
+        'fsBoardFeatures': 'fsBoardFeatures',
+        'fsBedType': 'fsBedType',
+        'fsLeftUnderbedLightPWM': 'fsLeftUnderbedLightPWM',
+        'fsRightUnderbedLightPWM': 'fsRightUnderbedLightPWM'
+    }
+
+def api_key(name):
+    #
+    # same result as inflection.camelize(name, False), computed once per name
+    #
+    try:
+        return API_KEYS[name]
+    except KeyError:
+        key = re.sub(r"(?:^|_)(.)", lambda m: m.group(1).upper(), name)
+        key = name[0].lower() + key[1:] if name else key
+        API_KEYS[name] = key
+        return key
+
 class APIobject(object):
+    #
+    # Immutable snapshot of an object in an API response. The fields callers
+    # read are parsed once, when the snapshot is made, into __slots__ (e.g.
+    # base positions decoded from hex to int). Any other attribute is looked
+    # up in the raw response dict, still available as .data, by its camelCase
+    # API key. Use replace() to get a copy with some fields changed.
+    #
+    __slots__ = ('data',)
+
     def __init__(self, data):
-        self.data = data
+        object.__setattr__(self, 'data', data)
 
     def __getattr__(self, name):
-        adjusted_name = inflection.camelize(name, False)
+        # Only called for names that aren't slots.
+        if name == 'data' or name.startswith('__'):
+            raise AttributeError(name)
+        adjusted_name = api_key(name)
         return self.data[adjusted_name] if self.data is not None else None
 
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} snapshots can't be changed")
+
+    def replace(self, **fields):
+        copy = object.__new__(type(self))
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                object.__setattr__(copy, name, fields[name] if name in fields else getattr(self, name))
+        return copy
+
 class Bed(APIobject):
-    def __init__(self, data):
+    __slots__ = ('bed_id', 'name', 'base', 'timezone', 'sleeper_left_id', 'sleeper_right_id', 'left', 'right')
+
+    def __init__(self, data, left=None, right=None):
         super(Bed, self).__init__(data)
-        self.left = None
-        self.right = None
+        set_field = object.__setattr__
+        set_field(self, 'bed_id', data.get('bedId', ""))
+        set_field(self, 'name', data.get('name', ""))
+        set_field(self, 'base', data.get('base', ""))
+        set_field(self, 'timezone', data.get('timezone', ""))
+        set_field(self, 'sleeper_left_id', data.get('sleeperLeftId', "0"))
+        set_field(self, 'sleeper_right_id', data.get('sleeperRightId', "0"))
+        set_field(self, 'left', left)  # SideStatus, None if nobody sleeps on that side
+        set_field(self, 'right', right)
 
 class FamilyStatus(APIobject):
+    __slots__ = ('bed_id', 'left', 'right')
+
     def __init__(self, data):
         super(FamilyStatus, self).__init__(data)
-        self.bed = None
-
-        self.left = SideStatus(data['leftSide'])
-        self.right = SideStatus(data['rightSide'])
+        set_field = object.__setattr__
+        set_field(self, 'bed_id', data.get('bedId', ""))
+        set_field(self, 'left', SideStatus(data['leftSide']))
+        set_field(self, 'right', SideStatus(data['rightSide']))
 
 class SideStatus(APIobject):
-    def __init__(self, data):
+    __slots__ = ('is_in_bed', 'pressure', 'sleep_number', 'alert_id', 'alert_detailed_message', 'sleeper')
+
+    def __init__(self, data, sleeper=None):
         super(SideStatus, self).__init__(data)
-        self.bed = None
-        self.sleeper = None
+        set_field = object.__setattr__
+        set_field(self, 'is_in_bed', data.get('isInBed', False))
+        set_field(self, 'pressure', data.get('pressure', 0))
+        set_field(self, 'sleep_number', data.get('sleepNumber', 0))
+        set_field(self, 'alert_id', data.get('alertId', ""))
+        set_field(self, 'alert_detailed_message', data.get('alertDetailedMessage', ""))
+        set_field(self, 'sleeper', sleeper)
 
 class Sleeper(APIobject):
+    __slots__ = ('sleeper_id', 'first_name', 'sleep_goal')
+
     def __init__(self, data):
         super(Sleeper, self).__init__(data)
-        self.bed = None
+        set_field = object.__setattr__
+        set_field(self, 'sleeper_id', data.get('sleeperId', 0))
+        set_field(self, 'first_name', data.get('firstName', ""))
+        set_field(self, 'sleep_goal', data.get('sleepGoal', ""))
 
 class FavSleepNumber(APIobject):
+    __slots__ = ('left', 'right')
+
     def __init__(self, data):
         super(FavSleepNumber, self).__init__(data)
-        self.left = None
-        self.right = None
+        object.__setattr__(self, 'left', data['sleepNumberFavoriteLeft'])
+        object.__setattr__(self, 'right', data['sleepNumberFavoriteRight'])
 
 class Status(APIobject):
+    __slots__ = ()
+
+class FoundationStatus(Status):
+    #
+    # base status, with the actuator positions (hex strings in the response)
+    # decoded to 0-100
+    #
+    __slots__ = ('left_head_position', 'left_foot_position', 'right_head_position', 'right_foot_position',
+                 'configured', 'needs_homing', 'base_type')
+
     def __init__(self, data):
-        super(Status, self).__init__(data)
+        super(FoundationStatus, self).__init__(data)
+        set_field = object.__setattr__
+        set_field(self, 'left_head_position', int(data.get('fsLeftHeadPosition', '00'), 16))
+        set_field(self, 'left_foot_position', int(data.get('fsLeftFootPosition', '00'), 16))
+        set_field(self, 'right_head_position', int(data.get('fsRightHeadPosition', '00'), 16))
+        set_field(self, 'right_foot_position', int(data.get('fsRightFootPosition', '00'), 16))
+        set_field(self, 'configured', data.get('fsConfigured', False))
+        set_field(self, 'needs_homing', data.get('fsNeedsHoming', False))
+        set_field(self, 'base_type', data.get('fsType', ""))
 
 
 class Sleepyq:
-    def __init__(self, login, password):
+    #
+    # Thread safety: one Sleepyq may be shared by any number of threads, e.g.
+    # the plugin's polling thread and Indigo action callbacks at the same time.
+    # Per-request parameters are passed with each request and never stored on
+    # the shared session, the session key is only replaced under the login
+    # lock, and the bed cache has its own lock. Returned API objects are
+    # immutable snapshots, so they can be shared: an object that didn't change
+    # since the last response is returned again rather than parsed again.
+    #
+    def __init__(self, login, password, pool_size=10, api_url=API_URL, adapter=None, rate_limit=5, rate_burst=10):
+        #
+        # pool_size  number of kept-alive connections to the API, at least
+        #            the most requests the caller makes at the same time
+        # api_url    base URL of the SleepIQ REST API, e.g. a local stand-in
+        #            for testing
+        # adapter    requests transport adapter to send requests with, default
+        #            a CountingHTTPAdapter; a ReplayHTTPAdapter answers them
+        #            from a recording instead
+        # rate_limit requests per second allowed on average, None=no limit
+        # rate_burst requests allowed at once after a quiet spell
+        #
         self._login = login
         self._password = password
         self._session = requests.Session()
+        self.pool_size = pool_size
+        self._adapter = adapter or CountingHTTPAdapter(pool_maxsize=pool_size)
+        self._session.mount('https://', self._adapter)
+        self._session.mount('http://', self._adapter)
         self._session.headers.update({'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/28.0.1500.95 Safari/537.36'})
-        self._api = "https://prod-api.sleepiq.sleepnumber.com/rest"
-
-    def __make_request(self, url, mode="get", data="", attempt=0):
-        if attempt < 4:
-            try:
-                if mode == 'put':
-                    r = self._session.put(self._api+url, json=data, timeout=2)
-                else:
-                    r = self._session.get(self._api+url, timeout=2)
-                if r.status_code == 401: # HTTP error 401 Unauthorized
-                    # Login
-                    self.login()
-                elif r.status_code == 404: # HTTP error 404 Not Found
-                    # Login
-                    self.login()
-                elif r.status_code == 503:  # HTTP error 503 Server Error
+        self._api = api_url.rstrip('/')
+        self.last_timings = {}  # Seconds taken by each call of the last beds_with_sleeper_status().
+        self.bed_cache_ttl = 300  # Seconds a fetched bed list is reused to resolve the default bed ID.
+        self._beds_cache = None
+        self._beds_cache_time = 0
+        self._sleepers_cache = None
+        self._sleepers_cache_time = 0
+        self._beds_cache_lock = threading.Lock()  # Also guards the sleepers cache.
+        self._snapshots = {}  # (kind, ID): last snapshot made, returned again while its data doesn't change
+        self._snapshots_lock = threading.Lock()
+        self.retry_policy = RetryPolicy()
+        # Shared by every request, user commands first. None if requests aren't limited.
+        self.rate_limiter = PriorityRateLimiter(rate_limit, rate_burst) if rate_limit is not None else None
+        self.breaker = CircuitBreaker()  # Set breaker.listener to be told when the service goes down or comes back.
+        self.metrics = ApiMetrics()  # Per-endpoint counts, errors and latencies of every request.
+        self.login_timeout = 10  # Seconds to wait for a login request.
+        self.key_lifetime = None  # Seconds a session key is expected to stay valid, None=only log in again after a 401.
+        self.key_refresh_margin = 0.1  # Fraction of key_lifetime before expiry at which the key is refreshed.
+        self.refresh_retry_delay = 30  # Seconds before retrying a failed key refresh, doubled for each failure after.
+        self.refresh_retry_max_delay = 600  # Longest wait between key refresh attempts.
+        self._key = None  # SleepIQ session key, sent as the _k parameter of every request.
+        self._login_lock = threading.Lock()
+        self._login_generation = 0  # Incremented on every successful login.
+        self._key_time = None  # time.monotonic() of the last successful login.
+        self._refresh_timer = None
+        self._closed = False  # Set by close(), so a failed refresh isn't rescheduled afterwards.
+
+    def __make_request(self, url, mode="get", data="", params=None, priority=None):
+        #
+        # priority SAFETY, USER or BACKGROUND (default USER for put, BACKGROUND
+        # for get) orders requests waiting on the rate limiter
+        #
+        # raises CircuitOpenError without a request while the breaker is open,
+        # or if another call's trial request doesn't close it before the
+        # deadline,
+        # RateLimitError if the rate limiter doesn't allow the request before
+        # the deadline, requests.exceptions.HTTPError for error responses and
+        # the last Timeout/ConnectionError once the retries or the deadline
+        # run out
+        #
+        if priority is None:
+            priority = USER if mode == 'put' else BACKGROUND
+        endpoint = ApiMetrics.endpoint(mode, url)
+        self.metrics.record_call(endpoint)
+        deadline = time.monotonic() + self.retry_policy.deadline
+        # While a half open breaker's trial request runs, wait for it rather than fail the call.
+        if not self.breaker.allow(timeout=self.retry_policy.deadline):
+            self.metrics.record_rejected(endpoint)
+            raise CircuitOpenError(f"SleepIQ service unavailable, {self.breaker.rejection_reason()}", request=None)
+        attempt = 0
+        relogged = False
+        try:
+            while True:
+                error = None
+                if self.rate_limiter is not None and not self.rate_limiter.acquire(priority, deadline - time.monotonic()):
+                    self.metrics.record_rejected(endpoint)
+                    raise RateLimitError(f"Request rate limit reached for url: {url}")
+                generation = self._login_generation
+                sent = time.monotonic()
+                try:
+                    timeout = max(0.1, min(self.retry_policy.timeout, deadline - sent))
+                    request_params = dict(params or {}, _k=self._key)
+                    if mode == 'put':
+                        r = self._session.put(self._api+url, json=data, params=request_params, timeout=timeout)
+                    else:
+                        r = self._session.get(self._api+url, params=request_params, timeout=timeout)
+                    self.metrics.record_request(endpoint, time.monotonic() - sent, status=r.status_code, retry=attempt > 0)
+                    action = self.retry_policy.classify(r.status_code)
+                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                    self.metrics.record_request(endpoint, time.monotonic() - sent,
+                                                timeout=isinstance(e, requests.exceptions.Timeout), retry=attempt > 0)
+                    error = e
+                    action = RETRY
+
+                if action == OK:
+                    self.breaker.record_success()
+                    return r
+                if action == FAIL or (action == RELOGIN and relogged):
+                    # The service answered, it just won't do what was asked.
                     r.raise_for_status()
-                if r.status_code != 200: # If status code is not 200 OK
-                    retry = self.__make_request(url, mode, data, attempt+1)
-                    if type(retry) == requests.models.Response:
-                        r = retry
+                    raise requests.exceptions.HTTPError(f"{r.status_code} Unexpected response for url: {r.url}", response=r)
+
+                attempt += 1
+                if action == RELOGIN:
+                    # The session key expired. Log in again (unless another thread already
+                    # has since this request was sent) and retry right away.
+                    relogged = True
+                    self.__relogin(generation)
+                    delay = 0
+                else:
+                    delay = self.retry_policy.delay(attempt)
+                if attempt >= self.retry_policy.attempts or time.monotonic() + delay >= deadline:
+                    if error is not None:
+                        raise error
                     r.raise_for_status()
-                return r
-            except requests.exceptions.ReadTimeout:
-                retry = self.__make_request(url, mode, data, attempt+1)
-                if type(retry) == requests.models.Response:
-                    retry.raise_for_status()
-                    return retry
-                print('Request timed out to', url)
+                    raise requests.exceptions.HTTPError(f"{r.status_code} Unexpected response for url: {r.url}", response=r)
+                time.sleep(delay)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+            self.breaker.record_failure()
+            raise
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and self.retry_policy.classify(e.response.status_code) == RETRY:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        except RateLimitError:
+            # Turned down here without a request, so it says nothing about the service.
+            self.breaker.release()
+            raise
+        except Exception:
+            # Anything else (e.g. a rejected login or missing credentials) doesn't show whether the service is
+            # up either. Don't count it, and let another call make the trial if this one was it.
+            self.breaker.release()
+            raise
+
+    def connection_stats(self):
+        #
+        # requests sent, connections opened on the request path (each a TCP
+        # and TLS handshake), connections opened ahead of time by
+        # warm_connections() and requests that reused a kept-alive connection
+        #
+        return self._adapter.stats()
+
+    def start_recording(self, path, max_bytes=5000000, backup_count=3):
+        #
+        # record every request and response from now on to path, rotated
+        # when it reaches max_bytes (see TrafficRecorder). Credentials and
+        # session keys are scrubbed.
+        #
+        recorder = TrafficRecorder(path, max_bytes=max_bytes, backup_count=backup_count)
+        self.stop_recording()
+        self._adapter.recorder = recorder
+
+    def stop_recording(self):
+        recorder, self._adapter.recorder = self._adapter.recorder, None
+        if recorder is not None:
+            recorder.close()
+
+    def recording(self):
+        #
+        # path being recorded to, None if not recording
+        #
+        recorder = self._adapter.recorder
+        return recorder.path if recorder is not None else None
+
+    def warm_connections(self, count=None):
+        #
+        # open up to count (default pool_size) connections to the API ahead
+        # of a burst of requests, replacing any the server closed while they
+        # were idle, so the handshakes aren't paid for on the request path
+        #
+        if not self._adapter.sends_requests:
+            return
+        connections = []
+        warmed = 0
+        try:
+            # Use the same connection pool requests will pick for API requests.
+            settings = self._session.merge_environment_settings(self._api, {}, None, None, None)
+            if hasattr(self._adapter, 'get_connection_with_tls_context'):
+                pool = self._adapter.get_connection_with_tls_context(requests.Request('GET', self._api).prepare(),
+                                                                     settings['verify'], settings['proxies'], settings['cert'])
+            else:
+                pool = self._adapter.get_connection(self._api, settings['proxies'])
+            for i in range(min(count or self.pool_size, self.pool_size)):
+                connection = pool._get_conn()
+                connections.append(connection)
+                if getattr(connection, 'sock', None) is None:
+                    connection.timeout = self.retry_policy.timeout
+                    connection.connect()
+                    warmed += 1
+        except Exception as e:
+            # The request itself will connect (and report any error) if warming fails.
+            logger.debug(f"Unable to open a connection to the SleepIQ service ahead of time: {e}")
+        finally:
+            for connection in connections:
+                pool._put_conn(connection)
+        self._adapter.count_warmed(warmed)
 
     def __feature_check(self, value, digit):
         return ((1 << digit) & value) > 0
 
     def login(self):
-        if '_k' in self._session.params:
-            del self._session.params['_k']
+        #
+        # logs in and gets a new session key. Concurrent calls are collapsed
+        # into one login whose result they all share.
+        #
+        self.__relogin(self._login_generation)
+        return True
+
+    def session_key(self):
+        #
+        # current session key, None if not logged in
+        #
+        return self._key
+
+    def use_session_key(self, key, age=0):
+        #
+        # reuse a key saved from an earlier session instead of logging in.
+        # age is how many seconds ago the key was obtained. If the key has
+        # expired, the first request that gets a 401 logs in again.
+        #
+        with self._login_lock:
+            self._key = key
+            self._key_time = time.monotonic() - age
+            self._login_generation += 1
+            self.__schedule_refresh(max(0, self.key_lifetime * (1 - self.key_refresh_margin) - age) if self.key_lifetime else None)
+
+    def key_age(self):
+        #
+        # seconds since the session key was obtained, None if not logged in
+        #
+        if self._key_time is None:
+            return None
+        return time.monotonic() - self._key_time
+
+    def close(self):
+        #
+        # stops the background key refresh and any recording
+        #
+        with self._login_lock:
+            self._closed = True
+            if self._refresh_timer:
+                self._refresh_timer.cancel()
+                self._refresh_timer = None
+        self.stop_recording()
+
+    def __relogin(self, generation, expired=True):
+        #
+        # log in unless a login has completed since generation was read, in
+        # which case the key it got is used. expired False=the current key
+        # still works and is kept until the new one arrives
+        #
+        with self._login_lock:
+            if self._login_generation != generation:
+                return
+            self.__login(expired)
+
+    def __login(self, expired=True):
+        # Must be called with _login_lock held.
+        if expired:
+            # The session (and the beds it could see) are gone, so don't send the rejected key again.
+            self.invalidate_bed_cache()
+            self._key = None
         if not self._login or not self._password:
             raise ValueError("username/password not set")
         data = {'login': self._login, 'password': self._password}
-        r = self._session.put(self._api+'/login', json=data)
+        r = self._session.put(self._api+'/login', json=data, timeout=self.login_timeout)
         if r.status_code == 401:
             raise ValueError("Incorect username or password")
-        self._session.params['_k'] = r.json()['key']
-        return True
+        r.raise_for_status()
+        # Requests sent until now used the old key, requests sent from now on use the new one.
+        self._key = r.json()['key']
+        self._key_time = time.monotonic()
+        self._login_generation += 1
+        self.__schedule_refresh(self.key_lifetime * (1 - self.key_refresh_margin) if self.key_lifetime else None)
+
+    def __schedule_refresh(self, delay, failures=0):
+        # Must be called with _login_lock held. delay None=no background refresh.
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+        if delay is not None:
+            self._refresh_timer = threading.Timer(delay, self.__refresh_key, (self._login_generation, failures))
+            self._refresh_timer.daemon = True
+            self._refresh_timer.start()
+
+    def __refresh_key(self, generation, failures):
+        # Renew the key before it expires so no request has to fail with a 401 first. The current key keeps
+        # being used until the new one arrives, and stays in use if the refresh fails.
+        try:
+            self.__relogin(generation, expired=False)
+            logger.debug("Refreshed the SleepIQ session key")
+        except Exception as e:
+            delay = min(self.refresh_retry_max_delay, self.refresh_retry_delay * 2 ** failures)
+            logger.debug(f"Unable to refresh the SleepIQ session key, retrying in {delay} seconds: {e}")
+            with self._login_lock:
+                # Unless a login has replaced the key in the meantime (and scheduled its own refresh).
+                if self._login_generation == generation and not self._closed:
+                    self.__schedule_refresh(delay, failures + 1)
+
+    def __shared(self, key, cls, data):
+        #
+        # the snapshot made for key last time if its data is the same, so
+        # unchanged objects are shared between polls instead of parsed again,
+        # else a new cls(data)
+        #
+        with self._snapshots_lock:
+            previous = self._snapshots.get(key)
+            if previous is not None and previous.data == data:
+                return previous
+            snapshot = self._snapshots[key] = cls(data)
+            return snapshot
 
     def sleepers(self):
         r=self.__make_request('/sleeper')
-        sleepers = [Sleeper(sleeper) for sleeper in r.json()['sleepers']]
+        sleepers = [self.__shared(('sleeper', sleeper.get('sleeperId')), Sleeper, sleeper) for sleeper in r.json()['sleepers']]
+        with self._beds_cache_lock:
+            self._sleepers_cache = sleepers
+            self._sleepers_cache_time = time.monotonic()
         return sleepers
 
+    def cached_sleepers(self):
+        #
+        # sleeper list from the last sleepers() call if it is less than
+        # bed_cache_ttl seconds old
+        #
+        with self._beds_cache_lock:
+            if self._sleepers_cache is not None and time.monotonic() - self._sleepers_cache_time < self.bed_cache_ttl:
+                return self._sleepers_cache
+        return self.sleepers()
+
     def beds(self):
         r=self.__make_request('/bed')
-        beds = [Bed(bed) for bed in r.json()['beds']]
+        beds = [self.__shared(('bed', bed.get('bedId')), Bed, bed) for bed in r.json()['beds']]
+        with self._beds_cache_lock:
+            self._beds_cache = beds
+            self._beds_cache_time = time.monotonic()
         return beds
 
-    def beds_with_sleeper_status(self):
-        beds = self.beds()
-        sleepers = self.sleepers()
+    def cached_beds(self):
+        #
+        # bed list from the last beds() call (including the one made by
+        # beds_with_sleeper_status) if it is less than bed_cache_ttl seconds old
+        #
+        with self._beds_cache_lock:
+            if self._beds_cache is not None and time.monotonic() - self._beds_cache_time < self.bed_cache_ttl:
+                return self._beds_cache
+        return self.beds()
+
+    def seed_bed_cache(self, beds):
+        #
+        # fill the bed cache with a bed list saved from an earlier session
+        #
+        with self._beds_cache_lock:
+            self._beds_cache = beds
+            self._beds_cache_time = time.monotonic()
+
+    def invalidate_bed_cache(self):
+        with self._beds_cache_lock:
+            self._beds_cache = None
+            self._sleepers_cache = None
+
+    def __timed(self, timings, name, method):
+        start = time.monotonic()
+        try:
+            return method()
+        finally:
+            timings[name] = time.monotonic() - start
+
+    def beds_with_sleeper_status(self, concurrent=True):
+        #
+        # concurrent True=fetch /bed, /sleeper and /bed/familyStatus in parallel
+        # over the shared session, False=fetch them one after another
+        #
+        timings = {}
+        start = time.monotonic()
+        if concurrent:
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                beds = executor.submit(self.__timed, timings, 'beds', self.beds)
+                sleepers = executor.submit(self.__timed, timings, 'sleepers', self.sleepers)
+                family_statuses = executor.submit(self.__timed, timings, 'familyStatus', self.bed_family_status)
+                beds = beds.result()
+                sleepers = sleepers.result()
+                family_statuses = family_statuses.result()
+        else:
+            beds = self.__timed(timings, 'beds', self.beds)
+            sleepers = self.__timed(timings, 'sleepers', self.sleepers)
+            family_statuses = self.__timed(timings, 'familyStatus', self.bed_family_status)
+        timings['total'] = time.monotonic() - start
+        self.last_timings = timings
+        return self.__attach_status(beds, sleepers, family_statuses)
+
+    def bed_with_sleeper_status(self, bedId):
+        #
+        # same as beds_with_sleeper_status for a single bed. Only the family
+        # status is requested, the bed and sleepers come from the caches.
+        #
         family_statuses = self.bed_family_status()
+        beds = [bed for bed in self.cached_beds() if bed.bed_id == bedId]
+        if not beds:
+            raise ValueError("Unknown bed ID")
+        return self.__attach_status(beds, self.cached_sleepers(), family_statuses)[0]
+
+    def __attach_status(self, beds, sleepers, family_statuses):
+        #
+        # copies of beds with their side statuses and sleepers filled in. A
+        # bed or side whose parts are all the same objects as last time is
+        # the same object as last time.
+        #
         sleepers_by_id = {sleeper.sleeper_id: sleeper for sleeper in sleepers}
         bed_family_statuses_by_bed_id = {family_status.bed_id: family_status for family_status in family_statuses}
+        attached = []
         for bed in beds:
             family_status = bed_family_statuses_by_bed_id.get(bed.bed_id)
+            sides = {}
             for side in ['left', 'right']:
                 sleeper_key = 'sleeper_' + side + '_id'
                 sleeper_id = getattr(bed, sleeper_key)
                 if sleeper_id == "0": # if no sleeper
+                    sides[side] = None
                     continue
                 sleeper = sleepers_by_id.get(sleeper_id)
                 status = getattr(family_status, side)
-                status.sleeper = sleeper
-                setattr(bed, side, status)
-        return beds
+                with self._snapshots_lock:
+                    previous = self._snapshots.get(('side', bed.bed_id, side))
+                    if previous is not None and previous.data == status.data and previous.sleeper is sleeper:
+                        sides[side] = previous
+                    else:
+                        sides[side] = self._snapshots[('side', bed.bed_id, side)] = status.replace(sleeper=sleeper)
+            with self._snapshots_lock:
+                previous = self._snapshots.get(('bedStatus', bed.bed_id))
+                if previous is not None and previous.data is bed.data and previous.left is sides['left'] and previous.right is sides['right']:
+                    attached.append(previous)
+                else:
+                    attached.append(bed.replace(left=sides['left'], right=sides['right']))
+                    self._snapshots[('bedStatus', bed.bed_id)] = attached[-1]
+        return attached
 
 
     def bed_family_status(self):
         r=self.__make_request('/bed/familyStatus')
-        statuses = [FamilyStatus(status) for status in r.json()['beds']]
+        statuses = [self.__shared(('familyStatus', status.get('bedId')), FamilyStatus, status) for status in r.json()['beds']]
         return statuses
         
     def default_bed_id(self, bedId):
         if not bedId:
-            if len(self.beds()) == 1:
-                bedId = self.beds()[0].data['bedId']
+            beds = self.cached_beds()
+            if len(beds) == 1:
+                bedId = beds[0].bed_id
             else:
                 raise ValueError("Bed ID must be specified if there is more than one bed")
         return bedId
@@ -209,9 +682,7 @@ class Sleepyq:
         # same light numbering as set_light
         #
         if light in BED_LIGHTS:
-            self._session.params['outletId'] = light
-            r=self.__make_request('/bed/'+self.default_bed_id(bedId)+'/foundation/outlet')
-            del self._session.params['outletId']
+            r=self.__make_request('/bed/'+self.default_bed_id(bedId)+'/foundation/outlet', params={'outletId': light}, priority=USER)
             return Status(r.json())
         else:
             raise ValueError("Invalid light")
@@ -269,9 +740,7 @@ class Sleepyq:
         else:
             raise ValueError("Side mut be one of the following: left, right, L or R")
         data = {'bed': self.default_bed_id(bedId), 'side': side, "sleepNumber": int(round(setting/5))*5}
-        self._session.params['side']=side
-        r=self.__make_request('/bed/'+self.default_bed_id(bedId)+'/sleepNumber', "put", data)
-        del self._session.params['side']
+        r=self.__make_request('/bed/'+self.default_bed_id(bedId)+'/sleepNumber', "put", data, params={'side': side})
         return True
 
     def set_favsleepnumber(self, side, setting, bedId = ''):
@@ -292,13 +761,8 @@ class Sleepyq:
         return True
 
     def get_favsleepnumber(self, bedId = ''):
-        r=self.__make_request('/bed/'+self.default_bed_id(bedId)+'/sleepNumberFavorite')
-        fav_sleepnumber = FavSleepNumber(r.json())
-        for side in ['Left', 'Right']:
-            side_key = 'sleepNumberFavorite'+ side
-            fav_sleepnumber_side = fav_sleepnumber.data[side_key]
-            setattr(fav_sleepnumber, side.lower(), fav_sleepnumber_side)
-        return fav_sleepnumber
+        r=self.__make_request('/bed/'+self.default_bed_id(bedId)+'/sleepNumberFavorite', priority=USER)
+        return FavSleepNumber(r.json())
 
     def stop_motion(self, side, bedId = ''):
         #
@@ -311,17 +775,18 @@ class Sleepyq:
         else:
             raise ValueError("Side mut be one of the following: left, right, L or R")
         data = {"footMotion":1, "headMotion":1, "massageMotion":1, "side":side}
-        r=self.__make_request('/bed/'+self.default_bed_id(bedId)+'/foundation/motion', "put", data)
+        r=self.__make_request('/bed/'+self.default_bed_id(bedId)+'/foundation/motion', "put", data, priority=SAFETY)
         return True
 
     def stop_pump(self, bedId = ''):
-        r=self.__make_request('/bed/'+self.default_bed_id(bedId)+'/pump/forceIdle', "put")
+        r=self.__make_request('/bed/'+self.default_bed_id(bedId)+'/pump/forceIdle', "put", priority=SAFETY)
         return True
 
     def foundation_status(self, bedId = ''):
-        r = self.__make_request('/bed/'+self.default_bed_id(bedId)+'/foundation/status')
+        bedId = self.default_bed_id(bedId)
+        r = self.__make_request('/bed/'+bedId+'/foundation/status')
         try:
-            result = Status(r.json())
+            result = self.__shared(('foundation', bedId), FoundationStatus, r.json())
         except AttributeError:
             result = None
         return result
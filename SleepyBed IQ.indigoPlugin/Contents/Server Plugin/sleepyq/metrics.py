@@ -0,0 +1,164 @@
+import math
+import re
+import threading
+
+class LatencySketch(object):
+    #
+    # Quantile sketch with bounded memory: latencies are counted in
+    # logarithmic buckets that each cover relative_error of their value, so
+    # any quantile is within relative_error of the true one. Latencies are
+    # clamped to [min_value, max_value] seconds, which bounds the number of
+    # buckets (about 400 with the defaults) no matter how many are added.
+    #
+    def __init__(self, relative_error=0.02, min_value=0.001, max_value=120):
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self._log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.max_value = max_value
+        self.buckets = {}  # bucket index: count
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        value = min(self.max_value, max(self.min_value, seconds))
+        index = int(math.ceil(math.log(value) / self._log_gamma))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # Middle of the bucket, which is within relative_error of every value in it.
+                return min(self.max, 2 * self.gamma ** index / (self.gamma + 1))
+        return self.max
+
+class EndpointMetrics(object):
+    def __init__(self):
+        self.calls = 0  # calls to the endpoint, however many requests each took
+        self.requests = 0  # requests actually sent, including retries
+        self.retries = 0
+        self.timeouts = 0
+        self.connection_errors = 0
+        self.rejected = 0  # calls refused without a request (breaker open or rate limited)
+        self.statuses = {}  # HTTP status code: count
+        self.latency = LatencySketch()
+
+    def snapshot(self):
+        return {'calls': self.calls, 'requests': self.requests, 'retries': self.retries, 'timeouts': self.timeouts,
+                'connection_errors': self.connection_errors, 'rejected': self.rejected, 'statuses': dict(self.statuses),
+                'errors': self.errors(), 'latency_mean': self.latency.total / self.latency.count if self.latency.count else None,
+                'latency_p50': self.latency.quantile(0.5), 'latency_p90': self.latency.quantile(0.9),
+                'latency_p99': self.latency.quantile(0.99), 'latency_max': self.latency.max if self.latency.count else None}
+
+    def errors(self):
+        # requests that failed: no response, or a response that wasn't 2xx
+        return self.timeouts + self.connection_errors + sum(count for status, count in self.statuses.items() if not 200 <= status < 300)
+
+class ApiMetrics(object):
+    #
+    # Per-endpoint request metrics for a Sleepyq object. Endpoints are named
+    # by method and path with the bed ID replaced, e.g.
+    # "GET /bed/{bedId}/foundation/status". Everything is kept twice: since
+    # the object was created, and since the last reset_window() so callers
+    # can report what happened in each interval.
+    #
+    def __init__(self):
+        self._total = {}  # endpoint: EndpointMetrics
+        self._window = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def endpoint(mode, url):
+        return f"{mode.upper()} {re.sub(r'^/bed/[^/]+/', '/bed/{bedId}/', url)}"
+
+    def record_call(self, endpoint):
+        self.__record(endpoint, 'calls')
+
+    def record_rejected(self, endpoint):
+        self.__record(endpoint, 'rejected')
+
+    def record_request(self, endpoint, seconds, status=None, timeout=False, retry=False):
+        #
+        # one request: status is the HTTP status code, or None if there was no
+        # response (timeout True for a timeout, else a connection error)
+        #
+        with self._lock:
+            for metrics in self.__metrics(endpoint):
+                metrics.requests += 1
+                if retry:
+                    metrics.retries += 1
+                if status is not None:
+                    metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+                elif timeout:
+                    metrics.timeouts += 1
+                else:
+                    metrics.connection_errors += 1
+                metrics.latency.add(seconds)
+
+    def snapshot(self, window=False):
+        #
+        # {endpoint: dict of the endpoint's metrics} since creation, or since
+        # the last reset_window() if window is True
+        #
+        with self._lock:
+            endpoints = self._window if window else self._total
+            return {endpoint: metrics.snapshot() for endpoint, metrics in endpoints.items()}
+
+    def summary(self, window=False):
+        #
+        # totals over every endpoint, with the latency quantiles of all
+        # requests together
+        #
+        with self._lock:
+            return self.__combine(self._window if window else self._total)
+
+    def take_window(self):
+        #
+        # (snapshot, summary) since the last reset_window() or take_window(),
+        # and start a new window
+        #
+        with self._lock:
+            endpoints = self._window
+            self._window = {}
+        return {endpoint: metrics.snapshot() for endpoint, metrics in endpoints.items()}, self.__combine(endpoints)
+
+    def reset_window(self):
+        with self._lock:
+            self._window = {}
+
+    def __combine(self, endpoints):
+        combined = EndpointMetrics()
+        for metrics in endpoints.values():
+            for counter in ('calls', 'requests', 'retries', 'timeouts', 'connection_errors', 'rejected'):
+                setattr(combined, counter, getattr(combined, counter) + getattr(metrics, counter))
+            for status, count in metrics.statuses.items():
+                combined.statuses[status] = combined.statuses.get(status, 0) + count
+            combined.latency.merge(metrics.latency)
+        return combined.snapshot()
+
+    def __record(self, endpoint, counter):
+        with self._lock:
+            for metrics in self.__metrics(endpoint):
+                setattr(metrics, counter, getattr(metrics, counter) + 1)
+
+    def __metrics(self, endpoint):
+        # Must be called with _lock held.
+        for endpoints in (self._total, self._window):
+            if endpoint not in endpoints:
+                endpoints[endpoint] = EndpointMetrics()
+            yield endpoints[endpoint]
@@ -0,0 +1,81 @@
+import bisect
+import itertools
+import requests
+import threading
+import time
+
+SAFETY = 0      # stop motion, stop pump: never wait
+USER = 1        # commands a person or automation is waiting on
+BACKGROUND = 2  # polling reads
+
+class RateLimitError(requests.exceptions.RequestException):
+    pass
+
+class PriorityRateLimiter(object):
+    #
+    # Token bucket shared by every request a Sleepyq object makes. rate tokens
+    # are added per second up to burst. Waiting requests get tokens in
+    # priority order (then first come, first served), so user commands go
+    # ahead of queued background reads. SAFETY requests never wait; they take
+    # a token even if that leaves the bucket in debt.
+    #
+    def __init__(self, rate=5, burst=10):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._waiters = []  # sorted (priority, sequence) of the requests waiting for a token
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def configure(self, rate=None, burst=None):
+        #
+        # change the rate and/or burst, e.g. to let a larger burst through
+        # once more beds need to be polled. A larger burst is available right
+        # away, as if the bucket had always been that size.
+        #
+        with self._condition:
+            self.__refill()
+            if rate is not None:
+                self.rate = rate
+            if burst is not None:
+                self._tokens = min(burst, self._tokens + max(0, burst - self.burst))
+                self.burst = burst
+            self._condition.notify_all()
+
+    def acquire(self, priority=BACKGROUND, timeout=None):
+        #
+        # wait for a token. Returns False if none was granted within timeout
+        # seconds.
+        #
+        with self._condition:
+            self.__refill()
+            if priority == SAFETY:
+                self._tokens -= 1
+                return True
+
+            waiter = (priority, next(self._sequence))
+            bisect.insort(self._waiters, waiter)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            try:
+                while True:
+                    self.__refill()
+                    if self._waiters[0] == waiter and self._tokens >= 1:
+                        self._tokens -= 1
+                        return True
+                    # Sleep until the next token is due, or until woken by a waiter leaving the line.
+                    wait = max(0.01, (1 - self._tokens) / self.rate) if self._waiters[0] == waiter else None
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._condition.wait(wait)
+            finally:
+                self._waiters.remove(waiter)
+                self._condition.notify_all()
+
+    def __refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
@@ -0,0 +1,184 @@
+import collections
+import http.client
+import json
+import os
+import requests
+import threading
+import time
+
+from urllib.parse import urlsplit, parse_qsl
+from .transport import CountingHTTPAdapter
+
+# Request parameters and JSON fields (at any depth) whose values are replaced
+# before they are written: the account credentials and the session key.
+SCRUBBED_FIELDS = {'_k', 'key', 'login', 'password', 'username', 'email'}
+SCRUBBED = 'scrubbed'
+
+def scrub(value):
+    if isinstance(value, dict):
+        return {name: SCRUBBED if name in SCRUBBED_FIELDS else scrub(item) for name, item in value.items()}
+    if isinstance(value, list):
+        return [scrub(item) for item in value]
+    return value
+
+class TrafficRecorder(object):
+    #
+    # Writes every request sent through a CountingHTTPAdapter and its response
+    # (or error) and timing to path as one JSON object per line, with the
+    # credentials and session key scrubbed. When the file would grow past
+    # max_bytes it is renamed path.1 (path.1 to path.2 and so on, keeping
+    # backup_count old files) and a new one started, like the logging
+    # module's RotatingFileHandler.
+    #
+    # Each line has:
+    #   t        seconds since recording started
+    #   time     time.time() the request was sent
+    #   method   HTTP method
+    #   path     URL path, e.g. /rest/bed/familyStatus
+    #   params   query parameters (optional)
+    #   data     JSON request body (optional)
+    #   seconds  time taken to answer
+    #   status   HTTP status code, or error 'timeout'/'connection' if there
+    #            was no response
+    #   json     JSON response body, or text if it wasn't JSON
+    #
+    def __init__(self, path, max_bytes=5000000, backup_count=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.entries = 0
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+        self._size = self._file.tell()
+
+    def record(self, request, response, seconds, error=None):
+        url = urlsplit(request.url)
+        entry = {'t': round(time.monotonic() - self._start - seconds, 3), 'time': round(time.time() - seconds, 3),
+                 'method': request.method, 'path': url.path}
+        params = {name: value for name, value in parse_qsl(url.query)}
+        if params:
+            entry['params'] = scrub(params)
+        if request.body:
+            try:
+                entry['data'] = scrub(json.loads(request.body))
+            except ValueError:
+                pass
+        entry['seconds'] = round(seconds, 4)
+        if response is None:
+            entry['error'] = 'timeout' if isinstance(error, requests.exceptions.Timeout) else 'connection'
+        else:
+            entry['status'] = response.status_code
+            try:
+                entry['json'] = scrub(response.json())
+            except ValueError:
+                if response.text:
+                    entry['text'] = response.text
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+
+        with self._lock:
+            if self._file is None:
+                return
+            if self._size and self._size + len(line) > self.max_bytes:
+                self.__rotate()
+            self._file.write(line)
+            self._file.flush()
+            self._size += len(line)
+            self.entries += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __rotate(self):
+        # Must be called with _lock held.
+        self._file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'w', encoding='utf-8')
+        self._size = 0
+
+def read_recording(path):
+    #
+    # entries recorded by a TrafficRecorder at path, oldest first, including
+    # the ones in its rotated files (path.1, path.2, ...)
+    #
+    files = [path]
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        files.insert(0, f"{path}.{index}")
+        index += 1
+    entries = []
+    for name in files:
+        with open(name, encoding='utf-8') as recording:
+            entries.extend(json.loads(line) for line in recording if line.strip())
+    return entries
+
+class ReplayHTTPAdapter(CountingHTTPAdapter):
+    #
+    # Answers requests from a recording instead of the network. Requests are
+    # matched to recorded ones by method and URL path, in the order they were
+    # recorded; once a path's recorded responses run out, its last one is
+    # used again, and a path that wasn't recorded gets a 404. Each answer
+    # takes the recorded time divided by speed (speed None=answer at once),
+    # and recorded timeouts and connection errors are raised again.
+    #
+    sends_requests = False
+
+    def __init__(self, entries, speed=1.0, *args, **kwargs):
+        super(ReplayHTTPAdapter, self).__init__(*args, **kwargs)
+        self.speed = speed
+        self._responses = collections.defaultdict(collections.deque)  # (method, path): recorded entries
+        self._last = {}  # (method, path): last entry used
+        self._replay_lock = threading.Lock()
+        for entry in entries:
+            self._responses[(entry['method'], entry['path'])].append(entry)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        with self._counter_lock:
+            self.requests_sent += 1
+        key = (request.method, urlsplit(request.url).path)
+        with self._replay_lock:
+            if self._responses[key]:
+                self._last[key] = self._responses[key].popleft()
+            entry = self._last.get(key)
+
+        if entry is None:
+            return self.__response(request, 404, b'{}')
+        if self.speed:
+            time.sleep(entry['seconds'] / self.speed)
+        if 'error' in entry:
+            if entry['error'] == 'timeout':
+                raise requests.exceptions.ReadTimeout(f"Recorded timeout for url: {request.url}", request=request)
+            raise requests.exceptions.ConnectionError(f"Recorded connection error for url: {request.url}", request=request)
+        if 'json' in entry:
+            content = json.dumps(entry['json']).encode('utf-8')
+        else:
+            content = entry.get('text', '').encode('utf-8')
+        return self.__response(request, entry['status'], content)
+
+    def remaining(self):
+        #
+        # number of recorded requests not replayed yet
+        #
+        with self._replay_lock:
+            return sum(len(entries) for entries in self._responses.values())
+
+    def __response(self, request, status, content):
+        response = requests.models.Response()
+        response.status_code = status
+        response.reason = http.client.responses.get(status, '')
+        response._content = content
+        response.encoding = 'utf-8'
+        response.headers['Content-Type'] = 'application/json'
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
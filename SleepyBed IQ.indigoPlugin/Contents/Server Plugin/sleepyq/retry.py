@@ -0,0 +1,167 @@
+import random
+import requests
+import threading
+import time
+
+OK = 'ok'
+RELOGIN = 'relogin'
+RETRY = 'retry'
+FAIL = 'fail'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+class RetryPolicy(object):
+    #
+    # attempts    maximum number of requests made for one call
+    # base_delay  seconds before the first retry, doubled for each one after
+    # max_delay   longest wait between two attempts
+    # deadline    seconds one call may take in total, including retries
+    # timeout     seconds to wait for each single request
+    #
+    def __init__(self, attempts=4, base_delay=0.5, max_delay=8, deadline=20, timeout=2):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.timeout = timeout
+        self.retry_statuses = {408, 429, 500, 502, 503, 504}
+        self.relogin_statuses = {401}
+
+    def classify(self, status_code):
+        #
+        # OK=use the response, RELOGIN=log in again then retry,
+        # RETRY=retry after a delay, FAIL=raise without retrying
+        #
+        if 200 <= status_code < 300:
+            return OK
+        if status_code in self.relogin_statuses:
+            return RELOGIN
+        if status_code in self.retry_statuses:
+            return RETRY
+        return FAIL
+
+    def delay(self, retry):
+        # Seconds to wait before retry number retry (1 for the first retry): exponential
+        # backoff with full jitter so callers don't retry in lock step.
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (retry - 1)))
+
+class CircuitBreaker(object):
+    #
+    # Opens after failure_threshold calls in a row fail because the service is
+    # unreachable or erroring, fails fast while open, and lets one trial call
+    # through after reset_timeout seconds. Calls made while the trial runs can
+    # wait for its result (see allow). listener(old_state, new_state) is
+    # called on every state change.
+    #
+    def __init__(self, failure_threshold=5, reset_timeout=60, listener=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.listener = listener
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._trial_running = False
+        self._trial_thread = None  # Thread making the trial call.
+        self._condition = threading.Condition()
+
+    @property
+    def state(self):
+        with self._condition:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def retry_after(self):
+        # Seconds until an open breaker lets a trial call through, 0 if it
+        # already would or one is running.
+        with self._condition:
+            if self._state != OPEN:
+                return 0
+            return max(0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def rejection_reason(self):
+        # Why allow() turned a call down, for error messages.
+        retry_after = self.retry_after()
+        if retry_after > 0:
+            return f"retrying in {max(1, round(retry_after))} seconds"
+        return "a trial request is in progress"
+
+    def allow(self, timeout=0):
+        #
+        # True if a call may be made. While half open only one trial call is
+        # let through; other calls wait up to timeout seconds for it to
+        # finish, and are allowed if it closed the breaker.
+        #
+        deadline = time.monotonic() + timeout
+        changed = None
+        with self._condition:
+            while True:
+                if self._state == CLOSED:
+                    allowed = True
+                    break
+                if self._state == OPEN:
+                    if time.monotonic() - self._opened_at < self.reset_timeout:
+                        allowed = False
+                        break
+                    changed = self._set_state(HALF_OPEN)
+                if not self._trial_running:
+                    self._trial_running = True
+                    self._trial_thread = threading.get_ident()
+                    allowed = True
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    allowed = False
+                    break
+                self._condition.wait(remaining)
+        self._notify(changed)
+        return allowed
+
+    def release(self):
+        #
+        # give up the trial call this thread was allowed without recording a
+        # result, e.g. because it was never sent. Does nothing if this thread
+        # isn't making the trial call.
+        #
+        with self._condition:
+            if self._trial_running and self._trial_thread == threading.get_ident():
+                self._trial_running = False
+                self._trial_thread = None
+                self._condition.notify_all()
+
+    def record_success(self):
+        with self._condition:
+            self._failures = 0
+            self._trial_running = False
+            self._trial_thread = None
+            changed = self._set_state(CLOSED)
+            self._condition.notify_all()
+        self._notify(changed)
+
+    def record_failure(self):
+        with self._condition:
+            self._failures += 1
+            self._trial_running = False
+            self._trial_thread = None
+            changed = None
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                changed = self._set_state(OPEN)
+            self._condition.notify_all()
+        self._notify(changed)
+
+    def _set_state(self, state):
+        if state == self._state:
+            return None
+        old_state = self._state
+        self._state = state
+        return (old_state, state)
+
+    def _notify(self, changed):
+        if changed and self.listener:
+            self.listener(*changed)
@@ -0,0 +1,67 @@
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+
+class CountingHTTPAdapter(HTTPAdapter):
+    #
+    # HTTPAdapter that counts the requests it sends and the connections it
+    # opens, to tell requests that reused a kept-alive connection from ones
+    # that had to wait for a new TCP and TLS handshake. Set recorder to a
+    # TrafficRecorder to record every request and its response.
+    #
+    sends_requests = True  # False for adapters that answer without a connection.
+
+    def __init__(self, *args, **kwargs):
+        self.recorder = None
+        self.requests_sent = 0
+        self.connections_opened = 0
+        self.connections_warmed = 0  # Connections opened ahead of time, not on the request path.
+        self._counter_lock = threading.Lock()
+        super(CountingHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(CountingHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {scheme: self.__counting_pool_class(pool_class)
+                                                   for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()}
+
+    def send(self, request, *args, **kwargs):
+        with self._counter_lock:
+            self.requests_sent += 1
+        recorder = self.recorder
+        if recorder is None:
+            return super(CountingHTTPAdapter, self).send(request, *args, **kwargs)
+        start = time.monotonic()
+        try:
+            response = super(CountingHTTPAdapter, self).send(request, *args, **kwargs)
+        except Exception as e:
+            recorder.record(request, None, time.monotonic() - start, e)
+            raise
+        # Reading the content here is part of the response time, and requests would read it right after anyway.
+        response.content
+        recorder.record(request, response, time.monotonic() - start)
+        return response
+
+    def count_connection(self):
+        with self._counter_lock:
+            self.connections_opened += 1
+
+    def count_warmed(self, count):
+        with self._counter_lock:
+            self.connections_warmed += count
+
+    def stats(self):
+        with self._counter_lock:
+            new = max(0, self.connections_opened - self.connections_warmed)
+            return {'requests': self.requests_sent, 'new': new, 'warmed': self.connections_warmed,
+                    'reused': max(0, self.requests_sent - new)}
+
+    def __counting_pool_class(self, pool_class):
+        adapter = self
+
+        class CountingConnection(pool_class.ConnectionCls):
+            def connect(self):
+                adapter.count_connection()
+                return super(CountingConnection, self).connect()
+
+        return type(pool_class.__name__, (pool_class,), {'ConnectionCls': CountingConnection})
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The plugin's modules (sleepyq, commands, motion) are imported from the Server Plugin folder, as Indigo does.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
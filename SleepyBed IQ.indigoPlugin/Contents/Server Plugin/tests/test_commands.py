@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Tests for the command dispatcher (commands.py)
+#
+# Run from the Server Plugin folder: python -m pytest -q tests
+#
+################################################################################
+
+import threading
+import time
+import unittest
+
+from commands import Command, CommandDispatcher
+
+
+################################################################################
+class CommandDispatcherTests(unittest.TestCase):
+    ########################################
+    def setUp(self):
+        self.sent = []  # (bedId, value) in the order the commands were sent
+        self.finished = []
+        self.lock = threading.Lock()
+        self.allFinished = threading.Event()
+        self.expected = 0
+        self.dispatcher = CommandDispatcher(workers=4, onFinished=self.onFinished, coalesceWindow=0.05)
+        self.addCleanup(self.dispatcher.shutdown)
+
+    ########################################
+    def onFinished(self, command):
+        with self.lock:
+            self.finished.append(command)
+            if len(self.finished) == self.expected:
+                self.allFinished.set()
+
+    ########################################
+    def send(self, bedId, value, delay=0):
+        time.sleep(delay)
+        with self.lock:
+            self.sent.append((bedId, value))
+
+    ########################################
+    def submit(self, bedId, value, target=None, delay=0):
+        return self.dispatcher.submit(Command(bedId, 1, f"set {value}", self.send, (bedId, value, delay), target=target))
+
+    ########################################
+    def waitForCommands(self, count):
+        with self.lock:
+            self.expected = count
+            if len(self.finished) >= count:
+                return
+        self.assertTrue(self.allFinished.wait(5), f"only {len(self.finished)} of {count} commands finished")
+
+    ########################################
+    def test_commands_for_a_bed_run_in_order(self):
+        for value in range(5):
+            self.submit("bed", value, delay=0.005)
+        self.waitForCommands(5)
+        self.assertEqual(self.sent, [("bed", value) for value in range(5)])
+        self.assertEqual(self.dispatcher.pending("bed"), 0)
+
+    ########################################
+    def test_beds_run_at_the_same_time(self):
+        start = time.monotonic()
+        for bedId in ("bed 1", "bed 2", "bed 3"):
+            self.submit(bedId, 1, delay=0.2)
+        self.waitForCommands(3)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    ########################################
+    def test_newer_value_for_the_same_target_replaces_a_queued_one(self):
+        self.submit("bed", "head 10", target=("bed", "head"))
+        pending, replaced = self.submit("bed", "head 20", target=("bed", "head"))
+        self.assertEqual(pending, 1)
+        self.assertEqual(replaced.args[1], "head 10")
+        self.waitForCommands(1)
+        self.assertEqual(self.sent, [("bed", "head 20")])
+        self.assertEqual(self.dispatcher.coalesced, 1)
+
+    ########################################
+    def test_replacement_is_sent_no_later_than_the_replaced_command(self):
+        first = Command("bed", 1, "head 10", self.send, ("bed", "head 10"), target="head")
+        self.dispatcher.submit(first)
+        time.sleep(0.03)
+        second = Command("bed", 1, "head 20", self.send, ("bed", "head 20"), target="head")
+        self.dispatcher.submit(second)
+        self.assertEqual(second.notBefore, first.notBefore)
+
+    ########################################
+    def test_replacement_runs_after_commands_queued_before_it(self):
+        self.submit("bed", "head 10", target="head")
+        self.submit("bed", "preset")
+        self.submit("bed", "head 20", target="head")
+        self.waitForCommands(2)
+        self.assertEqual(self.sent, [("bed", "preset"), ("bed", "head 20")])
+
+    ########################################
+    def test_commands_without_a_target_are_never_coalesced(self):
+        self.submit("bed", "stop")
+        self.submit("bed", "stop")
+        self.waitForCommands(2)
+        self.assertEqual(self.sent, [("bed", "stop"), ("bed", "stop")])
+        self.assertEqual(self.dispatcher.coalesced, 0)
+
+    ########################################
+    def test_errors_are_kept_on_the_command(self):
+        def fail():
+            raise ValueError("bed offline")
+
+        self.dispatcher.submit(Command("bed", 1, "fail", fail, ()))
+        self.waitForCommands(1)
+        self.assertIsInstance(self.finished[0].error, ValueError)
+        self.assertIsNotNone(self.finished[0].finishTime)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Tests for sleepyq.metrics.LatencySketch
+#
+# Run from the Server Plugin folder: python -m pytest -q tests
+#
+################################################################################
+
+import random
+import unittest
+
+from sleepyq.metrics import LatencySketch
+
+
+################################################################################
+class LatencySketchTests(unittest.TestCase):
+    ########################################
+    def exactQuantile(self, values, q):
+        # The same rank LatencySketch.quantile uses.
+        return sorted(values)[int(q * (len(values) - 1))]
+
+    ########################################
+    def assertWithinRelativeError(self, sketch, values):
+        for q in (0.0, 0.1, 0.5, 0.9, 0.99, 1.0):
+            exact = self.exactQuantile(values, q)
+            estimate = sketch.quantile(q)
+            self.assertLessEqual(abs(estimate - exact), 0.02 * exact + 1e-12, f"quantile {q}: {estimate} vs {exact}")
+
+    ########################################
+    def test_quantiles_are_within_the_relative_error(self):
+        generator = random.Random(1)
+        values = [generator.lognormvariate(-2, 1) for _ in range(20000)]
+        values = [min(120, max(0.001, value)) for value in values]
+        sketch = LatencySketch(relative_error=0.02)
+        for value in values:
+            sketch.add(value)
+        self.assertWithinRelativeError(sketch, values)
+        self.assertEqual(sketch.count, len(values))
+        self.assertAlmostEqual(sketch.total, sum(values))
+
+    ########################################
+    def test_memory_is_bounded(self):
+        generator = random.Random(2)
+        sketch = LatencySketch()
+        for _ in range(50000):
+            sketch.add(generator.uniform(0, 500))
+        self.assertLessEqual(len(sketch.buckets), 450)
+
+    ########################################
+    def test_quantile_never_exceeds_the_largest_value(self):
+        sketch = LatencySketch()
+        sketch.add(0.25)
+        self.assertLessEqual(sketch.quantile(1.0), 0.25)
+        self.assertEqual(sketch.max, 0.25)
+
+    ########################################
+    def test_empty_sketch_has_no_quantiles(self):
+        self.assertIsNone(LatencySketch().quantile(0.5))
+
+    ########################################
+    def test_merge_matches_one_sketch_of_everything(self):
+        generator = random.Random(3)
+        values = [generator.expovariate(5) + 0.001 for _ in range(5000)]
+        first, second, combined = LatencySketch(), LatencySketch(), LatencySketch()
+        for index, value in enumerate(values):
+            (first if index % 2 else second).add(value)
+            combined.add(value)
+        first.merge(second)
+        self.assertEqual(first.buckets, combined.buckets)
+        self.assertEqual(first.count, combined.count)
+        self.assertEqual(first.max, combined.max)
+        for q in (0.5, 0.9, 0.99):
+            self.assertEqual(first.quantile(q), combined.quantile(q))
+
+
+if __name__ == '__main__':
+    unittest.main()
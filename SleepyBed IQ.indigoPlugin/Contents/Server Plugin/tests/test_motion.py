@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Tests for the base motion tracker (motion.py)
+#
+# Run from the Server Plugin folder: python -m pytest -q tests
+#
+################################################################################
+
+import threading
+import unittest
+
+from motion import REACHED, STOPPED, TIMED_OUT, CANCELLED, MotionTracker
+
+
+################################################################################
+class ScriptedBase(object):
+    # Returns the given positions one read at a time, then keeps returning the last ones. An exception in the
+    # script is raised instead of returned.
+    ########################################
+    def __init__(self, *reads):
+        self.reads = list(reads)
+        self.count = 0
+
+    ########################################
+    def read(self):
+        reading = self.reads[min(self.count, len(self.reads) - 1)]
+        self.count += 1
+        if isinstance(reading, Exception):
+            raise reading
+        return dict(reading)
+
+
+################################################################################
+class MotionTrackerTests(unittest.TestCase):
+    ########################################
+    def track(self, base, targets, **kwargs):
+        kwargs.setdefault('interval', 0.001)
+        return MotionTracker(base.read, targets, **kwargs)
+
+    ########################################
+    def test_reached_when_every_known_target_is_within_tolerance(self):
+        base = ScriptedBase({'head': 0, 'foot': 0}, {'head': 20, 'foot': 5}, {'head': 39, 'foot': 10})
+        tracker = self.track(base, {'head': 40, 'foot': None}, tolerance=2)
+        self.assertEqual(tracker.run(), REACHED)
+        self.assertEqual(tracker.positions, {'head': 39, 'foot': 10})
+        self.assertEqual(tracker.requests, 3)
+
+    ########################################
+    def test_stopped_after_stall_reads_without_change(self):
+        base = ScriptedBase({'head': 0}, {'head': 15}, {'head': 30})
+        tracker = self.track(base, {'head': 60}, stallReads=3)
+        self.assertEqual(tracker.run(), STOPPED)
+        self.assertEqual(tracker.positions, {'head': 30})
+        self.assertEqual(tracker.requests, 3 + 3)
+
+    ########################################
+    def test_settles_when_no_target_is_known(self):
+        base = ScriptedBase({'head': 0}, {'head': 10}, {'head': 12})
+        tracker = self.track(base, {'head': None}, stallReads=2)
+        self.assertEqual(tracker.run(), STOPPED)
+        self.assertEqual(tracker.positions, {'head': 12})
+
+    ########################################
+    def test_times_out_when_the_budget_runs_out(self):
+        base = ScriptedBase(*[{'head': position} for position in range(100)])
+        tracker = self.track(base, {'head': 99}, maxRequests=10)
+        self.assertEqual(tracker.run(), TIMED_OUT)
+        self.assertEqual(tracker.requests, 10)
+
+    ########################################
+    def test_failed_reads_count_against_the_budget_only(self):
+        base = ScriptedBase({'head': 10}, IOError(), IOError(), {'head': 20}, {'head': 30})
+        tracker = self.track(base, {'head': 30}, stallReads=2)
+        self.assertEqual(tracker.run(), REACHED)
+        self.assertEqual(tracker.requests, 5)
+
+    ########################################
+    def test_reports_progress_only_when_the_positions_change(self):
+        progress = []
+        base = ScriptedBase({'head': 10}, {'head': 10}, {'head': 20})
+        tracker = self.track(base, {'head': None}, stallReads=3, onProgress=progress.append)
+        tracker.run()
+        self.assertEqual(progress, [{'head': 10}, {'head': 20}])
+
+    ########################################
+    def test_cancel_stops_tracking(self):
+        base = ScriptedBase({'head': 0})
+        tracker = self.track(base, {'head': 40}, interval=5)
+        threading.Timer(0.01, tracker.cancel).start()
+        self.assertEqual(tracker.run(), CANCELLED)
+        self.assertEqual(tracker.requests, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Tests for sleepyq.ratelimit.PriorityRateLimiter
+#
+# Run from the Server Plugin folder: python -m pytest -q tests
+#
+################################################################################
+
+import threading
+import time
+import unittest
+
+from sleepyq.ratelimit import SAFETY, USER, BACKGROUND, PriorityRateLimiter
+
+
+################################################################################
+class PriorityRateLimiterTests(unittest.TestCase):
+    ########################################
+    def test_burst_is_granted_at_once(self):
+        limiter = PriorityRateLimiter(rate=1, burst=5)
+        start = time.monotonic()
+        for _ in range(5):
+            self.assertTrue(limiter.acquire(BACKGROUND, timeout=0))
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertFalse(limiter.acquire(BACKGROUND, timeout=0.05))
+
+    ########################################
+    def test_tokens_refill_at_rate(self):
+        limiter = PriorityRateLimiter(rate=20, burst=1)
+        self.assertTrue(limiter.acquire(BACKGROUND, timeout=0))
+        start = time.monotonic()
+        self.assertTrue(limiter.acquire(BACKGROUND, timeout=1))
+        self.assertGreaterEqual(time.monotonic() - start, 0.03)
+
+    ########################################
+    def test_safety_never_waits(self):
+        limiter = PriorityRateLimiter(rate=1, burst=1)
+        self.assertTrue(limiter.acquire(USER, timeout=0))
+        start = time.monotonic()
+        self.assertTrue(limiter.acquire(SAFETY))
+        self.assertTrue(limiter.acquire(SAFETY))
+        self.assertLess(time.monotonic() - start, 0.05)
+        # The safety requests left the bucket in debt, which later requests pay back.
+        self.assertFalse(limiter.acquire(USER, timeout=0.5))
+
+    ########################################
+    def test_user_requests_go_ahead_of_waiting_background_requests(self):
+        limiter = PriorityRateLimiter(rate=20, burst=1)
+        self.assertTrue(limiter.acquire(BACKGROUND, timeout=0))
+        granted = []
+        lock = threading.Lock()
+
+        def request(priority, name):
+            if limiter.acquire(priority, timeout=5):
+                with lock:
+                    granted.append(name)
+
+        threads = [threading.Thread(target=request, args=(BACKGROUND, f"background {index}")) for index in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.01)  # The background requests are waiting before the user request arrives.
+        threads.append(threading.Thread(target=request, args=(USER, "user")))
+        threads[-1].start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(granted[0], "user")
+        self.assertEqual(len(granted), 4)
+
+    ########################################
+    def test_same_priority_is_first_come_first_served(self):
+        limiter = PriorityRateLimiter(rate=50, burst=1)
+        self.assertTrue(limiter.acquire(BACKGROUND, timeout=0))
+        granted = []
+        threads = []
+        for index in range(4):
+            threads.append(threading.Thread(target=lambda index=index: limiter.acquire(BACKGROUND, timeout=5) and granted.append(index)))
+            threads[-1].start()
+            time.sleep(0.005)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(granted, [0, 1, 2, 3])
+
+    ########################################
+    def test_timed_out_waiter_leaves_the_line(self):
+        limiter = PriorityRateLimiter(rate=10, burst=1)
+        self.assertTrue(limiter.acquire(BACKGROUND, timeout=0))
+        self.assertFalse(limiter.acquire(USER, timeout=0.01))
+        self.assertEqual(limiter._waiters, [])
+        self.assertTrue(limiter.acquire(BACKGROUND, timeout=1))
+
+    ########################################
+    def test_larger_burst_is_available_at_once(self):
+        limiter = PriorityRateLimiter(rate=1, burst=2)
+        self.assertTrue(limiter.acquire(BACKGROUND, timeout=0))
+        self.assertTrue(limiter.acquire(BACKGROUND, timeout=0))
+        limiter.configure(burst=5)
+        for _ in range(3):
+            self.assertTrue(limiter.acquire(BACKGROUND, timeout=0))
+        self.assertFalse(limiter.acquire(BACKGROUND, timeout=0))
+
+    ########################################
+    def test_configure_wakes_waiters(self):
+        limiter = PriorityRateLimiter(rate=0.1, burst=1)
+        self.assertTrue(limiter.acquire(BACKGROUND, timeout=0))
+        result = []
+        thread = threading.Thread(target=lambda: result.append(limiter.acquire(BACKGROUND, timeout=5)))
+        thread.start()
+        time.sleep(0.02)
+        start = time.monotonic()
+        limiter.configure(burst=2)
+        thread.join()
+        self.assertEqual(result, [True])
+        self.assertLess(time.monotonic() - start, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
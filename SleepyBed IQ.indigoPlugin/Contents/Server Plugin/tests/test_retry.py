@@ -0,0 +1,261 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Tests for sleepyq.retry: RetryPolicy and CircuitBreaker, on their own and
+# as Sleepyq uses them (with a ReplayHTTPAdapter standing in for the service)
+#
+# Run from the Server Plugin folder: python -m pytest -q tests
+#
+################################################################################
+
+import requests
+import threading
+import time
+import unittest
+
+from sleepyq import Sleepyq
+from sleepyq.ratelimit import PriorityRateLimiter, RateLimitError
+from sleepyq.recording import ReplayHTTPAdapter
+from sleepyq.retry import CLOSED, OPEN, HALF_OPEN, OK, RELOGIN, RETRY, FAIL, CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+################################################################################
+class RetryPolicyTests(unittest.TestCase):
+    ########################################
+    def test_classify(self):
+        policy = RetryPolicy()
+        self.assertEqual(policy.classify(200), OK)
+        self.assertEqual(policy.classify(204), OK)
+        self.assertEqual(policy.classify(401), RELOGIN)
+        for status in (408, 429, 500, 502, 503, 504):
+            self.assertEqual(policy.classify(status), RETRY)
+        for status in (400, 403, 404, 501):
+            self.assertEqual(policy.classify(status), FAIL)
+
+    ########################################
+    def test_first_retry_waits_at_most_base_delay(self):
+        policy = RetryPolicy(base_delay=0.5, max_delay=8)
+        for _ in range(200):
+            self.assertLessEqual(policy.delay(1), 0.5)
+            self.assertLessEqual(policy.delay(2), 1.0)
+            self.assertLessEqual(policy.delay(3), 2.0)
+
+    ########################################
+    def test_delay_is_capped_at_max_delay(self):
+        policy = RetryPolicy(base_delay=0.5, max_delay=8)
+        delays = [policy.delay(20) for _ in range(200)]
+        self.assertLessEqual(max(delays), 8)
+        self.assertGreater(max(delays), 4)  # Jittered over the whole range, not stuck at the low end.
+
+
+################################################################################
+class CircuitBreakerTests(unittest.TestCase):
+    ########################################
+    def setUp(self):
+        self.changes = []
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.05,
+                                      listener=lambda old, new: self.changes.append((old, new)))
+
+    ########################################
+    def openBreaker(self):
+        for _ in range(self.breaker.failure_threshold):
+            self.breaker.record_failure()
+
+    ########################################
+    def test_opens_after_threshold_failures_in_a_row(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.changes, [(CLOSED, OPEN)])
+
+    ########################################
+    def test_success_resets_the_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    ########################################
+    def test_one_trial_call_after_reset_timeout(self):
+        self.openBreaker()
+        self.assertGreater(self.breaker.retry_after(), 0)
+        self.assertIn("retrying in", self.breaker.rejection_reason())
+        time.sleep(0.06)
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.rejection_reason(), "a trial request is in progress")
+
+    ########################################
+    def test_successful_trial_closes(self):
+        self.openBreaker()
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.changes, [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)])
+
+    ########################################
+    def test_failed_trial_opens_again(self):
+        self.openBreaker()
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.changes, [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, OPEN)])
+
+    ########################################
+    def waitDuringTrial(self, recordResult):
+        # Make a trial call on another thread that recordResult finishes, and wait for it.
+        self.openBreaker()
+        time.sleep(0.06)
+        trialStarted = threading.Event()
+
+        def trial():
+            self.assertTrue(self.breaker.allow())
+            trialStarted.set()
+            time.sleep(0.05)
+            recordResult()
+
+        threading.Thread(target=trial).start()
+        trialStarted.wait()
+        start = time.monotonic()
+        allowed = self.breaker.allow(timeout=2)
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        return allowed
+
+    ########################################
+    def test_calls_waiting_for_a_successful_trial_are_allowed(self):
+        self.assertTrue(self.waitDuringTrial(self.breaker.record_success))
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    ########################################
+    def test_calls_waiting_for_a_failed_trial_are_rejected(self):
+        self.assertFalse(self.waitDuringTrial(self.breaker.record_failure))
+        self.assertEqual(self.breaker.state, OPEN)
+
+    ########################################
+    def test_released_trial_goes_to_a_waiting_call(self):
+        self.assertTrue(self.waitDuringTrial(self.breaker.release))
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        # The waiting call made the new trial, so nobody else gets one.
+        self.assertFalse(self.breaker.allow())
+
+    ########################################
+    def test_release_only_gives_up_this_threads_trial(self):
+        self.openBreaker()
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.allow())
+        thread = threading.Thread(target=self.breaker.release)
+        thread.start()
+        thread.join()
+        self.assertFalse(self.breaker.allow())
+
+
+################################################################################
+class SleepyqRetryTests(unittest.TestCase):
+    ########################################
+    def connect(self, bedEntry, speed=None, otherEntries=()):
+        entries = [{'method': "PUT", 'path': "/rest/login", 'seconds': 0, 'status': 200, 'json': {'key': "key"}},
+                   dict(bedEntry, method="GET", path="/rest/bed")] + list(otherEntries)
+        self.adapter = ReplayHTTPAdapter(entries, speed=speed)
+        connection = Sleepyq("user", "password", api_url="http://sleepiq.test/rest", adapter=self.adapter, rate_limit=None)
+        connection.retry_policy.base_delay = 0.01
+        connection.login()
+        self.addCleanup(connection.close)
+        return connection
+
+    ########################################
+    def test_retries_until_attempts_run_out(self):
+        connection = self.connect({'seconds': 0, 'status': 503, 'json': {}})
+        with self.assertRaises(requests.exceptions.HTTPError):
+            connection.beds()
+        self.assertEqual(self.adapter.requests_sent, 1 + connection.retry_policy.attempts)
+
+    ########################################
+    def test_does_not_retry_client_errors(self):
+        connection = self.connect({'seconds': 0, 'status': 404, 'json': {}})
+        with self.assertRaises(requests.exceptions.HTTPError):
+            connection.beds()
+        self.assertEqual(self.adapter.requests_sent, 2)
+        self.assertEqual(connection.breaker.state, CLOSED)
+
+    ########################################
+    def test_stops_retrying_at_the_deadline(self):
+        connection = self.connect({'seconds': 0.15, 'error': "timeout"}, speed=1)
+        connection.retry_policy.attempts = 100
+        connection.retry_policy.deadline = 0.4
+        start = time.monotonic()
+        with self.assertRaises(requests.exceptions.Timeout):
+            connection.beds()
+        self.assertLess(time.monotonic() - start, 0.6)
+        self.assertLessEqual(self.adapter.requests_sent, 1 + 3)
+
+    ########################################
+    def test_open_breaker_fails_fast(self):
+        connection = self.connect({'seconds': 0, 'error': "connection"})
+        connection.retry_policy.attempts = 1
+        for _ in range(connection.breaker.failure_threshold):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                connection.beds()
+        sent = self.adapter.requests_sent
+        with self.assertRaises(CircuitOpenError):
+            connection.beds()
+        self.assertEqual(self.adapter.requests_sent, sent)
+
+    ########################################
+    def test_poll_through_a_half_open_breaker(self):
+        # The poll's three requests are sent at once. One is the trial; the others wait for it instead of failing.
+        connection = self.connect({'seconds': 0.05, 'status': 200, 'json': {'beds': [{'bedId': "1", 'name': "Bed"}]}}, speed=1,
+                                  otherEntries=[{'method': "GET", 'path': "/rest/sleeper", 'seconds': 0.05, 'status': 200, 'json': {'sleepers': []}},
+                                                {'method': "GET", 'path': "/rest/bed/familyStatus", 'seconds': 0.05, 'status': 200, 'json': {'beds': []}}])
+        connection.breaker.reset_timeout = 0.05
+        for _ in range(connection.breaker.failure_threshold):
+            connection.breaker.record_failure()
+        time.sleep(0.06)
+        self.assertEqual(connection.breaker.state, HALF_OPEN)
+        beds = connection.beds_with_sleeper_status()
+        self.assertEqual([bed.bed_id for bed in beds], ["1"])
+        self.assertEqual(connection.breaker.state, CLOSED)
+        self.assertEqual(self.adapter.requests_sent, 1 + 3)
+
+    ########################################
+    def test_rate_limited_trial_is_released(self):
+        connection = self.connect({'seconds': 0, 'status': 200, 'json': {'beds': []}})
+        connection.rate_limiter = PriorityRateLimiter(rate=0.01, burst=0)
+        connection.retry_policy.deadline = 0.05
+        connection.breaker.reset_timeout = 0.05
+        for _ in range(connection.breaker.failure_threshold):
+            connection.breaker.record_failure()
+        time.sleep(0.06)
+        sent = self.adapter.requests_sent
+        with self.assertRaises(RateLimitError):
+            connection.beds()
+        self.assertEqual(self.adapter.requests_sent, sent)
+        # No trial was sent, so the breaker is still half open with the trial free for the next call.
+        self.assertEqual(connection.breaker.state, HALF_OPEN)
+        self.assertTrue(connection.breaker.allow())
+
+    ########################################
+    def test_rate_limited_call_does_not_reset_the_failure_count(self):
+        connection = self.connect({'seconds': 0, 'status': 200, 'json': {'beds': []}})
+        connection.rate_limiter = PriorityRateLimiter(rate=0.01, burst=0)
+        connection.retry_policy.deadline = 0.05
+        for _ in range(connection.breaker.failure_threshold - 1):
+            connection.breaker.record_failure()
+        with self.assertRaises(RateLimitError):
+            connection.beds()
+        connection.breaker.record_failure()
+        self.assertEqual(connection.breaker.state, OPEN)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# APIobject attribute access micro-benchmark
+#
+# Compares reading snake_case attributes from sleepyq API objects through the
+# memoized name table against the old per-access inflection.camelize() call.
+#
+# Usage: python benchmarks/bench_apiobject.py [iterations]
+#
+################################################################################
+
+import os
+import sys
+import timeit
+
+PLUGIN_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SleepyBed IQ.indigoPlugin", "Contents", "Server Plugin")
+sys.path.insert(0, PLUGIN_FOLDER)
+
+import inflection
+import sleepyq
+
+NAMES = ['bed_id', 'sleeper_id', 'sleeper_left_id', 'sleeper_right_id', 'fsBoardFeatures', 'fsBedType']
+DATA = {'bedId': "-9223372019941310000", 'sleeperId': "-9223372019946840000", 'sleeperLeftId': "-9223372019946840000",
+        'sleeperRightId': "0", 'fsBoardFeatures': 6, 'fsBedType': 1}
+
+
+class CamelizeAPIobject(object):
+    # The APIobject attribute lookup as it was before the name table was added.
+    def __init__(self, data):
+        self.data = data
+
+    def __getattr__(self, name):
+        adjusted_name = inflection.camelize(name, False)
+        return self.data[adjusted_name] if self.data is not None else None
+
+
+def read_all(api_object):
+    for name in NAMES:
+        getattr(api_object, name)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for label, api_object in (("inflection.camelize", CamelizeAPIobject(DATA)), ("memoized name table", sleepyq.APIobject(DATA))):
+        seconds = min(timeit.repeat(lambda: read_all(api_object), number=iterations, repeat=5))
+        print(f"{label:>20}: {seconds / (iterations * len(NAMES)) * 1e9:8.1f} ns per attribute read")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Poll cycle and command benchmark
+#
+# Runs the plugin outside of Indigo (with benchmarks/indigo_stub.py standing
+# in for the indigo module) against a local SleepIQ stand-in started in a
+# separate process, so the CPU time measured is the plugin's alone. For each
+# combination of bed and device counts it times a number of status update
+# cycles (Plugin.pollBeds) back to back with the request rate limiter off, so
+# the plugin's own cost is measured, and a batch of SleepNumber commands, and
+# reports latency percentiles, CPU time, SleepIQ requests and Indigo API calls
+# per cycle. For each bed count it also runs a few cycles the way the plugin
+# runs in Indigo, with the shipped rate limiter and --interval seconds between
+# cycles, and reports how long they take. Any cycle where a bed's base
+# information missed the plugin's baseFetchDeadline is flagged. The results
+# are saved as JSON so runs for different plugin versions can be compared.
+#
+# Usage: python benchmarks/bench_poll_cycle.py [--beds 1,4,16,64] [--devices 1,100,500] [--cycles 20]
+#            [--limited-cycles 3] [--interval 10] [--latency 0.05] [--jitter 0.02] [--activity 0.1]
+#            [--output FILE] [--compare FILE]
+#
+################################################################################
+
+import argparse
+import json
+import logging
+import os
+import platform
+import plistlib
+import subprocess
+import sys
+import threading
+import time
+import types
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_BUNDLE = os.path.join(BENCHMARK_FOLDER, "..", "SleepyBed IQ.indigoPlugin")
+PLUGIN_FOLDER = os.path.join(PLUGIN_BUNDLE, "Contents", "Server Plugin")
+sys.path.insert(0, BENCHMARK_FOLDER)
+sys.path.insert(0, PLUGIN_FOLDER)
+
+import indigo_stub
+
+indigo = indigo_stub.install()
+import plugin
+
+PLUGIN_ID = "com.nathansheldon.indigoplugin.SleepyBedIQ"
+
+
+########################################
+def percentile(values, fraction):
+    # Nearest rank percentile of a list of numbers.
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+########################################
+def summarize(values):
+    return {'p50': percentile(values, 0.5), 'p90': percentile(values, 0.9), 'p99': percentile(values, 0.99),
+            'max': max(values) if values else None, 'mean': sum(values) / len(values) if values else None}
+
+
+########################################
+def pluginVersion():
+    try:
+        with open(os.path.join(PLUGIN_BUNDLE, "Contents", "Info.plist"), "rb") as infoFile:
+            return plistlib.load(infoFile).get('PluginVersion', "")
+    except Exception:
+        return ""
+
+
+########################################
+def gitRevision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=BENCHMARK_FOLDER, capture_output=True,
+                              text=True, timeout=10).stdout.strip()
+    except Exception:
+        return ""
+
+
+########################################
+def startStandIn(beds, args):
+    # Start the SleepIQ stand-in in its own process and return the process and its base URL.
+    process = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_FOLDER, "sleepiq_standin.py"), "--port", "0",
+                                "--beds", str(beds), "--latency", str(args.latency), "--jitter", str(args.jitter),
+                                "--activity", str(args.activity), "--seed", str(args.seed)],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    line = process.stdout.readline()
+    if " at " not in line:
+        process.kill()
+        raise RuntimeError(f"The SleepIQ stand-in didn't start: {line}")
+    return process, line.strip().rsplit(" at ", 1)[1]
+
+
+########################################
+def stopStandIn(process):
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+########################################
+def startPlugin(url, deviceCount, rateLimited):
+    indigo.devices.clear()
+    indigo.server.__init__()  # A new install folder, so nothing is cached from the last case.
+    sleepyBed = plugin.Plugin(PLUGIN_ID, "SleepyBed IQ", pluginVersion(),
+                              {'username': "bench", 'password': "bench", 'apiUrl': url, 'logLevel': logging.WARNING})
+    if not rateLimited:
+        sleepyBed.requestRate = None
+    instrumentBaseFetch(sleepyBed)
+    if not sleepyBed.startup():
+        raise RuntimeError("The plugin couldn't log in to the SleepIQ stand-in")
+
+    # Spread the devices over the beds the way a user monitoring every bed (several times over) would.
+    bedIds = [bed.bed_id for bed in sleepyBed.connection.beds()]
+    for index in range(deviceCount):
+        device = indigo_stub.Device(1000 + index, f"Bed Device {index + 1}",
+                                    {'bedId': bedIds[index % len(bedIds)], 'base': "FlexFit 2", 'hasFootControl': True})
+        indigo.devices.add(device)
+        sleepyBed.deviceStartComm(device)
+    return sleepyBed
+
+
+########################################
+def stopPlugin(sleepyBed):
+    sleepyBed.shutdown()
+    # Let base fetches that missed the deadline finish before the stand-in stops, so they don't log errors.
+    sleepyBed.baseFetchExecutor.shutdown(wait=True)
+
+
+########################################
+def instrumentBaseFetch(sleepyBed):
+    # Time Plugin.fetchBaseData and count the beds with a base it had to skip because baseFetchDeadline ran out.
+    fetchBaseData = sleepyBed.fetchBaseData
+    sleepyBed.baseFetch = {'seconds': 0, 'missed': 0}
+
+    def timedFetchBaseData(beds):
+        start = time.perf_counter()
+        baseDataByBedId = fetchBaseData(beds)
+        sleepyBed.baseFetch = {'seconds': time.perf_counter() - start,
+                               'missed': sum(1 for bed in beds if bed.base and bed.bed_id not in baseDataByBedId)}
+        return baseDataByBedId
+
+    sleepyBed.fetchBaseData = timedFetchBaseData
+
+
+########################################
+def runCase(beds, deviceCount, args):
+    # Cycles run back to back here rather than seconds apart, so the request rate limiter is off. Otherwise it
+    # would be measured instead of the plugin (runLimitedCase measures it).
+    process, url = startStandIn(beds, args)
+    try:
+        sleepyBed = startPlugin(url, deviceCount, rateLimited=False)
+
+        # The first cycle also downloads the base features and writes every state, so it's reported separately.
+        firstCycle = measureCycle(sleepyBed)
+        cycles = [measureCycle(sleepyBed) for _ in range(args.cycles)]
+        commands = measureCommands(sleepyBed, min(args.commands, deviceCount))
+        stopPlugin(sleepyBed)
+    finally:
+        stopStandIn(process)
+
+    indigoCalls = dict()
+    for cycle in cycles:
+        for name, number in cycle['indigoCalls'].items():
+            indigoCalls[name] = indigoCalls.get(name, 0) + number / len(cycles)
+    return {
+        'beds': beds,
+        'devices': deviceCount,
+        'cycles': len(cycles),
+        'firstCycle': firstCycle,
+        'latency': summarize([cycle['latency'] for cycle in cycles]),
+        'cpu': summarize([cycle['cpu'] for cycle in cycles]),
+        'requestsPerCycle': sum(cycle['requests'] for cycle in cycles) / len(cycles),
+        'baseFetch': summarize([cycle['baseFetch'] for cycle in cycles]),
+        'basesMissed': sum(cycle['basesMissed'] for cycle in cycles),
+        'indigoCallsPerCycle': indigoCalls,
+        'commands': commands
+    }
+
+
+########################################
+def runLimitedCase(beds, args):
+    # Run cycles the way the plugin does in Indigo: with the shipped request rate limiter and cycles
+    # args.interval seconds apart, so tokens refill between them. The first cycle also downloads the base
+    # features, which needs the most requests.
+    process, url = startStandIn(beds, args)
+    try:
+        sleepyBed = startPlugin(url, 1, rateLimited=True)
+        cycles = []
+        start = time.monotonic()
+        for index in range(args.limited_cycles + 1):
+            time.sleep(max(0, start + index * args.interval - time.monotonic()))
+            cycles.append(measureCycle(sleepyBed))
+        stopPlugin(sleepyBed)
+    finally:
+        stopStandIn(process)
+    return {
+        'beds': beds,
+        'interval': args.interval,
+        'deadline': sleepyBed.baseFetchDeadline,
+        'firstCycle': cycles[0],
+        'latency': summarize([cycle['latency'] for cycle in cycles[1:]]),
+        'baseFetch': summarize([cycle['baseFetch'] for cycle in cycles]),
+        'basesMissed': sum(cycle['basesMissed'] for cycle in cycles),
+        'requestsPerCycle': sum(cycle['requests'] for cycle in cycles[1:]) / max(1, len(cycles) - 1)
+    }
+
+
+########################################
+def measureCycle(sleepyBed):
+    indigo_stub.resetCalls()
+    requests = sleepyBed.connection.connection_stats()['requests']
+    cpu = time.process_time()
+    start = time.perf_counter()
+    succeeded = sleepyBed.pollBeds()
+    latency = time.perf_counter() - start
+    return {'latency': latency, 'cpu': time.process_time() - cpu, 'succeeded': succeeded,
+            'requests': sleepyBed.connection.connection_stats()['requests'] - requests,
+            'baseFetch': sleepyBed.baseFetch['seconds'], 'basesMissed': sleepyBed.baseFetch['missed'],
+            'indigoCalls': indigo_stub.snapshotCalls()}
+
+
+########################################
+def measureCommands(sleepyBed, count):
+    # Queue one SleepNumber command per device (up to count) at once and time each from queued to finished.
+    # Commands for the same side of the same bed are coalesced, so only the ones actually sent are waited for.
+    if count == 0:
+        return None
+    latencies = []
+    finished = threading.Semaphore(0)
+    onFinished = sleepyBed.commandDispatcher.onFinished
+
+    def recordFinished(command):
+        onFinished(command)
+        latencies.append(command.latency())
+        finished.release()
+
+    sleepyBed.commandDispatcher.onFinished = recordFinished
+    sleepyBed.verifyDelays = (0.5,)  # One quick read back, so verification doesn't outlive the case.
+    requests = sleepyBed.connection.connection_stats()['requests']
+    coalesced = sleepyBed.commandDispatcher.coalesced
+    start = time.perf_counter()
+    for index in range(count):
+        action = types.SimpleNamespace(deviceId=1000 + index, props={'side': "LR"[index % 2], 'SleepNumber': str(5 * (index % 20) + 5)})
+        sleepyBed.setSleepNumber(action)
+    coalesced = sleepyBed.commandDispatcher.coalesced - coalesced
+    for _ in range(count - coalesced):
+        finished.acquire(timeout=60)
+    total = time.perf_counter() - start
+    # Let the read backs finish before the stand-in goes away.
+    deadline = time.monotonic() + 10
+    while sleepyBed.expectedStates and time.monotonic() < deadline:
+        time.sleep(0.05)
+    sleepyBed.commandDispatcher.onFinished = onFinished
+    return {'count': count, 'coalesced': coalesced, 'latency': summarize(latencies), 'total': total,
+            'requests': sleepyBed.connection.connection_stats()['requests'] - requests}
+
+
+########################################
+def printResults(results, baseline=None):
+    baselineByCase = {(case['beds'], case['devices']): case for case in (baseline or {}).get('results', [])}
+    print(f"{'beds':>5} {'devices':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'cpu ms':>8} {'requests':>8} "
+          f"{'states':>7} {'cmd p50':>8}" + ("   vs baseline (p50, cpu)" if baseline else ""))
+    for case in results:
+        commandLatency = case['commands']['latency']['p50'] * 1000 if case['commands'] else 0
+        line = (f"{case['beds']:>5} {case['devices']:>7} {case['latency']['p50'] * 1000:>8.1f} {case['latency']['p90'] * 1000:>8.1f} "
+                f"{case['latency']['p99'] * 1000:>8.1f} {case['cpu']['mean'] * 1000:>8.1f} {case['requestsPerCycle']:>8.1f} "
+                f"{case['indigoCallsPerCycle'].get('device.statesWritten', 0):>7.1f} {commandLatency:>8.1f}")
+        old = baselineByCase.get((case['beds'], case['devices']))
+        if old:
+            line += (f"   {(case['latency']['p50'] / old['latency']['p50'] - 1) * 100:+6.1f}% "
+                     f"{(case['cpu']['mean'] / max(old['cpu']['mean'], 1e-9) - 1) * 100:+6.1f}%")
+        print(line)
+        if case.get('basesMissed'):
+            print(f"      !! {case['basesMissed']} bed base update(s) missed the base fetch deadline")
+
+
+########################################
+def printLimitedResults(limitedResults):
+    if not limitedResults:
+        return
+    print(f"\nWith the shipped rate limiter, cycles {limitedResults[0]['interval']:g} seconds apart "
+          f"(base fetch deadline {limitedResults[0]['deadline']:g} seconds):")
+    print(f"{'beds':>5} {'first ms':>9} {'p50 ms':>8} {'p90 ms':>8} {'base max ms':>11} {'requests':>8}")
+    for case in limitedResults:
+        print(f"{case['beds']:>5} {case['firstCycle']['latency'] * 1000:>9.1f} {(case['latency']['p50'] or 0) * 1000:>8.1f} "
+              f"{(case['latency']['p90'] or 0) * 1000:>8.1f} {case['baseFetch']['max'] * 1000:>11.1f} {case['requestsPerCycle']:>8.1f}")
+        if case['basesMissed']:
+            print(f"      !! {case['basesMissed']} bed base update(s) missed the {case['deadline']:g} second base fetch deadline")
+
+
+########################################
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the plugin's status update cycle and command path.")
+    parser.add_argument('--beds', default="1,4,16,64", help="comma separated bed counts")
+    parser.add_argument('--devices', default="1,100,500", help="comma separated device counts")
+    parser.add_argument('--cycles', type=int, default=20, help="status update cycles measured per case")
+    parser.add_argument('--commands', type=int, default=16, help="most SleepNumber commands timed per case")
+    parser.add_argument('--latency', type=float, default=0.05, help="stand-in response latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.02, help="stand-in random extra latency in seconds")
+    parser.add_argument('--activity', type=float, default=0.1, help="chance a side's occupancy changes each cycle")
+    parser.add_argument('--limited-cycles', type=int, default=3,
+                        help="cycles per bed count run with the shipped rate limiter, 0 to skip them")
+    parser.add_argument('--interval', type=float, default=10,
+                        help="seconds between rate limited cycles (default the plugin's active update interval)")
+    parser.add_argument('--seed', type=int, default=1, help="stand-in random seed")
+    parser.add_argument('--output', default=None, help="JSON results file (default benchmarks/results/poll_cycle-<time>.json)")
+    parser.add_argument('--compare', default=None, help="JSON results file of an earlier run to compare with")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    results = []
+    for beds in [int(value) for value in args.beds.split(",")]:
+        for deviceCount in [int(value) for value in args.devices.split(",")]:
+            print(f"Running {beds} bed(s), {deviceCount} device(s)...", file=sys.stderr)
+            results.append(runCase(beds, deviceCount, args))
+    limitedResults = []
+    if args.limited_cycles > 0:
+        for beds in [int(value) for value in args.beds.split(",")]:
+            print(f"Running {beds} bed(s) with the rate limiter...", file=sys.stderr)
+            limitedResults.append(runLimitedCase(beds, args))
+
+    report = {
+        'plugin': {'version': pluginVersion(), 'revision': gitRevision()},
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': results,
+        'rateLimitedResults': limitedResults
+    }
+    output = args.output or os.path.join(BENCHMARK_FOLDER, "results", f"poll_cycle-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as outputFile:
+        json.dump(report, outputFile, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            baseline = json.load(baselineFile)
+    printResults(results, baseline)
+    printLimitedResults(limitedResults)
+    print(f"Results saved to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Minimal stand-in for the indigo module
+#
+# Provides just enough of the Indigo plugin API (PluginBase, server, devices,
+# triggers, Dict) to load plugin.py outside of Indigo, and counts every call
+# the plugin makes to the Indigo server so benchmarks can report them.
+#
+# Usage: install() before importing plugin, then add devices with
+#        devices.add(Device(...)).
+#
+################################################################################
+
+import builtins
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from collections import Counter
+
+calls = Counter()  # Indigo API name: number of calls
+_callsLock = threading.Lock()
+
+
+########################################
+def count(name):
+    with _callsLock:
+        calls[name] += 1
+
+
+########################################
+def resetCalls():
+    with _callsLock:
+        calls.clear()
+
+
+########################################
+def snapshotCalls():
+    with _callsLock:
+        return dict(calls)
+
+
+################################################################################
+class Dict(dict):
+    pass
+
+
+################################################################################
+class Server(object):
+    ########################################
+    def __init__(self):
+        self.installFolder = tempfile.mkdtemp(prefix="indigo-stub-")
+
+    ########################################
+    def getInstallFolderPath(self):
+        return self.installFolder
+
+    ########################################
+    def getLogsFolderPath(self, pluginId=None):
+        folder = os.path.join(self.installFolder, "Logs", pluginId or "")
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    ########################################
+    def log(self, message, typeName=None):
+        count('server.log')
+
+
+################################################################################
+class Device(object):
+    ########################################
+    def __init__(self, id, name, pluginProps, deviceTypeId="sleepNumberBed"):
+        self.id = id
+        self.name = name
+        self.deviceTypeId = deviceTypeId
+        self.pluginProps = Dict(pluginProps)
+        self.states = Dict()
+        self.enabled = True
+        self.configured = True
+
+    ########################################
+    @property
+    def onState(self):
+        return self.states.get('onOffState', False)
+
+    ########################################
+    def updateStatesOnServer(self, keyValueList):
+        count('device.updateStatesOnServer')
+        with _callsLock:
+            calls['device.statesWritten'] += len(keyValueList)
+        for state in keyValueList:
+            self.states[state['key']] = state['value']
+
+    ########################################
+    def replacePluginPropsOnServer(self, pluginProps):
+        count('device.replacePluginPropsOnServer')
+        self.pluginProps = Dict(pluginProps)
+
+    ########################################
+    def setErrorStateOnServer(self, error):
+        count('device.setErrorStateOnServer')
+
+    ########################################
+    def stateListOrDisplayStateIdChanged(self):
+        count('device.stateListOrDisplayStateIdChanged')
+
+
+################################################################################
+class Devices(object):
+    ########################################
+    def __init__(self):
+        self._devices = dict()
+
+    ########################################
+    def add(self, device):
+        self._devices[device.id] = device
+
+    ########################################
+    def clear(self):
+        self._devices.clear()
+
+    ########################################
+    def __getitem__(self, deviceId):
+        count('devices[]')
+        return self._devices[deviceId]
+
+    ########################################
+    def iter(self, filter=""):
+        # Only "self.<device type>" filters narrow the devices, since every device belongs to the plugin.
+        count('devices.iter')
+        deviceTypeId = filter.split(".", 1)[1] if filter.startswith("self.") else None
+        return iter([device for device in self._devices.values() if deviceTypeId in (None, device.deviceTypeId)])
+
+    ########################################
+    def __len__(self):
+        return len(self._devices)
+
+
+################################################################################
+class Trigger(object):
+    ########################################
+    def execute(self, trigger):
+        count('trigger.execute')
+
+
+################################################################################
+class PluginBase(object):
+    class StopThread(Exception):
+        pass
+
+    ########################################
+    def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        self.pluginId = pluginId
+        self.pluginDisplayName = pluginDisplayName
+        self.pluginVersion = pluginVersion
+        self.pluginPrefs = pluginPrefs
+        self.logger = logging.getLogger("Plugin")
+        self.plugin_file_handler = logging.NullHandler()
+        self.indigo_log_handler = logging.NullHandler()
+
+    ########################################
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+server = Server()
+devices = Devices()
+trigger = Trigger()
+
+
+########################################
+def install():
+    # Make this module importable as indigo and visible to plugin.py as the global the Indigo host provides.
+    module = sys.modules[__name__]
+    sys.modules['indigo'] = module
+    builtins.indigo = module
+    return module
@@ -0,0 +1,151 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Replay recorded SleepIQ traffic through the plugin
+#
+# Feeds a recording made with "Record SleepIQ Traffic" (sleepiq-traffic.jsonl
+# in the plugin's log folder) back through Plugin.pollBeds, with the plugin
+# running outside of Indigo (benchmarks/indigo_stub.py stands in for the
+# indigo module) and a ReplayHTTPAdapter answering its requests instead of
+# the SleepIQ service. Every recorded GET /bed starts a status update cycle,
+# so plugin versions can be timed and profiled against identical traffic.
+# Cycles start and requests are answered at the recorded times divided by
+# --speed; --speed 0 runs them back to back.
+#
+# Usage: python benchmarks/replay_traffic.py RECORDING [--speed 1] [--cycles N] [--profile]
+#            [--output FILE] [--compare FILE]
+#
+################################################################################
+
+import argparse
+import cProfile
+import json
+import logging
+import os
+import platform
+import pstats
+import sys
+import time
+
+from bench_poll_cycle import BENCHMARK_FOLDER, PLUGIN_ID, indigo, indigo_stub, plugin, gitRevision, pluginVersion, summarize
+from sleepyq import API_URL, Sleepyq
+from sleepyq.recording import ReplayHTTPAdapter, read_recording
+
+
+########################################
+def isCycleStart(entry):
+    return entry['method'] == "GET" and entry['path'].endswith("/bed")
+
+
+########################################
+def recordedBedIds(entries):
+    for entry in entries:
+        if isCycleStart(entry) and entry.get('status') == 200:
+            return [bed['bedId'] for bed in entry['json'].get('beds', [])]
+    return []
+
+
+########################################
+def replay(entries, args):
+    indigo.devices.clear()
+    indigo.server.__init__()  # A new install folder, so nothing is cached from an earlier run.
+    sleepyBed = plugin.Plugin(PLUGIN_ID, "SleepyBed IQ", pluginVersion(),
+                              {'username': "replay", 'password': "replay", 'logLevel': logging.WARNING})
+    adapter = ReplayHTTPAdapter(entries, speed=args.speed or None)
+    sleepyBed.loadCapabilities()
+    # The recording already holds whatever rate limiting the plugin did when it was made.
+    sleepyBed.connection = Sleepyq("replay", "replay", api_url=API_URL, adapter=adapter, rate_limit=None)
+
+    for index, bedId in enumerate(recordedBedIds(entries)):
+        device = indigo_stub.Device(1000 + index, f"Bed Device {index + 1}", {'bedId': bedId})
+        indigo.devices.add(device)
+        sleepyBed.deviceStartComm(device)
+
+    cycleTimes = [entry['t'] for entry in entries if isCycleStart(entry)][:args.cycles]
+    profiler = cProfile.Profile() if args.profile else None
+    cycles = []
+    start = time.monotonic()
+    try:
+        for cycleTime in cycleTimes:
+            if args.speed:
+                time.sleep(max(0, start + (cycleTime - cycleTimes[0]) / args.speed - time.monotonic()))
+            indigo_stub.resetCalls()
+            cpu = time.process_time()
+            cycleStart = time.perf_counter()
+            if profiler:
+                profiler.enable()
+            succeeded = sleepyBed.pollBeds()
+            if profiler:
+                profiler.disable()
+            cycles.append({'latency': time.perf_counter() - cycleStart, 'cpu': time.process_time() - cpu,
+                           'succeeded': succeeded, 'statesWritten': indigo_stub.snapshotCalls().get('device.statesWritten', 0)})
+    finally:
+        sleepyBed.shutdown()
+
+    if profiler:
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats('tottime').print_stats(20)
+    return {
+        'cycles': len(cycles),
+        'failed': sum(1 for cycle in cycles if not cycle['succeeded']),
+        'elapsed': time.monotonic() - start,
+        'latency': summarize([cycle['latency'] for cycle in cycles]),
+        'cpu': summarize([cycle['cpu'] for cycle in cycles]),
+        'statesWrittenPerCycle': sum(cycle['statesWritten'] for cycle in cycles) / max(1, len(cycles)),
+        'requests': sleepyBed.connection.connection_stats()['requests'],
+        'unreplayed': adapter.remaining()
+    }
+
+
+########################################
+def printResult(result, baseline=None):
+    print(f"{result['cycles']} cycles ({result['failed']} failed) in {result['elapsed']:.1f} seconds, "
+          f"{result['requests']} requests, {result['unreplayed']} recorded requests not replayed")
+    print(f"cycle p50 {result['latency']['p50'] * 1000:.1f} ms, p90 {result['latency']['p90'] * 1000:.1f} ms, "
+          f"cpu {result['cpu']['mean'] * 1000:.1f} ms, {result['statesWrittenPerCycle']:.1f} states written per cycle")
+    if baseline:
+        print(f"vs baseline: p50 {(result['latency']['p50'] / baseline['latency']['p50'] - 1) * 100:+.1f}%, "
+              f"cpu {(result['cpu']['mean'] / max(baseline['cpu']['mean'], 1e-9) - 1) * 100:+.1f}%")
+
+
+########################################
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded SleepIQ traffic through the plugin's status updates.")
+    parser.add_argument('recording', help="sleepiq-traffic.jsonl recorded by the plugin (rotated files are read too)")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed, e.g. 10 for ten times faster, 0 for no waiting")
+    parser.add_argument('--cycles', type=int, default=None, help="most status update cycles replayed")
+    parser.add_argument('--profile', action='store_true', help="profile the cycles and print the functions taking the most time")
+    parser.add_argument('--output', default=None, help="JSON results file (default benchmarks/results/replay-<time>.json)")
+    parser.add_argument('--compare', default=None, help="JSON results file of an earlier replay to compare with")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    entries = read_recording(args.recording)
+    if not any(isCycleStart(entry) for entry in entries):
+        sys.exit(f"No status updates found in {args.recording}")
+    result = replay(entries, args)
+
+    report = {
+        'plugin': {'version': pluginVersion(), 'revision': gitRevision()},
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'recording': os.path.abspath(args.recording),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'recording')},
+        'result': result
+    }
+    output = args.output or os.path.join(BENCHMARK_FOLDER, "results", f"replay-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as outputFile:
+        json.dump(report, outputFile, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            baseline = json.load(baselineFile)['result']
+    printResult(result, baseline)
+    print(f"Results saved to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Local SleepIQ API stand-in
+#
+# Answers the SleepIQ REST endpoints the sleepyq library uses with simulated
+# beds, so the plugin and library can be tested and benchmarked without the
+# real service. Bases move toward the position they were sent at a steady
+# rate, and latency, error rate and session key expiry are configurable.
+#
+# Usage: python benchmarks/sleepiq_standin.py [--port 8780] [--beds 1] [--latency 0.05]
+#            [--jitter 0.02] [--error-rate 0] [--key-lifetime 0] [--activity 0]
+#
+# Point Sleepyq at it with Sleepyq(login, password, api_url="http://127.0.0.1:8780/rest")
+# or the plugin's "SleepIQ Service URL" setting. Any login and password are accepted.
+#
+################################################################################
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+PRESET_POSITIONS = {1: (20, 0), 2: (45, 5), 3: (35, 15), 4: (0, 0), 5: (15, 35), 6: (12, 0)}  # preset: (head, foot)
+
+
+################################################################################
+class SimulatedBed(object):
+    ########################################
+    def __init__(self, index, motionRate):
+        self.bedId = f"-92233720199413{index:05d}"
+        self.motionRate = motionRate  # Percent per second the base actuators move.
+        self.sleeperIds = {'left': f"-92233720199468{index * 2:05d}", 'right': f"-92233720199468{index * 2 + 1:05d}"}
+        self.sleepNumbers = {'left': 40, 'right': 50}
+        self.favorites = {'left': 40, 'right': 50}
+        self.inBed = {'left': False, 'right': False}
+        self.outlets = {1: 0, 2: 0, 3: 0, 4: 0}
+        self.actuators = dict()  # (side, 'Head' or 'Foot'): [position, target, time.monotonic() of position]
+        for side in ('Left', 'Right'):
+            for actuator in ('Head', 'Foot'):
+                self.actuators[(side, actuator)] = [0.0, 0.0, time.monotonic()]
+
+    ########################################
+    def position(self, side, actuator):
+        # Move the actuator as far toward its target as it could have since it was last looked at.
+        state = self.actuators[(side, actuator)]
+        now = time.monotonic()
+        step = (now - state[2]) * self.motionRate
+        if abs(state[1] - state[0]) <= step:
+            state[0] = state[1]
+        else:
+            state[0] += step if state[1] > state[0] else -step
+        state[2] = now
+        return int(state[0])
+
+    ########################################
+    def move(self, side, actuator, target):
+        self.position(side, actuator)
+        self.actuators[(side, actuator)][1] = float(target)
+
+    ########################################
+    def stop(self, side):
+        for actuator in ('Head', 'Foot'):
+            self.actuators[(side, actuator)][1] = float(self.position(side, actuator))
+
+    ########################################
+    def bedData(self, index):
+        return {'bedId': self.bedId, 'accountId': "-9223372019953550000", 'name': f"Bed {index + 1}",
+                'base': "FlexFit 2", 'sleeperLeftId': self.sleeperIds['left'], 'sleeperRightId': self.sleeperIds['right'],
+                'dualSleep': True, 'generation': "360", 'isKidsBed': False, 'macAddress': f"64DBA0{index:06X}",
+                'model': "P6", 'purchaseDate': "2020-01-01T00:00:00Z", 'reference': f"{index:010d}",
+                'registrationDate': "2020-01-01T00:00:00Z", 'returnRequestStatus': 0, 'serial': "",
+                'size': "KING", 'sku': "QP6", 'status': 1, 'timezone': "US/Pacific", 'version': "",
+                'zipcode': "55401"}
+
+    ########################################
+    def sleeperData(self, side, index):
+        return {'sleeperId': self.sleeperIds[side], 'bedId': self.bedId, 'firstName': f"{side.capitalize()} {index + 1}",
+                'side': 0 if side == 'left' else 1, 'sleepGoal': 480, 'active': True}
+
+    ########################################
+    def familyStatus(self):
+        return {'bedId': self.bedId, 'status': 1,
+                'leftSide': self.sideStatus('left'), 'rightSide': self.sideStatus('right')}
+
+    ########################################
+    def sideStatus(self, side):
+        return {'isInBed': self.inBed[side], 'alertDetailedMessage': "No Alert", 'sleepNumber': self.sleepNumbers[side],
+                'alertId': 0, 'lastLink': "00:00:00", 'pressure': 1000 + self.sleepNumbers[side] * 10}
+
+    ########################################
+    def foundationStatus(self):
+        status = {'fsCurrentPositionPresetRight': "Flat", 'fsNeedsHoming': False, 'fsRightFootActuatorMotorStatus': "00",
+                  'fsCurrentPositionPresetLeft': "Flat", 'fsLeftHeadActuatorMotorStatus': "00", 'fsTimerPositionPresetLeft': "No timer running, thus not applicable",
+                  'fsConfigured': True, 'fsType': "Split King", 'fsOutletsOn': False, 'fsIsMoving': False}
+        for (side, actuator) in self.actuators:
+            position = self.position(side, actuator)
+            status[f"fs{side}{actuator}Position"] = f"{position:02x}"
+            status['fsIsMoving'] = status['fsIsMoving'] or position != int(self.actuators[(side, actuator)][1])
+        return status
+
+
+################################################################################
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep connections alive like the real service.
+    disable_nagle_algorithm = True  # Headers and body are written separately; don't hold the body for an ACK.
+
+    ########################################
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    ########################################
+    def do_GET(self):
+        self.handle_request('GET')
+
+    ########################################
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    ########################################
+    def handle_request(self, method):
+        standIn = self.server.standIn
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b""
+        try:
+            data = json.loads(body) if body else dict()
+        except ValueError:
+            data = dict()
+
+        status, response = standIn.respond(method, url.path, query, data)
+        payload = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', "application/json")
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+################################################################################
+class StandInServer(object):
+    ########################################
+    def __init__(self, beds=1, port=0, latency=0.0, jitter=0.0, errorRate=0.0, keyLifetime=0, motionRate=10.0,
+                 activity=0.0, seed=None, verbose=False):
+        self.latency = latency  # Seconds added to every response.
+        self.jitter = jitter  # Up to this many seconds more are added at random.
+        self.errorRate = errorRate  # Fraction of requests (other than logins) answered with a 503.
+        self.keyLifetime = keyLifetime  # Seconds a session key is valid, 0=forever. Expired keys get a 401.
+        self.activity = activity  # Chance each side's occupancy changes between two family status requests.
+        self.beds = [SimulatedBed(index, motionRate) for index in range(beds)]
+        self.bedsById = {bed.bedId: bed for bed in self.beds}
+        self.keys = dict()  # Session key: time.monotonic() it was issued.
+        self.counts = dict()  # "METHOD /path pattern": number of requests.
+        self.statusCounts = dict()  # HTTP status: number of responses.
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.httpServer = ThreadingHTTPServer(('127.0.0.1', port), StandInHandler)
+        self.httpServer.daemon_threads = True
+        self.httpServer.standIn = self
+        self.httpServer.verbose = verbose
+        self.thread = None
+
+    ########################################
+    @property
+    def url(self):
+        # Base URL to give Sleepyq.
+        return f"http://127.0.0.1:{self.httpServer.server_address[1]}/rest"
+
+    ########################################
+    def start(self):
+        self.thread = threading.Thread(target=self.httpServer.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    ########################################
+    def stop(self):
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+
+    ########################################
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.counts), 'statuses': dict(self.statusCounts)}
+
+    ########################################
+    def resetStats(self):
+        with self.lock:
+            self.counts.clear()
+            self.statusCounts.clear()
+
+    ########################################
+    def expireKeys(self):
+        # Make every session key invalid, as the service does now and then.
+        with self.lock:
+            self.keys.clear()
+
+    ########################################
+    def respond(self, method, path, query, data):
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+        route = re.sub(r"/bed/[^/]+/", "/bed/{bedId}/", path)
+        with self.lock:
+            name = f"{method} {route}"
+            self.counts[name] = self.counts.get(name, 0) + 1
+            status, response = self.route(method, path, query, data)
+            self.statusCounts[status] = self.statusCounts.get(status, 0) + 1
+        return status, response
+
+    ########################################
+    def route(self, method, path, query, data):
+        # Must be called with lock held.
+        if path == "/rest/login" and method == 'PUT':
+            if not data.get('login') or not data.get('password'):
+                return 401, {'Error': {'Code': 401, 'Message': "Invalid credentials"}}
+            key = uuid.uuid4().hex
+            self.keys[key] = time.monotonic()
+            return 200, {'userId': "-9223372019953550000", 'key': key, 'registrationState': 13}
+
+        issued = self.keys.get(query.get('_k', [""])[0], None)
+        if issued is None or (self.keyLifetime and time.monotonic() - issued > self.keyLifetime):
+            return 401, {'Error': {'Code': 50002, 'Message': "Session is invalid"}}
+        if self.errorRate and self.random.random() < self.errorRate:
+            return 503, {'Error': {'Code': 503, 'Message': "Service unavailable"}}
+
+        if path == "/rest/bed" and method == 'GET':
+            return 200, {'beds': [bed.bedData(index) for index, bed in enumerate(self.beds)]}
+        if path == "/rest/sleeper" and method == 'GET':
+            return 200, {'sleepers': [bed.sleeperData(side, index) for index, bed in enumerate(self.beds) for side in ('left', 'right')]}
+        if path == "/rest/bed/familyStatus" and method == 'GET':
+            if self.activity:
+                for bed in self.beds:
+                    for side in ('left', 'right'):
+                        if self.random.random() < self.activity:
+                            bed.inBed[side] = not bed.inBed[side]
+            return 200, {'beds': [bed.familyStatus() for bed in self.beds]}
+
+        match = re.match(r"^/rest/bed/([^/]+)/(.+)$", path)
+        if not match or match.group(1) not in self.bedsById:
+            return 404, {'Error': {'Code': 404, 'Message': "Not found"}}
+        bed = self.bedsById[match.group(1)]
+        endpoint = match.group(2)
+        side = 'Right' if data.get('side', query.get('side', ["L"])[0]) in ("R", 1, "1") else 'Left'
+
+        if endpoint == "foundation/status" and method == 'GET':
+            return 200, bed.foundationStatus()
+        if endpoint == "foundation/system" and method == 'GET':
+            return 200, {'fsBoardFeatures': 6, 'fsBedType': 2, 'fsLeftUnderbedLightPWM': 100, 'fsRightUnderbedLightPWM': 100,
+                         'fsBoardFaults': 0, 'fsBoardHWRevisionCode': 1, 'fsBoardStatus': 0}
+        if endpoint == "foundation/outlet":
+            outletId = int(data.get('outletId', query.get('outletId', [1])[0]))
+            if method == 'PUT':
+                bed.outlets[outletId] = int(data.get('setting', 0))
+                return 200, {}
+            return 200, {'bedId': bed.bedId, 'outlet': outletId, 'setting': bed.outlets.get(outletId, 0), 'timer': None}
+        if endpoint == "foundation/preset" and method == 'PUT':
+            head, foot = PRESET_POSITIONS.get(int(data.get('preset', 4)), (0, 0))
+            bed.move(side, 'Head', head)
+            bed.move(side, 'Foot', foot)
+            return 200, {}
+        if endpoint == "foundation/adjustment/micro" and method == 'PUT':
+            bed.move(side, 'Foot' if data.get('actuator') == "F" else 'Head', int(data.get('position', 0)))
+            return 200, {}
+        if endpoint == "foundation/adjustment" and method == 'PUT':
+            return 200, {}
+        if endpoint == "foundation/motion" and method == 'PUT':
+            bed.stop(side)
+            return 200, {}
+        if endpoint == "sleepNumber" and method == 'PUT':
+            bed.sleepNumbers[side.lower()] = int(data.get('sleepNumber', 0))
+            return 200, {}
+        if endpoint == "sleepNumberFavorite":
+            if method == 'PUT':
+                bed.favorites[side.lower()] = int(data.get('sleepNumberFavorite', 0))
+                return 200, {}
+            return 200, {'bedId': bed.bedId, 'sleepNumberFavoriteLeft': bed.favorites['left'],
+                         'sleepNumberFavoriteRight': bed.favorites['right']}
+        if endpoint == "pump/forceIdle" and method == 'PUT':
+            return 200, {}
+        return 404, {'Error': {'Code': 404, 'Message': "Not found"}}
+
+
+########################################
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the SleepIQ API.")
+    parser.add_argument('--port', type=int, default=8780)
+    parser.add_argument('--beds', type=int, default=1, help="number of simulated beds")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.02, help="up to this many seconds more added at random")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with a 503")
+    parser.add_argument('--key-lifetime', type=float, default=0, help="seconds before a session key expires, 0=never")
+    parser.add_argument('--activity', type=float, default=0.0, help="chance a side's occupancy changes per status request")
+    parser.add_argument('--motion-rate', type=float, default=10.0, help="percent per second the bases move")
+    parser.add_argument('--seed', type=int, default=None, help="random seed for repeatable jitter and errors")
+    parser.add_argument('--verbose', action='store_true', help="log every request")
+    args = parser.parse_args()
+
+    server = StandInServer(beds=args.beds, port=args.port, latency=args.latency, jitter=args.jitter,
+                           errorRate=args.error_rate, keyLifetime=args.key_lifetime, motionRate=args.motion_rate,
+                           activity=args.activity, seed=args.seed, verbose=args.verbose)
+    print(f"SleepIQ stand-in with {args.beds} bed(s) listening at {server.url}", flush=True)
+    try:
+        server.httpServer.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats(), indent=2))
+
+
+if __name__ == '__main__':
+    main()